@@ -59,6 +59,7 @@ impl Client {
             position_ids,
             max_length,
             cu_seq_lengths,
+            ..Default::default()
         })
         .inject_context();
         let response = self.stub.embed(request).await?.into_inner();
@@ -80,6 +81,7 @@ impl Client {
             position_ids,
             max_length,
             cu_seq_lengths,
+            ..Default::default()
         })
         .inject_context();
         let response = self.stub.predict(request).await?.into_inner();
@@ -0,0 +1,42 @@
+"""Request generation and timing shared by the benchmarks."""
+
+import time
+import torch
+
+from typing import Callable
+
+from text_embeddings_server.pb import embed_pb2
+
+
+def make_request(
+    batch_size: int, seq_length: int, ragged: bool = False
+) -> embed_pb2.EmbedRequest:
+    """
+    Random `EmbedRequest` of `batch_size` rows of `seq_length` tokens. `ragged` rows
+    vary between seq_length / 2 and seq_length tokens like real traffic
+    """
+    generator = torch.Generator().manual_seed(0)
+    if ragged:
+        lengths = torch.randint(
+            max(1, seq_length // 2), seq_length + 1, (batch_size,), generator=generator
+        )
+        lengths[0] = seq_length
+    else:
+        lengths = torch.full((batch_size,), seq_length)
+    total = int(lengths.sum())
+    return embed_pb2.EmbedRequest(
+        input_ids=torch.randint(1000, 10000, (total,), generator=generator).tolist(),
+        token_type_ids=[0] * total,
+        position_ids=torch.cat([torch.arange(int(l)) for l in lengths]).tolist(),
+        cu_seq_lengths=[0] + torch.cumsum(lengths, 0).tolist(),
+        max_length=seq_length,
+    )
+
+
+def timeit(fn: Callable, iterations: int) -> float:
+    """Seconds per call of `fn`, after one warmup call"""
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
@@ -0,0 +1,69 @@
+"""
+Microbenchmark for `PaddedBatch.from_pb`.
+
+Reports the time needed to turn an `EmbedRequest` into a padded CPU batch for a
+grid of batch sizes and sequence lengths, next to the per-row loop it replaced.
+
+    python benchmarks/from_pb.py --batch-sizes 1,32,256 --seq-lengths 16,128,512
+"""
+
+import torch
+import typer
+
+from common import make_request, timeit
+from text_embeddings_server.models.types import PaddedBatch
+from text_embeddings_server.pb import embed_pb2
+
+
+def loop_from_pb(pb: embed_pb2.EmbedRequest) -> torch.Tensor:
+    """Previous implementation: three small tensor allocations per row"""
+    batch_size = len(pb.cu_seq_lengths) - 1
+    all_tensors = torch.zeros([4, batch_size, pb.max_length], dtype=torch.int32)
+    for i, start_index in enumerate(pb.cu_seq_lengths[:-1]):
+        end_index = pb.cu_seq_lengths[i + 1]
+        input_length = end_index - start_index
+        all_tensors[0, i, :input_length] = torch.tensor(
+            pb.input_ids[start_index:end_index], dtype=torch.int32
+        )
+        all_tensors[1, i, :input_length] = torch.tensor(
+            pb.token_type_ids[start_index:end_index], dtype=torch.int32
+        )
+        all_tensors[2, i, :input_length] = torch.tensor(
+            pb.position_ids[start_index:end_index], dtype=torch.int32
+        )
+        all_tensors[3, i, :input_length] = 1
+    return all_tensors
+
+
+def main(
+    batch_sizes: str = "1,8,32,128,256",
+    seq_lengths: str = "16,64,128,512",
+    iterations: int = 20,
+):
+    device = torch.device("cpu")
+    print(
+        f"{'batch':>6} {'seq':>5} {'loop (ms)':>10} {'vectorized (ms)':>16} "
+        f"{'speedup':>8}"
+    )
+    for batch_size in [int(b) for b in batch_sizes.split(",")]:
+        for seq_length in [int(s) for s in seq_lengths.split(",")]:
+            pb = make_request(batch_size, seq_length, ragged=True)
+
+            batch = PaddedBatch.from_pb(pb, device, seq_length)
+            reference = loop_from_pb(pb)
+            assert torch.equal(batch.input_ids, reference[0])
+            assert torch.equal(batch.attention_mask, reference[3])
+
+            loop_ms = timeit(lambda: loop_from_pb(pb), iterations) * 1e3
+            vectorized_ms = (
+                timeit(lambda: PaddedBatch.from_pb(pb, device, seq_length), iterations)
+                * 1e3
+            )
+            print(
+                f"{batch_size:>6} {seq_length:>5} {loop_ms:>10.3f} "
+                f"{vectorized_ms:>16.3f} {loop_ms / vectorized_ms:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,73 @@
+"""
+Benchmark of the weight-only `--quantize` modes of FlashMistral and FlashQwen3.
+
+Loads the model unquantized, then with int8 and int4 weights, one at a time, and
+reports the size of the projection weights, the tokens per second of a grid of
+batch sizes and sequence lengths, and the cosine similarity of the embeddings to
+the unquantized model.
+
+    python benchmarks/quantize_decoder.py /data/Qwen3-Embedding-4B --dtype bfloat16
+"""
+
+import gc
+import torch
+import typer
+
+from pathlib import Path
+
+from common import make_request, timeit
+from text_embeddings_server.models import get_model
+from text_embeddings_server.utils.quantize import weight_nbytes
+
+
+def main(
+    model_path: Path,
+    dtype: str = "bfloat16",
+    pool: str = "lasttoken",
+    batch_sizes: str = "1,8",
+    seq_lengths: str = "128,512",
+    iterations: int = 5,
+):
+    shapes = [
+        (int(batch_size), int(seq_length))
+        for batch_size in batch_sizes.split(",")
+        for seq_length in seq_lengths.split(",")
+    ]
+    print(
+        f"{'weights':<8} {'GiB':>6} {'batch':>6} {'seq':>5} {'tokens/s':>10} "
+        f"{'speedup':>8} {'cosine':>8}"
+    )
+    reference = {}
+    baseline = {}
+    for quantize in [None, "int8", "int4"]:
+        model = get_model(model_path, dtype, pool, quantize)
+        nbytes, _ = weight_nbytes(model.model.layers)
+        name = quantize or dtype
+
+        for batch_size, seq_length in shapes:
+            batch = model.batch_type.from_pb(
+                make_request(batch_size, seq_length),
+                model.device,
+                model.max_input_length,
+            )
+            embeddings = model.embed(batch).float()
+            seconds = timeit(lambda: model.embed(batch), iterations)
+            if quantize is None:
+                reference[batch_size, seq_length] = embeddings
+                baseline[batch_size, seq_length] = seconds
+            cosine = torch.nn.functional.cosine_similarity(
+                embeddings, reference[batch_size, seq_length]
+            ).min()
+            print(
+                f"{name:<8} {nbytes / 2**30:>6.2f} {batch_size:>6} {seq_length:>5} "
+                f"{batch_size * seq_length / seconds:>10.1f} "
+                f"{baseline[batch_size, seq_length] / seconds:>7.2f}x "
+                f"{cosine:>8.4f}"
+            )
+
+        model = None
+        gc.collect()
+
+
+if __name__ == "__main__":
+    typer.run(main)
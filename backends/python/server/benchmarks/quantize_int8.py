@@ -0,0 +1,73 @@
+"""
+Benchmark of the `int8` CPU mode against float32.
+
+Loads every model twice through `get_model`, in float32 and in int8, and reports
+the rows per second of both for a grid of batch sizes and sequence lengths, next
+to the cosine similarity of their outputs. Pass one model per family to compare
+(BERT, RoBERTa, classifiers, SPLADE...).
+
+    python benchmarks/quantize_int8.py /data/bge-small,/data/ms-marco-MiniLM \
+        --batch-sizes 1,32 --seq-lengths 32,256
+"""
+
+import torch
+import typer
+
+from pathlib import Path
+from typing import Callable
+
+from common import make_request, timeit
+from text_embeddings_server.models import get_model
+from text_embeddings_server.pb import embed_pb2
+
+
+def forward_method(model) -> Callable:
+    """`embed`, or `predict` for classifiers, of a request"""
+    batch = model.batch_type.from_pb(make_request(1, 8), model.device, 8)
+    method = model.embed if model.embed(batch) is not None else model.predict
+
+    def forward(pb: embed_pb2.EmbedRequest) -> torch.Tensor:
+        batch = model.batch_type.from_pb(pb, model.device, model.max_input_length)
+        return method(batch)
+
+    return forward
+
+
+def main(
+    model_paths: str,
+    pool: str = "cls",
+    batch_sizes: str = "1,8,32",
+    seq_lengths: str = "32,128,512",
+    iterations: int = 10,
+):
+    print(
+        f"{'model':<24} {'batch':>6} {'seq':>5} {'fp32 rows/s':>12} "
+        f"{'int8 rows/s':>12} {'speedup':>8} {'cosine':>8}"
+    )
+    for model_path in model_paths.split(","):
+        name = Path(model_path).name
+        float_model = get_model(Path(model_path), "float32", pool)
+        int8_model = get_model(Path(model_path), "int8", pool)
+        float_forward = forward_method(float_model)
+        int8_forward = forward_method(int8_model)
+
+        for batch_size in [int(b) for b in batch_sizes.split(",")]:
+            for seq_length in [int(s) for s in seq_lengths.split(",")]:
+                if seq_length > float_model.max_input_length:
+                    continue
+                pb = make_request(batch_size, seq_length)
+                cosine = torch.nn.functional.cosine_similarity(
+                    float_forward(pb).float(), int8_forward(pb).float()
+                ).min()
+                float_seconds = timeit(lambda: float_forward(pb), iterations)
+                int8_seconds = timeit(lambda: int8_forward(pb), iterations)
+                print(
+                    f"{name:<24} {batch_size:>6} {seq_length:>5} "
+                    f"{batch_size / float_seconds:>12.1f} "
+                    f"{batch_size / int8_seconds:>12.1f} "
+                    f"{float_seconds / int8_seconds:>7.2f}x {cosine:>8.4f}"
+                )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,92 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from text_embeddings_server.utils import flash_attn
+from text_embeddings_server.utils.flash_attn import sdpa_varlen_attn
+
+LENGTHS = [5, 1, 12, 7]
+NUM_HEADS = 4
+HEAD_SIZE = 8
+SOFTMAX_SCALE = HEAD_SIZE**-0.5
+
+
+def packed_inputs(num_kv_heads=NUM_HEADS):
+    generator = torch.Generator().manual_seed(0)
+    total = sum(LENGTHS)
+    q = torch.randn(total, NUM_HEADS, HEAD_SIZE, generator=generator)
+    k = torch.randn(total, num_kv_heads, HEAD_SIZE, generator=generator)
+    v = torch.randn(total, num_kv_heads, HEAD_SIZE, generator=generator)
+    cu_seqlens = torch.tensor([0] + LENGTHS).cumsum(0).to(torch.int32)
+    return q, k, v, cu_seqlens
+
+
+def reference(q, k, v, cu_seqlens, is_causal=False):
+    """Attention of every sequence on its own"""
+    groups = q.size(1) // k.size(1)
+    out = torch.empty_like(q)
+    bounds = cu_seqlens.tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        out[start:end] = F.scaled_dot_product_attention(
+            q[start:end].transpose(0, 1),
+            k[start:end].repeat_interleave(groups, dim=1).transpose(0, 1),
+            v[start:end].repeat_interleave(groups, dim=1).transpose(0, 1),
+            is_causal=is_causal,
+            scale=SOFTMAX_SCALE,
+        ).transpose(0, 1)
+    return out
+
+
+@pytest.mark.parametrize("block_diagonal_max_tokens", [0, 512])
+@pytest.mark.parametrize("is_causal", [False, True])
+@pytest.mark.parametrize("num_kv_heads", [NUM_HEADS, 2])
+def test_packed_matches_per_sequence(
+    monkeypatch, block_diagonal_max_tokens, is_causal, num_kv_heads
+):
+    # 0 attends sequence by sequence, 512 with one block-diagonal mask
+    monkeypatch.setattr(
+        flash_attn, "BLOCK_DIAGONAL_MAX_TOKENS", block_diagonal_max_tokens
+    )
+    q, k, v, cu_seqlens = packed_inputs(num_kv_heads)
+
+    out = sdpa_varlen_attn(
+        q,
+        k,
+        v,
+        torch.empty_like(q),
+        cu_seqlens,
+        max(LENGTHS),
+        SOFTMAX_SCALE,
+        is_causal=is_causal,
+    )
+
+    torch.testing.assert_close(out, reference(q, k, v, cu_seqlens, is_causal))
+
+
+def test_padded_matches_packed():
+    q, k, v, cu_seqlens = packed_inputs()
+    batch_size, max_s = len(LENGTHS), max(LENGTHS)
+
+    padded = [torch.zeros(batch_size, max_s, NUM_HEADS, HEAD_SIZE) for _ in range(3)]
+    # Additive mask hiding the padded keys
+    attn_mask = torch.full((batch_size, 1, 1, max_s), torch.finfo(q.dtype).min)
+    for i, length in enumerate(LENGTHS):
+        start, end = cu_seqlens[i], cu_seqlens[i + 1]
+        for padded_tensor, packed_tensor in zip(padded, [q, k, v]):
+            padded_tensor[i, :length] = packed_tensor[start:end]
+        attn_mask[i, ..., :length] = 0
+
+    out = sdpa_varlen_attn(
+        *padded,
+        torch.empty_like(padded[0]),
+        cu_seqlens,
+        max_s,
+        SOFTMAX_SCALE,
+        attn_mask=attn_mask,
+    )
+
+    expected = reference(q, k, v, cu_seqlens)
+    for i, length in enumerate(LENGTHS):
+        torch.testing.assert_close(
+            out[i, :length], expected[cu_seqlens[i] : cu_seqlens[i + 1]]
+        )
@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+import torch
+
+from transformers import BertConfig, BertModel
+
+from text_embeddings_server.models.default_model import DefaultModel
+from text_embeddings_server.models.types import encode_request
+from text_embeddings_server.utils.executor import InferenceExecutor
+
+VOCAB_SIZE = 64
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    model_path = tmp_path_factory.mktemp("bert")
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=16,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=64,
+    )
+    BertModel(config).save_pretrained(model_path)
+    return DefaultModel(model_path, torch.device("cpu"), torch.float32, pool="mean")
+
+
+def make_request(lengths, seed, invalid=False):
+    generator = torch.Generator().manual_seed(seed)
+    total = sum(lengths)
+    input_ids = torch.randint(0, VOCAB_SIZE, (total,), generator=generator)
+    if invalid:
+        # Out of the embedding table: the forward pass fails
+        input_ids[0] = VOCAB_SIZE
+    tokens = torch.stack(
+        [
+            input_ids,
+            torch.zeros(total, dtype=torch.int64),
+            torch.cat([torch.arange(length) for length in lengths]),
+        ]
+    )
+    cu_seq_lengths = [0]
+    for length in lengths:
+        cu_seq_lengths.append(cu_seq_lengths[-1] + length)
+    return encode_request(tokens, cu_seq_lengths, max(lengths))
+
+
+async def embed_all(executor, requests):
+    """Responses of concurrent RPCs, merged by the executor, or their errors"""
+    executor.start()
+    return await asyncio.gather(
+        *[executor.embed(pb) for pb in requests], return_exceptions=True
+    )
+
+
+def run_executors(model, requests):
+    sequential = InferenceExecutor(model, pipeline=False)
+    pipelined = InferenceExecutor(model, pipeline=True)
+    return (
+        asyncio.run(embed_all(sequential, requests)),
+        asyncio.run(embed_all(pipelined, requests)),
+    )
+
+
+def embeddings(response):
+    return torch.tensor([embedding.values for embedding in response.embeddings])
+
+
+def test_pipeline_matches_sequential(model):
+    requests = [
+        make_request(lengths, seed)
+        for seed, lengths in enumerate([[3, 17], [8], [5, 5, 12], [1]])
+    ]
+
+    expected, responses = run_executors(model, requests)
+
+    for expected_response, response in zip(expected, responses):
+        torch.testing.assert_close(embeddings(response), embeddings(expected_response))
+
+
+def test_pipeline_propagates_errors(model):
+    requests = [
+        make_request([4, 9], 0),
+        make_request([6], 1, invalid=True),
+        make_request([11], 2),
+    ]
+
+    expected, responses = run_executors(model, requests)
+
+    # Only the failing RPC fails, in both executors
+    for results in [expected, responses]:
+        assert isinstance(results[1], Exception)
+        assert not isinstance(results[0], Exception)
+        assert not isinstance(results[2], Exception)
+    for i in [0, 2]:
+        torch.testing.assert_close(embeddings(responses[i]), embeddings(expected[i]))
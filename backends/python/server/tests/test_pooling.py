@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from text_embeddings_server.models.pooling import (
+    DefaultPooling,
+    SegmentPooling,
+    SpladePooling,
+)
+
+HIDDEN_SIZE = 16
+LENGTHS = [5, 1, 9, 3]
+
+
+def ragged_inputs():
+    """Packed hidden states of sequences of `LENGTHS`, and the same states padded"""
+    generator = torch.Generator().manual_seed(0)
+    packed = torch.randn(sum(LENGTHS), HIDDEN_SIZE, generator=generator)
+    cu_seqlens = torch.tensor([0] + LENGTHS).cumsum(0).to(torch.int32)
+
+    padded = torch.zeros(len(LENGTHS), max(LENGTHS), HIDDEN_SIZE)
+    attention_mask = torch.zeros(len(LENGTHS), max(LENGTHS))
+    for i, length in enumerate(LENGTHS):
+        padded[i, :length] = packed[cu_seqlens[i] : cu_seqlens[i + 1]]
+        attention_mask[i, :length] = 1
+    return packed, cu_seqlens, padded, attention_mask
+
+
+@pytest.mark.parametrize("pooling_mode", ["cls", "mean", "lasttoken"])
+def test_segment_pooling_matches_default_pooling(pooling_mode):
+    packed, cu_seqlens, padded, attention_mask = ragged_inputs()
+
+    expected = DefaultPooling(HIDDEN_SIZE, pooling_mode).forward(
+        (padded,), attention_mask
+    )
+    pooled = SegmentPooling(pooling_mode).forward(packed, cu_seqlens)
+
+    torch.testing.assert_close(pooled, expected)
+
+
+def test_segment_pooling_matches_splade_pooling():
+    packed, cu_seqlens, padded, attention_mask = ragged_inputs()
+
+    expected = SpladePooling().forward((padded,), attention_mask)
+    pooled = SegmentPooling("splade").forward(packed, cu_seqlens)
+
+    torch.testing.assert_close(pooled, expected)
+
+
+def test_segment_pooling_empty_rows():
+    packed, cu_seqlens, _, _ = ragged_inputs()
+    # Empty rows padding a bucketed batch
+    padded_cu_seqlens = torch.cat([cu_seqlens, cu_seqlens[-1:].repeat(2)])
+
+    for pooling_mode in SegmentPooling.MODES:
+        pooling = SegmentPooling(pooling_mode)
+        pooled = pooling.forward(packed, padded_cu_seqlens)
+        assert pooled.shape == (len(LENGTHS) + 2, HIDDEN_SIZE)
+        torch.testing.assert_close(
+            pooled[: len(LENGTHS)], pooling.forward(packed, cu_seqlens)
+        )
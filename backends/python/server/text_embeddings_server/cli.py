@@ -13,19 +13,15 @@ class Dtype(str, Enum):
     float32 = "float32"
     float16 = "float16"
     bloat16 = "bfloat16"
+    int8 = "int8"
 
 
-@app.command()
-def serve(
-    model_path: Path,
-    dtype: Dtype = "float32",
-    uds_path: Path = "/tmp/text-embeddings-server",
-    logger_level: str = "INFO",
-    json_output: bool = False,
-    otlp_endpoint: Optional[str] = None,
-    otlp_service_name: str = "text-embeddings-inference.server",
-    pool: str = "cls",
-):
+class Quantize(str, Enum):
+    int8 = "int8"
+    int4 = "int4"
+
+
+def setup_logger(logger_level: str, json_output: bool):
     # Remove default handler
     logger.remove()
     logger.add(
@@ -38,17 +34,88 @@ def serve(
         diagnose=False,
     )
 
+
+@app.command()
+def serve(
+    model_path: Path,
+    dtype: Dtype = "float32",
+    uds_path: Path = "/tmp/text-embeddings-server",
+    logger_level: str = "INFO",
+    json_output: bool = False,
+    otlp_endpoint: Optional[str] = None,
+    otlp_service_name: str = "text-embeddings-inference.server",
+    pool: str = "cls",
+    profile_startup: bool = typer.Option(
+        False,
+        envvar="PROFILE_STARTUP",
+        help="Log a breakdown of the startup time",
+    ),
+    compile: bool = typer.Option(
+        False,
+        "--compile",
+        envvar="TORCH_COMPILE",
+        help="Compile the model with torch.compile for static shape buckets",
+    ),
+    exported: bool = typer.Option(
+        False,
+        "--exported",
+        envvar="EXPORTED_MODEL",
+        help="Serve the AOTInductor packages written by `export`",
+    ),
+    quantize: Optional[Quantize] = typer.Option(
+        None,
+        "--quantize",
+        envvar="QUANTIZE",
+        help="Weight-only quantization of the FlashMistral and FlashQwen3 layers",
+    ),
+):
+    setup_logger(logger_level, json_output)
+
     # Import here after the logger is added to log potential import exceptions
-    from text_embeddings_server import server
-    from text_embeddings_server.utils.tracing import setup_tracing
+    from text_embeddings_server.utils.startup import startup_profile
+
+    with startup_profile.phase("import torch"):
+        import torch  # noqa: F401
+    with startup_profile.phase("import server"):
+        from text_embeddings_server import server
+        from text_embeddings_server.utils.tracing import setup_tracing
+        from text_embeddings_server.utils.metrics import setup_metrics
 
-    # Setup OpenTelemetry distributed tracing
+    # Setup OpenTelemetry distributed tracing and metrics
     if otlp_endpoint is not None:
         setup_tracing(otlp_endpoint=otlp_endpoint, otlp_service_name=otlp_service_name)
+        setup_metrics(otlp_endpoint=otlp_endpoint, otlp_service_name=otlp_service_name)
 
     # Downgrade enum into str for easier management later on
     dtype = None if dtype is None else dtype.value
-    server.serve(model_path, dtype, uds_path, pool)
+    quantize = None if quantize is None else quantize.value
+    server.serve(
+        model_path,
+        dtype,
+        uds_path,
+        pool,
+        profile_startup,
+        compile,
+        exported,
+        quantize,
+    )
+
+
+@app.command()
+def export(
+    model_path: Path,
+    dtype: Dtype = "float32",
+    logger_level: str = "INFO",
+    json_output: bool = False,
+    pool: str = "cls",
+):
+    """Export the model to AOTInductor packages next to its weights"""
+    setup_logger(logger_level, json_output)
+
+    # Import here after the logger is added to log potential import exceptions
+    from text_embeddings_server.utils.export import export_model
+
+    export_model(model_path, dtype.value, pool)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,29 @@
+import importlib
 import os
 import torch
 
+from functools import lru_cache
 from loguru import logger
 from pathlib import Path
 from typing import Optional
-from transformers import AutoConfig
-from transformers.models.bert import BertConfig
 
 from text_embeddings_server.models.model import Model
-from text_embeddings_server.models.masked_model import MaskedLanguageModel
-from text_embeddings_server.models.default_model import DefaultModel
-from text_embeddings_server.models.classification_model import ClassificationModel
-from text_embeddings_server.models.jinaBert_model import FlashJinaBert
-from text_embeddings_server.models.flash_mistral import FlashMistral
-from text_embeddings_server.models.flash_qwen3 import FlashQwen3
 from text_embeddings_server.utils.device import get_device, use_ipex
+from text_embeddings_server.utils.startup import startup_profile
 
 __all__ = ["Model"]
 
+# Model modules are only imported once `get_model` selects them
+MODEL_MODULES = {
+    "DefaultModel": "default_model",
+    "ClassificationModel": "classification_model",
+    "MaskedLanguageModel": "masked_model",
+    "FlashBert": "flash_bert",
+    "FlashJinaBert": "jinaBert_model",
+    "FlashMistral": "flash_mistral",
+    "FlashQwen3": "flash_qwen3",
+}
+
 TRUST_REMOTE_CODE = os.getenv("TRUST_REMOTE_CODE", "false").lower() in ["true", "1"]
 DISABLE_TENSOR_CACHE = os.getenv("DISABLE_TENSOR_CACHE", "false").lower() in [
     "true",
@@ -26,15 +32,38 @@ DISABLE_TENSOR_CACHE = os.getenv("DISABLE_TENSOR_CACHE", "false").lower() in [
 # Disable gradients
 torch.set_grad_enabled(False)
 
-FLASH_ATTENTION = True
-try:
-    from text_embeddings_server.models.flash_bert import FlashBert
-except ImportError as e:
-    logger.warning(f"Could not import Flash Attention enabled models: {e}")
-    FLASH_ATTENTION = False
 
-if FLASH_ATTENTION:
-    __all__.append(FlashBert)
+def load_model_class(name: str):
+    module = importlib.import_module(f"{__name__}.{MODEL_MODULES[name]}")
+    return getattr(module, name)
+
+
+@lru_cache(maxsize=None)
+def flash_attention_available() -> bool:
+    try:
+        load_model_class("FlashBert")
+    except ImportError as e:
+        logger.warning(f"Could not import Flash Attention enabled models: {e}")
+        return False
+    return True
+
+
+def has_weights(model_path: Path, name: str) -> bool:
+    """
+    Whether the safetensors checkpoint of `model_path` stores `name`. Flash models
+    read unprefixed names: checkpoints saved from a task model (`bert.*`,
+    `model.*`) go through transformers instead
+    """
+    from safetensors import safe_open
+    from text_embeddings_server.utils.weights import weight_files
+
+    for path in weight_files(model_path):
+        if not path.exists():
+            return False
+        with safe_open(path, framework="pt") as f:
+            if name in f.keys():
+                return True
+    return False
 
 
 def wrap_model_if_hpu(model_handle, device):
@@ -42,38 +71,85 @@ def wrap_model_if_hpu(model_handle, device):
     if device.type == "hpu":
         from habana_frameworks.torch.hpu import wrap_in_hpu_graph
 
+        model = model_handle.model
         model_handle.model = wrap_in_hpu_graph(
-            model_handle.model, disable_tensor_cache=DISABLE_TENSOR_CACHE
+            model, disable_tensor_cache=DISABLE_TENSOR_CACHE
         )
+        # MaskedLanguageModel runs its base model on its own, the MLM head being
+        # applied chunk by chunk by the pooling
+        encoder = getattr(model_handle, "encoder", None)
+        if encoder is model:
+            model_handle.encoder = model_handle.model
+        elif encoder is not None:
+            model_handle.encoder = wrap_in_hpu_graph(
+                encoder, disable_tensor_cache=DISABLE_TENSOR_CACHE
+            )
     return model_handle
 
 
-def create_model(model_class, model_path, device, datatype, pool="cls"):
+def create_model(model_name, model_path, device, datatype, pool="cls", quantize=None):
     """Create a model instance and wrap it if needed."""
-    model_handle = model_class(
-        model_path,
-        device,
-        datatype,
-        pool,
-        trust_remote=TRUST_REMOTE_CODE,
-    )
+    model_class = load_model_class(model_name)
+    # Only the decoder embedders take weight-only quantization
+    kwargs = {"quantize": quantize} if quantize is not None else {}
+    with startup_profile.phase("weights"):
+        model_handle = model_class(
+            model_path,
+            device,
+            datatype,
+            pool,
+            trust_remote=TRUST_REMOTE_CODE,
+            **kwargs,
+        )
     return wrap_model_if_hpu(model_handle, device)
 
 
-def get_model(model_path: Path, dtype: Optional[str], pool: str):
+def get_model(
+    model_path: Path, dtype: Optional[str], pool: str, quantize: Optional[str] = None
+):
     if dtype == "float32":
         datatype = torch.float32
     elif dtype == "float16":
         datatype = torch.float16
     elif dtype == "bfloat16":
         datatype = torch.bfloat16
+    elif dtype == "int8":
+        # int8 linear layers, everything else in float32
+        datatype = torch.float32
     else:
         raise RuntimeError(f"Unknown dtype {dtype}")
 
-    device = get_device()
+    with startup_profile.phase("device"):
+        device = get_device()
     logger.info(f"backend device: {device}")
 
-    config = AutoConfig.from_pretrained(model_path, trust_remote_code=TRUST_REMOTE_CODE)
+    with startup_profile.phase("config"):
+        from transformers import AutoConfig
+
+        config = AutoConfig.from_pretrained(
+            model_path, trust_remote_code=TRUST_REMOTE_CODE
+        )
+
+    # Weight-only quantization is implemented by the decoder embedders
+    if quantize is not None and (
+        dtype == "int8" or config.model_type not in ["mistral", "qwen3"]
+    ):
+        raise RuntimeError(
+            f"--quantize {quantize} only applies to FlashMistral and FlashQwen3"
+        )
+
+    if dtype == "int8":
+        # Dynamic quantization swaps the `nn.Linear` layers of transformers models
+        from text_embeddings_server.utils.quantize import quantize_int8
+
+        if config.architectures[0].endswith("Classification"):
+            model = create_model("ClassificationModel", model_path, device, datatype)
+        elif config.architectures[0].endswith("ForMaskedLM") and pool == "splade":
+            model = create_model("MaskedLanguageModel", model_path, device, datatype)
+        else:
+            model = create_model("DefaultModel", model_path, device, datatype, pool)
+        with startup_profile.phase("quantize"):
+            return quantize_int8(model, model_path)
 
     if (
         hasattr(config, "auto_map")
@@ -83,55 +159,75 @@ def get_model(model_path: Path, dtype: Optional[str], pool: str):
         == "jinaai/jina-bert-v2-qk-post-norm--modeling_bert.JinaBertModel"
     ):
         # Add specific offline modeling for model "jinaai/jina-embeddings-v2-base-code" which uses "autoMap" to reference code in other repository
-        return create_model(FlashJinaBert, model_path, device, datatype)
+        return create_model("FlashJinaBert", model_path, device, datatype, pool)
 
     if config.model_type == "bert":
-        config: BertConfig
-        if (
+        # FlashBert only embeds: classifiers go through ClassificationModel
+        if not config.architectures[0].endswith("Classification") and (
             use_ipex()
             or device.type in ["cuda", "hpu"]
             and config.position_embedding_type == "absolute"
             and datatype in [torch.float16, torch.bfloat16]
-            and FLASH_ATTENTION
+            and flash_attention_available()
+            # Unpadded execution through the PyTorch SDPA varlen backend
+            or device.type == "cpu"
+            and config.position_embedding_type == "absolute"
+            and flash_attention_available()
         ):
-            if pool != "cls":
-                if config.architectures[0].endswith("ForMaskedLM") and pool == "splade":
+            if pool == "splade":
+                if config.architectures[0].endswith("ForMaskedLM"):
                     return create_model(
-                        MaskedLanguageModel, model_path, device, datatype, pool
+                        "MaskedLanguageModel", model_path, device, datatype, pool
                     )
-                return create_model(DefaultModel, model_path, device, datatype, pool)
+                return create_model("DefaultModel", model_path, device, datatype, pool)
 
-            try:
-                return create_model(FlashBert, model_path, device, datatype)
-            except FileNotFoundError:
-                logger.info(
-                    "Do not have safetensors file for this model, use default transformers model path instead"
-                )
-                return create_model(DefaultModel, model_path, device, datatype, pool)
+            if has_weights(model_path, "embeddings.word_embeddings.weight"):
+                return create_model("FlashBert", model_path, device, datatype, pool)
+            logger.info(
+                "Do not have safetensors file with FlashBert weight names for this model, use default transformers model path instead"
+            )
+            return create_model("DefaultModel", model_path, device, datatype, pool)
 
         if config.architectures[0].endswith("Classification"):
-            return create_model(ClassificationModel, model_path, device, datatype)
+            return create_model("ClassificationModel", model_path, device, datatype)
         elif config.architectures[0].endswith("ForMaskedLM") and pool == "splade":
-            return create_model(MaskedLanguageModel, model_path, device, datatype)
+            return create_model("MaskedLanguageModel", model_path, device, datatype)
         else:
-            return create_model(DefaultModel, model_path, device, datatype, pool)
+            return create_model("DefaultModel", model_path, device, datatype, pool)
+
+    # Decoders run unpadded on CPU through the PyTorch SDPA varlen backend. IPEX
+    # varlen attention is not causal. The flash decoders only embed, from the
+    # unprefixed weights of the base model: classifiers and checkpoints of task
+    # models (`model.*`) go through transformers
+    flash_decoder = (
+        (
+            device.type == "hpu"
+            or device.type == "cpu"
+            and not use_ipex()
+            and flash_attention_available()
+        )
+        and not config.architectures[0].endswith("Classification")
+        and has_weights(model_path, "embed_tokens.weight")
+    )
 
-    if config.model_type == "mistral" and device.type == "hpu":
-        try:
-            return create_model(FlashMistral, model_path, device, datatype, pool)
-        except FileNotFoundError:
-            return create_model(DefaultModel, model_path, device, datatype, pool)
+    if config.model_type == "mistral" and flash_decoder:
+        return create_model(
+            "FlashMistral", model_path, device, datatype, pool, quantize
+        )
+
+    if config.model_type == "qwen3" and flash_decoder:
+        return create_model("FlashQwen3", model_path, device, datatype, pool, quantize)
 
-    if config.model_type == "qwen3" and device.type == "hpu":
-        try:
-            return create_model(FlashQwen3, model_path, device, datatype, pool)
-        except FileNotFoundError:
-            return create_model(DefaultModel, model_path, device, datatype, pool)
+    if quantize is not None:
+        raise RuntimeError(
+            f"--quantize {quantize} needs FlashMistral or FlashQwen3, which do not "
+            f"run this checkpoint on {device.type}"
+        )
 
     # Default case
     if config.architectures[0].endswith("Classification"):
-        return create_model(ClassificationModel, model_path, device, datatype)
+        return create_model("ClassificationModel", model_path, device, datatype)
     elif config.architectures[0].endswith("ForMaskedLM") and pool == "splade":
-        return create_model(MaskedLanguageModel, model_path, device, datatype)
+        return create_model("MaskedLanguageModel", model_path, device, datatype)
     else:
-        return create_model(DefaultModel, model_path, device, datatype, pool)
+        return create_model("DefaultModel", model_path, device, datatype, pool)
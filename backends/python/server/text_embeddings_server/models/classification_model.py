@@ -2,12 +2,12 @@ import inspect
 import torch
 
 from pathlib import Path
-from typing import Type, List
+from typing import Type
 from transformers import AutoModelForSequenceClassification
 from opentelemetry import trace
 
 from text_embeddings_server.models import Model
-from text_embeddings_server.models.types import PaddedBatch, Embedding, Score
+from text_embeddings_server.models.types import PaddedBatch
 
 tracer = trace.get_tracer(__name__)
 
@@ -31,6 +31,7 @@ class ClassificationModel(Model):
         model_type = model.config.model_type
         if model_type in ["xlm-roberta", "camembert", "roberta"]:
             position_offset = model.config.pad_token_id + 1
+        self.position_offset = position_offset
         if hasattr(model.config, "max_seq_length"):
             self.max_input_length = model.config.max_seq_length
         else:
@@ -56,11 +57,11 @@ class ClassificationModel(Model):
         return PaddedBatch
 
     @tracer.start_as_current_span("embed")
-    def embed(self, batch: PaddedBatch) -> List[Embedding]:
+    def embed(self, batch: PaddedBatch) -> torch.Tensor:
         pass
 
     @tracer.start_as_current_span("predict")
-    def predict(self, batch: PaddedBatch) -> List[Score]:
+    def predict(self, batch: PaddedBatch) -> torch.Tensor:
         kwargs = {"input_ids": batch.input_ids, "attention_mask": batch.attention_mask}
         if self.has_token_type_ids:
             kwargs["token_type_ids"] = batch.token_type_ids
@@ -68,5 +69,4 @@ class ClassificationModel(Model):
             kwargs["position_ids"] = batch.position_ids
 
         output = self.model(**kwargs, return_dict=True)
-        all_scores = output.logits.tolist()
-        return [Score(values=scores) for scores in all_scores]
+        return output.logits
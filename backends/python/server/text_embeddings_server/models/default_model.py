@@ -2,13 +2,17 @@ import inspect
 import torch
 
 from pathlib import Path
-from typing import Type, List
+from typing import Type
 from transformers import AutoModel
 from opentelemetry import trace
 from text_embeddings_server.models.pooling import DefaultPooling
 
 from text_embeddings_server.models import Model
-from text_embeddings_server.models.types import PaddedBatch, Embedding, Score
+from text_embeddings_server.models.types import PaddedBatch
+from text_embeddings_server.utils.prepared_weights import (
+    PREPARED_WEIGHTS_CACHE,
+    PreparedWeights,
+)
 
 tracer = trace.get_tracer(__name__)
 
@@ -22,11 +26,29 @@ class DefaultModel(Model):
         pool: str = "cls",
         trust_remote: bool = False,
     ):
-        model = (
-            AutoModel.from_pretrained(model_path, trust_remote_code=trust_remote)
-            .to(dtype)
-            .to(device)
+        # The converted state dict does not depend on the device: keep it in host
+        # memory and let `.to(device)` move it
+        prepared = (
+            PreparedWeights(model_path, torch.device("cpu"), dtype, "DefaultModel")
+            if PREPARED_WEIGHTS_CACHE
+            else None
         )
+        if prepared is not None and prepared.hit:
+            model = AutoModel.from_pretrained(
+                model_path,
+                state_dict=prepared.state_dict(),
+                torch_dtype=dtype,
+                trust_remote_code=trust_remote,
+            ).to(device)
+        else:
+            model = (
+                AutoModel.from_pretrained(model_path, trust_remote_code=trust_remote)
+                .to(dtype)
+                .to(device)
+            )
+            if prepared is not None:
+                prepared.record(model.state_dict())
+                prepared.save()
         self.hidden_size = model.config.hidden_size
         self.pooling = DefaultPooling(self.hidden_size, pooling_mode=pool)
 
@@ -34,6 +56,7 @@ class DefaultModel(Model):
         model_type = model.config.model_type
         if model_type in ["xlm-roberta", "camembert", "roberta"]:
             position_offset = model.config.pad_token_id + 1
+        self.position_offset = position_offset
         if hasattr(model.config, "max_seq_length"):
             self.max_input_length = model.config.max_seq_length
         else:
@@ -57,7 +80,7 @@ class DefaultModel(Model):
         return PaddedBatch
 
     @tracer.start_as_current_span("embed")
-    def embed(self, batch: PaddedBatch) -> List[Embedding]:
+    def embed(self, batch: PaddedBatch) -> torch.Tensor:
         kwargs = {"input_ids": batch.input_ids, "attention_mask": batch.attention_mask}
         if self.has_token_type_ids:
             kwargs["token_type_ids"] = batch.token_type_ids
@@ -65,17 +88,8 @@ class DefaultModel(Model):
             kwargs["position_ids"] = batch.position_ids
         output = self.model(**kwargs)
 
-        embedding = self.pooling.forward(output, batch.attention_mask)
-
-        cpu_results = embedding.view(-1).tolist()
-
-        return [
-            Embedding(
-                values=cpu_results[i * self.hidden_size : (i + 1) * self.hidden_size]
-            )
-            for i in range(len(batch))
-        ]
+        return self.pooling.forward(output, batch.attention_mask)
 
     @tracer.start_as_current_span("predict")
-    def predict(self, batch: PaddedBatch) -> List[Score]:
+    def predict(self, batch: PaddedBatch) -> torch.Tensor:
         pass
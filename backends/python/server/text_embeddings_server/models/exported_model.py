@@ -0,0 +1,79 @@
+import torch
+
+from loguru import logger
+from opentelemetry import trace
+from pathlib import Path
+from typing import Type
+
+from text_embeddings_server.models import Model
+from text_embeddings_server.models.types import PaddedBatch
+from text_embeddings_server.utils.buckets import BucketSet
+from text_embeddings_server.utils.device import get_device
+from text_embeddings_server.utils.export import (
+    INPUTS,
+    check_parity,
+    load_manifest,
+    load_probe,
+    package_dir,
+)
+from text_embeddings_server.utils.startup import startup_profile
+
+tracer = trace.get_tracer(__name__)
+
+
+class ExportedModel(Model):
+    """
+    AOTInductor packages written by `text-embeddings-server export`, one per static
+    shape. Serving them skips building the model and compiling it at startup
+    """
+
+    def __init__(self, model_path: Path, dtype: str, pool: str):
+        with startup_profile.phase("device"):
+            device = get_device()
+        output_dir = package_dir(model_path, dtype, pool, device)
+        manifest = load_manifest(output_dir, device)
+
+        with startup_profile.phase("load packages"):
+            runners = {
+                method: {
+                    tuple(package["shape"]): torch._inductor.aoti_load_package(
+                        str(output_dir / package["file"])
+                    )
+                    for package in packages
+                }
+                for method, packages in manifest["methods"].items()
+            }
+        self.max_input_length = manifest["max_input_length"]
+        self.buckets = BucketSet(manifest["seq_lens"], manifest["batch_sizes"])
+        super(ExportedModel, self).__init__(
+            model=runners, dtype=getattr(torch, dtype), device=device
+        )
+        logger.info(f"Loaded {manifest['model']} packages from {output_dir}")
+
+        with startup_profile.phase("parity"):
+            probe, expected = load_probe(output_dir, manifest, device)
+            for method, output in expected.items():
+                check_parity(output, self.run(method, probe), f"Exported {method}")
+
+    @property
+    def batch_type(self) -> Type[PaddedBatch]:
+        return PaddedBatch
+
+    def run(self, method: str, batch: PaddedBatch) -> torch.Tensor:
+        runners = self.model.get(method)
+        if runners is None:
+            return None
+        runner = runners.get(tuple(batch.input_ids.shape))
+        if runner is None:
+            raise RuntimeError(
+                f"no exported {method} for shape {tuple(batch.input_ids.shape)}"
+            )
+        return runner(*(getattr(batch, name) for name in INPUTS))
+
+    @tracer.start_as_current_span("embed")
+    def embed(self, batch: PaddedBatch) -> torch.Tensor:
+        return self.run("embed", batch)
+
+    @tracer.start_as_current_span("predict")
+    def predict(self, batch: PaddedBatch) -> torch.Tensor:
+        return self.run("predict", batch)
@@ -1,16 +1,31 @@
+import importlib.util
 import torch
 from pathlib import Path
 from torch import nn
 import torch.nn.functional as F
-from typing import Type, List, Union
-from safetensors import safe_open
+from typing import Union
 from transformers.activations import ACT2FN
 from transformers.models.bert import BertConfig
 from opentelemetry import trace
 from text_embeddings_server.models import Model
-from text_embeddings_server.models.types import FlashBatch, Embedding, PaddedBatch
-from text_embeddings_server.utils.flash_attn import attention
+from text_embeddings_server.models.pooling import SegmentPooling
+from text_embeddings_server.models.types import (
+    PACKED_BATCHES,
+    FlashBatch,
+    PackedBatch,
+    PaddedBatch,
+)
+from text_embeddings_server.utils.attention_mask import (
+    KeyPaddingMasks,
+    packed_attention_mask,
+    padded_cu_seqlens,
+)
+from text_embeddings_server.utils.flash_attn import (
+    attention,
+    supports_packed_batches,
+)
 from text_embeddings_server.utils.device import use_ipex
+from text_embeddings_server.utils.prepared_weights import load_weights
 
 tracer = trace.get_tracer(__name__)
 
@@ -35,17 +50,21 @@ def hpu_add_layer_norm(
 
 class FastLayerNorm:
     def __init__(self, prefix, handle, device, dtype, config: BertConfig):
-        self.weight = handle.get_tensor(f"{prefix}.weight").to(dtype).to(device)
-        self.bias = handle.get_tensor(f"{prefix}.bias").to(dtype).to(device)
+        self.weight = handle.get_tensor(f"{prefix}.weight")
+        self.bias = handle.get_tensor(f"{prefix}.bias")
         self.variance_epsilon = config.layer_norm_eps
         self.device = device
         self.use_ipex = use_ipex()
+        self.use_fused_cuda = (
+            device.type == "cuda"
+            and importlib.util.find_spec("dropout_layer_norm") is not None
+        )
 
     def forward(self, hidden_states, residual=None):
         # Flash attention imports
         normed_hidden_states = None
         res = None
-        if self.device.type == "cuda":
+        if self.use_fused_cuda:
             import dropout_layer_norm
 
             normed_hidden_states, res, *rest = dropout_layer_norm.dropout_add_ln_fwd(
@@ -80,7 +99,8 @@ class FastLayerNorm:
             )
 
             res = residual if residual is not None else hidden_states
-        elif self.device.type == "hpu":
+        else:
+            # HPU, and any device without a fused kernel
             normed_hidden_states = hpu_add_layer_norm(
                 residual,
                 hidden_states,
@@ -95,20 +115,16 @@ class FastLayerNorm:
 
 class BertEmbeddings:
     def __init__(self, prefix, handle, device, dtype, config: BertConfig):
-        self.word_embeddings_weight = (
-            handle.get_tensor(f"{prefix}.word_embeddings.weight").to(dtype).to(device)
+        self.word_embeddings_weight = handle.get_tensor(
+            f"{prefix}.word_embeddings.weight"
         )
-        self.token_type_embeddings_weight = (
-            handle.get_tensor(f"{prefix}.token_type_embeddings.weight")
-            .to(dtype)
-            .to(device)
+        self.token_type_embeddings_weight = handle.get_tensor(
+            f"{prefix}.token_type_embeddings.weight"
         )
 
         if config.position_embedding_type == "absolute":
-            self.position_embeddings_weight = (
-                handle.get_tensor(f"{prefix}.position_embeddings.weight")
-                .to(dtype)
-                .to(device)
+            self.position_embeddings_weight = handle.get_tensor(
+                f"{prefix}.position_embeddings.weight"
             )
         else:
             raise NotImplementedError(
@@ -136,26 +152,21 @@ class BertEmbeddings:
 
 class BertAttention:
     def __init__(self, prefix, handle, device, dtype, config: BertConfig):
-        query_weight = handle.get_tensor(f"{prefix}.self.query.weight")
-        query_bias = handle.get_tensor(f"{prefix}.self.query.bias")
-        key_weight = handle.get_tensor(f"{prefix}.self.key.weight")
-        key_bias = handle.get_tensor(f"{prefix}.self.key.bias")
-        value_weight = handle.get_tensor(f"{prefix}.self.value.weight")
-        value_bias = handle.get_tensor(f"{prefix}.self.value.bias")
-
-        self.qkv_weight = (
-            torch.cat([query_weight, key_weight, value_weight]).T.to(dtype).to(device)
-        )
-        self.qkv_bias = (
-            torch.cat([query_bias, key_bias, value_bias]).to(dtype).to(device)
-        )
+        def fused(suffix):
+            return torch.cat(
+                [
+                    handle.get_tensor(f"{prefix}.self.{name}.{suffix}")
+                    for name in ["query", "key", "value"]
+                ]
+            )
 
-        self.dense_weight = (
-            handle.get_tensor(f"{prefix}.output.dense.weight").T.to(dtype).to(device)
-        )
-        self.dense_bias = (
-            handle.get_tensor(f"{prefix}.output.dense.bias").to(dtype).to(device)
-        )
+        self.qkv_weight = handle.prepare(
+            f"{prefix}.self.qkv.weight", lambda: fused("weight")
+        ).T
+        self.qkv_bias = handle.prepare(f"{prefix}.self.qkv.bias", lambda: fused("bias"))
+
+        self.dense_weight = handle.get_tensor(f"{prefix}.output.dense.weight").T
+        self.dense_bias = handle.get_tensor(f"{prefix}.output.dense.bias")
 
         self.layer_norm = FastLayerNorm(
             f"{prefix}.output.LayerNorm", handle, device, dtype, config
@@ -212,14 +223,10 @@ class BertLayer:
             f"{prefix}.attention", handle, device, dtype, config
         )
 
-        self.intermediate_weight = (
-            handle.get_tensor(f"{prefix}.intermediate.dense.weight")
-            .T.to(dtype)
-            .to(device)
-        )
-        self.intermediate_bias = (
-            handle.get_tensor(f"{prefix}.intermediate.dense.bias").to(dtype).to(device)
-        )
+        self.intermediate_weight = handle.get_tensor(
+            f"{prefix}.intermediate.dense.weight"
+        ).T
+        self.intermediate_bias = handle.get_tensor(f"{prefix}.intermediate.dense.bias")
 
         act = config.hidden_act
         self.intermediate_act_fn = (
@@ -227,18 +234,14 @@ class BertLayer:
             if "gelu" not in act
             else lambda x: torch.nn.functional.gelu(
                 x,
-                approximate="tanh"
-                if act in ["gelu_fast", "gelu_pytorch_tanh"]
-                else "none",
+                approximate=(
+                    "tanh" if act in ["gelu_fast", "gelu_pytorch_tanh"] else "none"
+                ),
             )
         )
 
-        self.output_weight = (
-            handle.get_tensor(f"{prefix}.output.dense.weight").T.to(dtype).to(device)
-        )
-        self.output_bias = (
-            handle.get_tensor(f"{prefix}.output.dense.bias").to(dtype).to(device)
-        )
+        self.output_weight = handle.get_tensor(f"{prefix}.output.dense.weight").T
+        self.output_bias = handle.get_tensor(f"{prefix}.output.dense.bias")
         self.layer_norm = FastLayerNorm(
             f"{prefix}.output.LayerNorm", handle, device, dtype, config
         )
@@ -287,10 +290,10 @@ class FlashBertModel:
     ):
         embeddings = self.embeddings.forward(input_ids, token_type_ids, position_ids)
         encoder_outputs = self.encoder.forward(embeddings, cu_seqlens, max_s, attn_mask)
+        # Packed [total_tokens, hidden] outputs
         if mask is not None:
-            outputs = encoder_outputs[mask]
-            return outputs[cu_seqlens[:-1]]
-        return encoder_outputs[cu_seqlens[:-1]]
+            return encoder_outputs[mask]
+        return encoder_outputs
 
 
 class FlashBert(Model):
@@ -309,45 +312,43 @@ class FlashBert(Model):
         else:
             self.max_input_length = config.max_position_embeddings
 
-        with safe_open(model_path / "model.safetensors", framework="pt") as f:
-            model = FlashBertModel(f, device, dtype, config)
+        with load_weights(model_path, device, dtype, "FlashBert") as weights:
+            model = FlashBertModel(weights, device, dtype, config)
         self.device = device
         self.dtype = dtype
         self.hidden_size = config.hidden_size
+        self.pooling = SegmentPooling(pool)
+        self.key_padding_masks = KeyPaddingMasks()
 
         super(FlashBert, self).__init__(model=model, dtype=dtype, device=device)
 
     @property
-    def batch_type(self) -> Union[FlashBatch, PaddedBatch]:
+    def batch_type(self) -> Union[FlashBatch, PaddedBatch, PackedBatch]:
+        if (PACKED_BATCHES or self.static_shapes) and supports_packed_batches():
+            return PackedBatch
         # for hpu devices, we use PaddedBatch as we do not have real varlen fwd yet
         return FlashBatch if self.device.type != "hpu" else PaddedBatch
 
     @tracer.start_as_current_span("embed")
-    def embed(self, batch: Union[FlashBatch, PaddedBatch]) -> List[Embedding]:
+    def embed(self, batch: Union[FlashBatch, PaddedBatch, PackedBatch]) -> torch.Tensor:
         if isinstance(batch, PaddedBatch):
-            input_lens = batch.attention_mask.cumsum(-1)[:, -1].to(torch.int32)
             max_input_lens = 0  # This value will not be used
-            cu_seqlens = torch.cat(
-                (input_lens.new_tensor([0]), input_lens.cumsum(-1).int())
-            )
+            cu_seqlens = padded_cu_seqlens(batch.attention_mask)
             mask = batch.attention_mask.bool()
-            bsz, tgt_len = mask.size()
-            min_val = torch.finfo(self.dtype).min
-            attn_mask = torch.full(
-                [bsz, 1, tgt_len, tgt_len],
-                fill_value=min_val,
-                device=self.device,
-                dtype=self.dtype,
-            )
-            expanded_mask = mask[:, None, None, :].expand(bsz, 1, tgt_len, tgt_len)
-            attn_mask = attn_mask.masked_fill(expanded_mask, 0.0)
+            attn_mask = self.key_padding_masks(batch.attention_mask, self.dtype)
         elif isinstance(batch, FlashBatch):
             cu_seqlens = batch.cu_seqlens
             mask = None
             attn_mask = None
             max_input_lens = batch.max_s
+        elif isinstance(batch, PackedBatch):
+            max_input_lens = 0
+            cu_seqlens = batch.cu_seqlens
+            # Pooled over the flattened rows: segments skip the padding
+            mask = None
+            attn_mask = packed_attention_mask(batch.segment_ids, self.dtype)
 
-        embedding = self.model.forward(
+        hidden_states = self.model.forward(
             input_ids=batch.input_ids,
             token_type_ids=batch.token_type_ids,
             position_ids=batch.position_ids,
@@ -356,11 +357,10 @@ class FlashBert(Model):
             mask=mask,
             attn_mask=attn_mask,
         )
-        cpu_results = embedding.view(-1).tolist()
-
-        return [
-            Embedding(
-                values=cpu_results[i * self.hidden_size : (i + 1) * self.hidden_size]
-            )
-            for i in range(len(batch))
-        ]
+        if isinstance(batch, PackedBatch):
+            hidden_states = hidden_states.flatten(0, 1)
+        embeddings = self.pooling.forward(hidden_states, cu_seqlens)
+        if isinstance(batch, PackedBatch):
+            # Back to the order of the request
+            return embeddings[batch.order]
+        return embeddings
@@ -1,20 +1,56 @@
+import os
 import torch
 import math
 from torch import nn
 import torch.nn.functional as F
 from pathlib import Path
-from typing import Type, List, Optional, Union, Tuple
+from typing import Callable, Type, List, Optional, Union, Tuple
 from transformers import AutoConfig, PretrainedConfig
 from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
 from opentelemetry import trace
-from safetensors import safe_open
-from text_embeddings_server.models.pooling import DefaultPooling
+from text_embeddings_server.models.pooling import SegmentPooling, segment_ids
 
 from text_embeddings_server.models import Model
-from text_embeddings_server.models.types import PaddedBatch, Embedding, Score
+from text_embeddings_server.models.types import FlashBatch
+from text_embeddings_server.utils.attention_mask import BLOCK_DIAGONAL_MAX_TOKENS
+from text_embeddings_server.utils.prepared_weights import load_weights
 
 tracer = trace.get_tracer(__name__)
 
+# Longest sequence covered by the relative position table built at load time, longer
+# batches compute their distances on the fly
+ALIBI_TABLE_MAX_LENGTH = int(os.getenv("ALIBI_TABLE_MAX_LENGTH", 2048))
+# Queries attending in one call for longer sequences: bounds the ALiBi bias to
+# [heads, ALIBI_QUERY_CHUNK_SIZE, L] instead of [heads, L, L]
+ALIBI_QUERY_CHUNK_SIZE = int(os.getenv("ALIBI_QUERY_CHUNK_SIZE", 512))
+
+# Additive [1, heads, q_end - q_start, length] bias of the queries
+# [q_start, q_end) of a sequence of `length` tokens
+AlibiBias = Callable[[int, int, int], torch.Tensor]
+
+
+def alibi_head_slopes(n_heads: int) -> List[float]:
+    # Following https://github.com/ofirpress/attention_with_linear_biases/issues/5 (Implementation 1)
+    def get_slopes_power_of_2(n):
+        start = 2 ** (-(2 ** -(math.log2(n) - 3)))
+        ratio = start
+        return [start * ratio**i for i in range(n)]
+
+    if math.log2(n_heads).is_integer():
+        return get_slopes_power_of_2(
+            n_heads
+        )  # In the paper, we only train models that have 2^a heads for some a. This function has
+    else:  # some good properties that only occur when the input is a power of 2. To maintain that even
+        closest_power_of_2 = 2 ** math.floor(
+            math.log2(n_heads)
+        )  # when the number of heads is not a power of 2, we use this workaround.
+        return (
+            get_slopes_power_of_2(closest_power_of_2)
+            + alibi_head_slopes(2 * closest_power_of_2)[0::2][
+                : n_heads - closest_power_of_2
+            ]
+        )
+
 
 class JinaBertConfig(PretrainedConfig):
     def __init__(
@@ -64,20 +100,14 @@ class JinaBertEmbeddings:
     """Construct the embeddings from word, position and token_type embeddings."""
 
     def __init__(self, handle, device, dtype, config: JinaBertConfig):
-        self.word_embeddings_weight = (
-            handle.get_tensor(f"embeddings.word_embeddings.weight").to(dtype).to(device)
-        )
-        self.token_type_embeddings_weight = (
-            handle.get_tensor(f"embeddings.token_type_embeddings.weight")
-            .to(dtype)
-            .to(device)
+        self.word_embeddings_weight = handle.get_tensor(
+            "embeddings.word_embeddings.weight"
         )
-        self.layernorm_weight = (
-            handle.get_tensor(f"embeddings.LayerNorm.weight").to(dtype).to(device)
-        )
-        self.layernorm_bias = (
-            handle.get_tensor(f"embeddings.LayerNorm.bias").to(dtype).to(device)
+        self.token_type_embeddings_weight = handle.get_tensor(
+            "embeddings.token_type_embeddings.weight"
         )
+        self.layernorm_weight = handle.get_tensor("embeddings.LayerNorm.weight")
+        self.layernorm_bias = handle.get_tensor("embeddings.LayerNorm.bias")
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         # position_ids (1, len position emb) is contiguous in memory and exported when serialized
         self.position_embedding_type = getattr(
@@ -126,28 +156,16 @@ class JinaBertSelfAttention:
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.query_weight = (
-            handle.get_tensor(f"{prefix}.query.weight").to(dtype).to(device)
-        )
-        self.query_bias = handle.get_tensor(f"{prefix}.query.bias").to(dtype).to(device)
-        self.key_weight = handle.get_tensor(f"{prefix}.key.weight").to(dtype).to(device)
-        self.key_bias = handle.get_tensor(f"{prefix}.key.bias").to(dtype).to(device)
-        self.value_weight = (
-            handle.get_tensor(f"{prefix}.value.weight").to(dtype).to(device)
-        )
-        self.value_bias = handle.get_tensor(f"{prefix}.value.bias").to(dtype).to(device)
-        self.layer_norm_q_weight = (
-            handle.get_tensor(f"{prefix}.layer_norm_q.weight").to(dtype).to(device)
-        )
-        self.layer_norm_q_bias = (
-            handle.get_tensor(f"{prefix}.layer_norm_q.bias").to(dtype).to(device)
-        )
-        self.layer_norm_k_weight = (
-            handle.get_tensor(f"{prefix}.layer_norm_k.weight").to(dtype).to(device)
-        )
-        self.layer_norm_k_bias = (
-            handle.get_tensor(f"{prefix}.layer_norm_k.bias").to(dtype).to(device)
-        )
+        self.query_weight = handle.get_tensor(f"{prefix}.query.weight")
+        self.query_bias = handle.get_tensor(f"{prefix}.query.bias")
+        self.key_weight = handle.get_tensor(f"{prefix}.key.weight")
+        self.key_bias = handle.get_tensor(f"{prefix}.key.bias")
+        self.value_weight = handle.get_tensor(f"{prefix}.value.weight")
+        self.value_bias = handle.get_tensor(f"{prefix}.value.bias")
+        self.layer_norm_q_weight = handle.get_tensor(f"{prefix}.layer_norm_q.weight")
+        self.layer_norm_q_bias = handle.get_tensor(f"{prefix}.layer_norm_q.bias")
+        self.layer_norm_k_weight = handle.get_tensor(f"{prefix}.layer_norm_k.weight")
+        self.layer_norm_k_bias = handle.get_tensor(f"{prefix}.layer_norm_k.bias")
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
@@ -157,13 +175,13 @@ class JinaBertSelfAttention:
             self.attention_head_size,
         )
         x = x.view(new_x_shape)
-        return x.permute(0, 2, 1, 3)
+        return x.transpose(0, 1)
 
     def forward(
         self,
         hidden_states: torch.Tensor,
-        attention_mask: Optional[torch.FloatTensor] = None,
-        bias: Optional[torch.FloatTensor] = None,
+        segments: List[Tuple[int, int]],
+        bias: AlibiBias,
     ) -> Tuple[torch.Tensor]:
         q_hidden_states = F.linear(hidden_states, self.query_weight, self.query_bias)
         mixed_query_layer = F.layer_norm(
@@ -189,24 +207,23 @@ class JinaBertSelfAttention:
         value_layer = self.transpose_for_scores(v_hidden_states)
         query_layer = self.transpose_for_scores(mixed_query_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-            attention_scores = attention_scores + attention_mask
-
-        # Normalize the attention scores to probabilities.
-        attention_probs = F.softmax(attention_scores + bias, dim=-1)
-
-        attention_probs = self.dropout(attention_probs)
-
-        context_layer = torch.matmul(attention_probs, value_layer)
+        # Packed [heads, total_tokens, head_size] layout, long sequences attend one
+        # chunk of queries at a time
+        context_layer = torch.empty_like(query_layer)
+        for start, end in segments:
+            length = end - start
+            for q_start in range(0, length, ALIBI_QUERY_CHUNK_SIZE):
+                q_end = min(q_start + ALIBI_QUERY_CHUNK_SIZE, length)
+                context_layer[:, start + q_start : start + q_end] = (
+                    F.scaled_dot_product_attention(
+                        query_layer[None, :, start + q_start : start + q_end],
+                        key_layer[None, :, start:end],
+                        value_layer[None, :, start:end],
+                        attn_mask=bias(length, q_start, q_end),
+                    )[0]
+                )
 
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(new_context_layer_shape)
+        context_layer = context_layer.transpose(0, 1).reshape(-1, self.all_head_size)
 
         outputs = (context_layer,)
 
@@ -216,16 +233,10 @@ class JinaBertSelfAttention:
 class JinaBertSelfOutput:
     def __init__(self, prefix, handle, device, dtype, config):
         self.config = config
-        self.dense_weight = (
-            handle.get_tensor(f"{prefix}.dense.weight").to(dtype).to(device)
-        )
-        self.dense_bias = handle.get_tensor(f"{prefix}.dense.bias").to(dtype).to(device)
-        self.layerNorm_weight = (
-            handle.get_tensor(f"{prefix}.LayerNorm.weight").to(dtype).to(device)
-        )
-        self.layerNorm_bias = (
-            handle.get_tensor(f"{prefix}.LayerNorm.bias").to(dtype).to(device)
-        )
+        self.dense_weight = handle.get_tensor(f"{prefix}.dense.weight")
+        self.dense_bias = handle.get_tensor(f"{prefix}.dense.bias")
+        self.layerNorm_weight = handle.get_tensor(f"{prefix}.LayerNorm.weight")
+        self.layerNorm_bias = handle.get_tensor(f"{prefix}.LayerNorm.bias")
 
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
@@ -256,12 +267,12 @@ class JinaBertAttention:
     def forward(
         self,
         hidden_states: torch.Tensor,
-        attention_mask: Optional[torch.FloatTensor] = None,
-        bias: Optional[torch.FloatTensor] = None,
+        segments: List[Tuple[int, int]],
+        bias: AlibiBias,
     ) -> Tuple[torch.Tensor]:
         self_outputs = self.self.forward(
             hidden_states,
-            attention_mask,
+            segments,
             bias,
         )
         attention_output = self.output.forward(self_outputs[0], hidden_states)
@@ -282,22 +293,18 @@ class JinaBertGLUMLP:
             raise ValueError(
                 f"feed_forward_type {config.feed_forward_type} not supported"
             )
-        self.up_gated_layer_weight = (
-            handle.get_tensor(f"{prefix}.up_gated_layer.weight").to(dtype).to(device)
-        )
-        self.down_layer_weight = (
-            handle.get_tensor(f"{prefix}.down_layer.weight").to(dtype).to(device)
-        )
-        self.down_layer_bias = (
-            handle.get_tensor(f"{prefix}.down_layer.bias").to(dtype).to(device)
+        self.up_gated_layer_weight = handle.get_tensor(
+            f"{prefix}.up_gated_layer.weight"
         )
+        self.down_layer_weight = handle.get_tensor(f"{prefix}.down_layer.weight")
+        self.down_layer_bias = handle.get_tensor(f"{prefix}.down_layer.bias")
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
         # Up with gate
         hidden_mlp_states = F.linear(hidden_states, self.up_gated_layer_weight, None)
-        up = hidden_mlp_states[:, :, : self.config.intermediate_size]
-        gated = hidden_mlp_states[:, :, self.config.intermediate_size :]
+        up = hidden_mlp_states[..., : self.config.intermediate_size]
+        gated = hidden_mlp_states[..., self.config.intermediate_size :]
         hidden_mlp_states = up * self.act(gated)
         hidden_mlp_states = self.dropout(hidden_mlp_states)
         # Down
@@ -311,18 +318,10 @@ class JinaBertLayer:
         )
         self.config = config
         self.feed_forward_type = config.feed_forward_type
-        self.layer_norm_1_weight = (
-            handle.get_tensor(f"{prefix}.layer_norm_1.weight").to(dtype).to(device)
-        )
-        self.layer_norm_1_bias = (
-            handle.get_tensor(f"{prefix}.layer_norm_1.bias").to(dtype).to(device)
-        )
-        self.layer_norm_2_weight = (
-            handle.get_tensor(f"{prefix}.layer_norm_2.weight").to(dtype).to(device)
-        )
-        self.layer_norm_2_bias = (
-            handle.get_tensor(f"{prefix}.layer_norm_2.bias").to(dtype).to(device)
-        )
+        self.layer_norm_1_weight = handle.get_tensor(f"{prefix}.layer_norm_1.weight")
+        self.layer_norm_1_bias = handle.get_tensor(f"{prefix}.layer_norm_1.bias")
+        self.layer_norm_2_weight = handle.get_tensor(f"{prefix}.layer_norm_2.weight")
+        self.layer_norm_2_bias = handle.get_tensor(f"{prefix}.layer_norm_2.bias")
         if self.feed_forward_type.endswith("glu"):
             self.mlp = JinaBertGLUMLP(f"{prefix}.mlp", handle, device, dtype, config)
         else:
@@ -333,8 +332,8 @@ class JinaBertLayer:
     def forward(
         self,
         hidden_states: torch.Tensor,
-        attention_mask: Optional[torch.FloatTensor] = None,
-        bias: Optional[torch.FloatTensor] = None,
+        segments: List[Tuple[int, int]],
+        bias: AlibiBias,
     ) -> Tuple[torch.Tensor]:
         # Pre-Norm
         residual = hidden_states
@@ -342,7 +341,7 @@ class JinaBertLayer:
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
         self_attention_outputs = self.attention.forward(
             hidden_states,
-            attention_mask,
+            segments,
             bias=bias,
         )
         attention_output = self_attention_outputs[0]
@@ -379,76 +378,88 @@ class JinaBertEncoder:
             for i in range(config.num_hidden_layers)
         ]
         self.num_attention_heads = config.num_attention_heads
+        self.dtype = dtype
 
-    def rebuild_alibi_tensor(
-        self, size: int, device: Optional[Union[torch.device, str]] = None
-    ):
-        # Alibi
-        # Following https://github.com/ofirpress/attention_with_linear_biases/issues/5 (Implementation 1)
-        # In the causal case, you can exploit the fact that softmax is invariant to a uniform translation
-        # of the logits, which makes the math work out *after* applying causal masking. If no causal masking
-        # will be applied, it is necessary to construct the diagonal mask.
-        n_heads = self.num_attention_heads
-
-        def _get_alibi_head_slopes(n_heads: int) -> List[float]:
-            def get_slopes_power_of_2(n):
-                start = 2 ** (-(2 ** -(math.log2(n) - 3)))
-                ratio = start
-                return [start * ratio**i for i in range(n)]
-
-            if math.log2(n_heads).is_integer():
-                return get_slopes_power_of_2(
-                    n_heads
-                )  # In the paper, we only train models that have 2^a heads for some a. This function has
-            else:  # some good properties that only occur when the input is a power of 2. To maintain that even
-                closest_power_of_2 = (
-                    2 ** math.floor(math.log2(n_heads))
-                )  # when the number of heads is not a power of 2, we use this workaround.
-                return (
-                    get_slopes_power_of_2(closest_power_of_2)
-                    + _get_alibi_head_slopes(2 * closest_power_of_2)[0::2][
-                        : n_heads - closest_power_of_2
-                    ]
-                )
+        # The slopes and the |i - j| distances do not depend on the inputs: build them
+        # once and slice them per batch
+        self.slopes = -torch.tensor(
+            alibi_head_slopes(self.num_attention_heads),
+            dtype=torch.float32,
+            device=device,
+        )
+        table_length = min(config.max_position_embeddings, ALIBI_TABLE_MAX_LENGTH)
+        self.relative_positions = self.distances(
+            torch.arange(table_length, device=device)
+        )
+
+    @staticmethod
+    def distances(positions: torch.Tensor) -> torch.Tensor:
+        return (positions[None, :] - positions[:, None]).abs().float()
+
+    def sequence_bias(self, length: int, q_start: int, q_end: int) -> torch.Tensor:
+        """Contiguous ALiBi bias of the queries [q_start, q_end) of one sequence"""
+        if length <= self.relative_positions.size(0):
+            distances = self.relative_positions[q_start:q_end, :length]
+        else:
+            positions = torch.arange(length, device=self.slopes.device)
+            distances = (positions[q_start:q_end, None] - positions[None, :]).abs()
+            distances = distances.float()
+        # One head at a time: a float32 [heads, queries, L] bias would take twice
+        # the memory of the bias itself
+        bias = torch.empty(
+            (1, self.slopes.size(0), q_end - q_start, length),
+            dtype=self.dtype,
+            device=distances.device,
+        )
+        for head, slope in enumerate(self.slopes):
+            torch.mul(distances, slope, out=bias[0, head])
+        return bias
+
+    def alibi_bias(
+        self, cu_seqlens: torch.Tensor
+    ) -> Tuple[List[Tuple[int, int]], AlibiBias]:
+        """Sequences attending together and the builder of their ALiBi bias"""
+        boundaries = cu_seqlens.tolist()
+        total = boundaries[-1]
+        if len(boundaries) > 2 and total <= BLOCK_DIAGONAL_MAX_TOKENS:
+            # Short batches: one call over all packed tokens, the bias masks the
+            # tokens of the other sequences. Built once for every layer
+            ids = segment_ids(cu_seqlens.long(), total)
+            positions = torch.arange(total, device=cu_seqlens.device)
+            distances = self.distances(positions - cu_seqlens.long()[ids])
+            bias = (self.slopes[:, None, None] * distances).masked_fill(
+                ids[None, :, None] != ids[None, None, :], torch.finfo(self.dtype).min
+            )
+            bias = bias.to(self.dtype)[None]
 
-        context_position = torch.arange(size, device=device)[:, None]
-        memory_position = torch.arange(size, device=device)[None, :]
-        relative_position = torch.abs(memory_position - context_position)
-        # [n_heads, max_token_length, max_token_length]
-        relative_position = relative_position.unsqueeze(0).expand(n_heads, -1, -1)
-        slopes = torch.Tensor(_get_alibi_head_slopes(n_heads)).to(device) * -1
-        alibi = slopes.unsqueeze(1).unsqueeze(1) * relative_position
-        # [1, n_heads, max_token_length, max_token_length]
-        alibi = alibi.unsqueeze(0)
-        assert alibi.shape == torch.Size([1, n_heads, size, size])
+            def block_diagonal_bias(length: int, q_start: int, q_end: int):
+                return bias[:, :, q_start:q_end]
 
-        self._current_alibi_size = size
-        return alibi
+            return [(0, total)], block_diagonal_bias
+
+        # Empty rows padding a bucketed batch have nothing to attend
+        segments = [
+            (start, end)
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+            if end > start
+        ]
+        # Rebuilt per layer and per chunk of queries: never a [heads, L, L] tensor
+        # for the longest sequence
+        return segments, self.sequence_bias
 
     def forward(
         self,
         hidden_states: torch.Tensor,
-        max_len: int,
-        attention_mask: Optional[torch.FloatTensor] = None,
+        cu_seqlens: torch.Tensor,
+        max_s: int,
     ) -> Union[Tuple[torch.Tensor], BaseModelOutputWithPastAndCrossAttentions]:
-        # Add alibi matrix to extended_attention_mask
-        bs, seqlen, _ = hidden_states.size()
-        alibi_bias = self.rebuild_alibi_tensor(
-            size=max_len, device=hidden_states.device
-        ).to(hidden_states.dtype)
-        full_alibi_bias = torch.full(
-            (bs, self.num_attention_heads, seqlen, seqlen),
-            fill_value=torch.finfo(hidden_states.dtype).min,
-            dtype=hidden_states.dtype,
-            device=hidden_states.device,
-        )
-        full_alibi_bias[:, :, :max_len, :max_len] = alibi_bias
+        segments, bias = self.alibi_bias(cu_seqlens)
 
         for i, layer_module in enumerate(self.layers):
             layer_outputs = layer_module.forward(
                 hidden_states,
-                attention_mask,
-                full_alibi_bias,
+                segments,
+                bias,
             )
 
             hidden_states = layer_outputs[0]
@@ -466,11 +477,11 @@ class FlashJinaBertModel:
         input_ids,
         token_type_ids,
         position_ids,
-        max_len,
-        attn_mask=None,
+        cu_seqlens,
+        max_s,
     ):
         embeddings = self.embeddings.forward(input_ids, token_type_ids, position_ids)
-        encoder_outputs = self.encoder.forward(embeddings, max_len, attn_mask)
+        encoder_outputs = self.encoder.forward(embeddings, cu_seqlens, max_s)
         return encoder_outputs
 
 
@@ -489,50 +500,30 @@ class FlashJinaBert(Model):
         else:
             self.max_input_length = config.max_position_embeddings
 
-        with safe_open(model_path / "model.safetensors", framework="pt") as f:
-            model = FlashJinaBertModel(f, device, dtype, config)
+        with load_weights(model_path, device, dtype, "FlashJinaBert") as weights:
+            model = FlashJinaBertModel(weights, device, dtype, config)
         self.hidden_size = config.hidden_size
-        self.pooling = DefaultPooling(self.hidden_size, pooling_mode=pool)
+        self.pooling = SegmentPooling(pool)
         self.device = device
         self.dtype = dtype
-        self.hidden_size = config.hidden_size
 
         super(FlashJinaBert, self).__init__(model=model, dtype=dtype, device=device)
 
     @property
-    def batch_type(self) -> Type[PaddedBatch]:
-        return PaddedBatch
-
-    def mean_pooling(
-        self, token_embeddings: torch.Tensor, attention_mask: torch.Tensor
-    ):
-        input_mask_expanded = (
-            attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-        )
-        return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(
-            input_mask_expanded.sum(1), min=1e-9
-        )
+    def batch_type(self) -> Type[FlashBatch]:
+        return FlashBatch
 
     @tracer.start_as_current_span("embed")
-    def embed(self, batch: PaddedBatch) -> List[Embedding]:
-        kwargs = {"input_ids": batch.input_ids}
-        kwargs["token_type_ids"] = batch.token_type_ids
-        kwargs["position_ids"] = batch.position_ids
-        input_lens = batch.attention_mask.cumsum(-1)[:, -1].to(torch.int32)
-        max_input_lens = input_lens.max().item()
-        kwargs["max_len"] = max_input_lens
-        outputs = self.model.forward(**kwargs)
-
-        embedding = self.mean_pooling(outputs, batch.attention_mask)
-        cpu_results = embedding.view(-1).tolist()
-
-        return [
-            Embedding(
-                values=cpu_results[i * self.hidden_size : (i + 1) * self.hidden_size]
-            )
-            for i in range(len(batch))
-        ]
+    def embed(self, batch: FlashBatch) -> torch.Tensor:
+        hidden_states = self.model.forward(
+            input_ids=batch.input_ids,
+            token_type_ids=batch.token_type_ids,
+            position_ids=batch.position_ids,
+            cu_seqlens=batch.cu_seqlens,
+            max_s=batch.max_s,
+        )
+        return self.pooling.forward(hidden_states, batch.cu_seqlens)
 
     @tracer.start_as_current_span("predict")
-    def predict(self, batch: PaddedBatch) -> List[Score]:
+    def predict(self, batch: FlashBatch) -> torch.Tensor:
         pass
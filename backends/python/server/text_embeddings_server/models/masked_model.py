@@ -1,17 +1,25 @@
 import inspect
+import os
 import torch
 
 from pathlib import Path
-from typing import Type, List
+from typing import Type
 from transformers import AutoModelForMaskedLM
 from opentelemetry import trace
 
 from text_embeddings_server.models import Model
-from text_embeddings_server.models.types import PaddedBatch, Embedding, Score
-from text_embeddings_server.models.pooling import SpladePooling
+from text_embeddings_server.models.types import PaddedBatch
+from text_embeddings_server.models.pooling import ChunkedSpladePooling, SpladePooling
 
 tracer = trace.get_tracer(__name__)
 
+# Tokens projected to the vocabulary at once by the SPLADE pooling. 0 runs the whole
+# MLM model and pools the full logits
+SPLADE_CHUNK_TOKENS = int(os.getenv("SPLADE_CHUNK_TOKENS", 4096))
+
+# Attributes holding the MLM head on top of `base_model` (BERT, RoBERTa...)
+MLM_HEADS = ["cls", "lm_head"]
+
 
 class MaskedLanguageModel(Model):
     def __init__(
@@ -29,11 +37,20 @@ class MaskedLanguageModel(Model):
             .to(dtype)
             .to(device)
         )
-        self.pooling = SpladePooling()
+        head = next(
+            (getattr(model, name) for name in MLM_HEADS if hasattr(model, name)), None
+        )
+        if SPLADE_CHUNK_TOKENS > 0 and head is not None:
+            self.encoder = model.base_model
+            self.pooling = ChunkedSpladePooling(head, SPLADE_CHUNK_TOKENS)
+        else:
+            self.encoder = model
+            self.pooling = SpladePooling()
         position_offset = 0
         model_type = model.config.model_type
         if model_type in ["xlm-roberta", "camembert", "roberta"]:
             position_offset = model.config.pad_token_id + 1
+        self.position_offset = position_offset
         if hasattr(model.config, "max_seq_length"):
             self.max_input_length = model.config.max_seq_length
         else:
@@ -58,22 +75,15 @@ class MaskedLanguageModel(Model):
         return PaddedBatch
 
     @tracer.start_as_current_span("embed")
-    def embed(self, batch: PaddedBatch) -> List[Embedding]:
+    def embed(self, batch: PaddedBatch) -> torch.Tensor:
         kwargs = {"input_ids": batch.input_ids, "attention_mask": batch.attention_mask}
         if self.has_token_type_ids:
             kwargs["token_type_ids"] = batch.token_type_ids
         if self.has_position_ids:
             kwargs["position_ids"] = batch.position_ids
-        output = self.model(**kwargs)
-        embedding = self.pooling.forward(output, batch.attention_mask)
-        cpu_results = embedding.view(-1).tolist()
-
-        step_size = embedding.shape[-1]
-        return [
-            Embedding(values=cpu_results[i * step_size : (i + 1) * step_size])
-            for i in range(len(batch))
-        ]
+        output = self.encoder(**kwargs)
+        return self.pooling.forward(output, batch.attention_mask)
 
     @tracer.start_as_current_span("predict")
-    def predict(self, batch: PaddedBatch) -> List[Score]:
+    def predict(self, batch: PaddedBatch) -> torch.Tensor:
         pass
@@ -1,14 +1,21 @@
 import torch
 
 from abc import ABC, abstractmethod
-from typing import List, TypeVar, Type
+from typing import Optional, TypeVar, Type
 
-from text_embeddings_server.models.types import Batch, Embedding
+from text_embeddings_server.models.types import Batch
 
 B = TypeVar("B", bound=Batch)
 
 
 class Model(ABC):
+    # Set when the model runs under compiled static shapes
+    static_shapes: bool = False
+    # First position id of the router, `pad_token_id + 1` for RoBERTa models
+    position_offset: int = 0
+    # Quantization of the weights, None when they are in `dtype`
+    quantize: Optional[str] = None
+
     def __init__(
         self,
         model,
@@ -25,5 +32,5 @@ class Model(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def embed(self, batch: B) -> List[Embedding]:
+    def embed(self, batch: B) -> torch.Tensor:
         raise NotImplementedError
@@ -2,8 +2,7 @@ from abc import ABC, abstractmethod
 
 import torch
 from opentelemetry import trace
-from sentence_transformers.models import Pooling
-from torch import Tensor
+from torch import Tensor, nn
 
 tracer = trace.get_tracer(__name__)
 
@@ -19,6 +18,9 @@ class DefaultPooling(_Pooling):
         assert (
             pooling_mode != "splade"
         ), "Splade pooling is not supported for DefaultPooling"
+        # sentence_transformers is slow to import and only needed for this class
+        from sentence_transformers.models import Pooling
+
         self.pooling = Pooling(hidden_size, pooling_mode=pooling_mode)
 
     @tracer.start_as_current_span("pooling")
@@ -30,6 +32,66 @@ class DefaultPooling(_Pooling):
         return self.pooling.forward(pooling_features)["sentence_embedding"]
 
 
+def segment_ids(cu_seqlens: Tensor, total: int) -> Tensor:
+    """Index of the sequence of every packed token"""
+    return torch.repeat_interleave(
+        torch.arange(cu_seqlens.numel() - 1, device=cu_seqlens.device),
+        cu_seqlens.diff(),
+        output_size=total,
+    )
+
+
+class SegmentPooling(_Pooling):
+    """
+    Pooling of packed `[total_tokens, hidden]` outputs, sequences delimited by
+    `cu_seqlens`, without re-padding them
+    """
+
+    MODES = ["cls", "mean", "lasttoken", "splade"]
+
+    def __init__(self, pooling_mode: str) -> None:
+        assert (
+            pooling_mode in self.MODES
+        ), f"Unsupported pooling mode {pooling_mode} for SegmentPooling"
+        self.pooling_mode = pooling_mode
+
+    @tracer.start_as_current_span("pooling")
+    def forward(self, hidden_states: Tensor, cu_seqlens: Tensor) -> Tensor:
+        cu_seqlens = cu_seqlens.long()
+        total = hidden_states.size(0)
+        if self.pooling_mode == "cls":
+            # Clamped for the empty rows padding a bucketed batch
+            return hidden_states[cu_seqlens[:-1].clamp(max=total - 1)]
+        if self.pooling_mode == "lasttoken":
+            return hidden_states[(cu_seqlens[1:] - 1).clamp(min=0)]
+
+        batch_size = cu_seqlens.numel() - 1
+        ids = segment_ids(cu_seqlens, total)
+        if self.pooling_mode == "mean":
+            # Accumulate in float32: half precision sums overflow on long sequences
+            sums = torch.zeros(
+                (batch_size, hidden_states.size(-1)),
+                dtype=torch.float32,
+                device=hidden_states.device,
+            ).index_add_(0, ids, hidden_states.float())
+            lengths = cu_seqlens.diff().clamp(min=1).unsqueeze(-1)
+            return (sums / lengths).to(hidden_states.dtype)
+
+        # SPLADE: max over the sequence of log(1 + relu(logits)). Values are >= 0 so
+        # zeros are a neutral start for the max
+        activations = torch.log1p(torch.relu(hidden_states))
+        return torch.zeros(
+            (batch_size, hidden_states.size(-1)),
+            dtype=activations.dtype,
+            device=activations.device,
+        ).scatter_reduce_(
+            0,
+            ids.unsqueeze(-1).expand_as(activations),
+            activations,
+            reduce="amax",
+        )
+
+
 class SpladePooling(_Pooling):
     @tracer.start_as_current_span("pooling")
     def forward(self, model_output, attention_mask) -> Tensor:
@@ -38,3 +100,32 @@ class SpladePooling(_Pooling):
         hidden_states = (1 + hidden_states).log()
         hidden_states = torch.mul(hidden_states, attention_mask.unsqueeze(-1))
         return hidden_states.max(dim=1).values
+
+
+class ChunkedSpladePooling(_Pooling):
+    """
+    SPLADE pooling of encoder hidden states: the MLM `head` projects `chunk_tokens`
+    tokens at a time to the vocabulary and log(1 + relu(logits)) is folded into a
+    running max, so the `[batch, seq, vocab]` logits are never materialized
+    """
+
+    def __init__(self, head: nn.Module, chunk_tokens: int) -> None:
+        self.head = head
+        self.chunk_tokens = chunk_tokens
+
+    @tracer.start_as_current_span("pooling")
+    def forward(self, model_output, attention_mask) -> Tensor:
+        hidden_states = model_output[0]
+        batch_size, seq_len, _ = hidden_states.shape
+        chunk_len = max(1, self.chunk_tokens // batch_size)
+        mask = attention_mask.unsqueeze(-1).bool()
+
+        pooled = None
+        for start in range(0, seq_len, chunk_len):
+            end = min(start + chunk_len, seq_len)
+            logits = self.head(hidden_states[:, start:end])
+            # In place: the chunk logits are the only vocab-sized buffer
+            activations = logits.relu_().log1p_().masked_fill_(~mask[:, start:end], 0)
+            chunk_max = activations.amax(dim=1)
+            pooled = chunk_max if pooled is None else torch.maximum(pooled, chunk_max)
+        return pooled
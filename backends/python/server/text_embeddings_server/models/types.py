@@ -1,17 +1,28 @@
 import os
 import math
 import torch
+import warnings
 
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from opentelemetry import trace
+from typing import List, Optional, Tuple
 
 from text_embeddings_server.pb import embed_pb2
-from text_embeddings_server.pb.embed_pb2 import Embedding, Score
+from text_embeddings_server.pb.embed_pb2 import (
+    Embedding,
+    Score,
+    SparseEmbedding,
+    Tensor,
+    TensorDtype,
+)
 
 tracer = trace.get_tracer(__name__)
 PAD_SEQUENCE_TO_MULTIPLE_OF = int(os.environ.get("PAD_SEQUENCE_TO_MULTIPLE_OF", 128))
 SEQ_LEN_EXPONENT_BASE = int(os.environ.get("SEQ_LEN_EXPONENT_BASE", 2))
+# Pack several sequences in every row instead of padding each of them, for models
+# running static shapes
+PACKED_BATCHES = os.environ.get("PACKED_BATCHES", "false").lower() in ["true", "1"]
 
 
 def round_up_seq(number, k, base):
@@ -19,6 +30,155 @@ def round_up_seq(number, k, base):
     return int(k * (base**exponent))
 
 
+def decode_tokens(values, packed: bytes) -> torch.Tensor:
+    """Decode a token field, preferring its packed little-endian int32 encoding"""
+    if packed:
+        with warnings.catch_warnings():
+            # Protobuf bytes are read-only; decoded token ids are never written to
+            warnings.simplefilter("ignore", UserWarning)
+            return torch.frombuffer(packed, dtype=torch.int32)
+    return torch.tensor(values, dtype=torch.int32)
+
+
+def decode_request(pb: embed_pb2.EmbedRequest) -> torch.Tensor:
+    """Flat `[3, total_tokens]` input ids, token type ids and position ids"""
+    return torch.stack(
+        [
+            decode_tokens(pb.input_ids, pb.packed_input_ids),
+            decode_tokens(pb.token_type_ids, pb.packed_token_type_ids),
+            decode_tokens(pb.position_ids, pb.packed_position_ids),
+        ]
+    )
+
+
+def encode_request(
+    tokens: torch.Tensor, cu_seq_lengths: List[int], max_length: int
+) -> embed_pb2.EmbedRequest:
+    """Packed `EmbedRequest` from flat `[3, total_tokens]` token tensors"""
+    tokens = tokens.to(torch.int32).contiguous()
+    return embed_pb2.EmbedRequest(
+        packed_input_ids=tokens[0].numpy().tobytes(),
+        packed_token_type_ids=tokens[1].numpy().tobytes(),
+        packed_position_ids=tokens[2].numpy().tobytes(),
+        cu_seq_lengths=cu_seq_lengths,
+        max_length=max_length,
+    )
+
+
+def concat_requests(pbs: List[embed_pb2.EmbedRequest]) -> embed_pb2.EmbedRequest:
+    """Merge several requests into one, keeping their rows in order"""
+    if len(pbs) == 1:
+        return pbs[0]
+
+    cu_seq_lengths = [0]
+    for pb in pbs:
+        offset = cu_seq_lengths[-1]
+        cu_seq_lengths.extend(offset + length for length in pb.cu_seq_lengths[1:])
+
+    return encode_request(
+        torch.cat([decode_request(pb) for pb in pbs], dim=1),
+        cu_seq_lengths,
+        max(pb.max_length for pb in pbs),
+    )
+
+
+def select_rows(pb: embed_pb2.EmbedRequest, rows: List[int]) -> embed_pb2.EmbedRequest:
+    """Packed `EmbedRequest` with only the given rows of `pb`, in the given order"""
+    cu_seq_lengths = torch.tensor(pb.cu_seq_lengths, dtype=torch.int64)
+    rows = torch.tensor(rows, dtype=torch.int64)
+    starts = cu_seq_lengths[rows]
+    lengths = cu_seq_lengths[rows + 1] - starts
+
+    new_cu_seq_lengths = torch.zeros(len(rows) + 1, dtype=torch.int64)
+    torch.cumsum(lengths, 0, out=new_cu_seq_lengths[1:])
+    # Index of every selected token in the flat tokens of `pb`
+    token_index = torch.arange(int(new_cu_seq_lengths[-1])) + (
+        starts - new_cu_seq_lengths[:-1]
+    ).repeat_interleave(lengths)
+
+    return encode_request(
+        decode_request(pb)[:, token_index],
+        new_cu_seq_lengths.tolist(),
+        int(lengths.max()),
+    )
+
+
+def to_device(tensor: torch.Tensor, device: torch.device, pin_memory: bool = False):
+    """Copy to `device`, staging through pinned memory for asynchronous copies"""
+    if pin_memory and device.type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+def encode_tensor(tensor: torch.Tensor, dtype: TensorDtype) -> Tensor:
+    torch_dtype = torch.float16 if dtype == TensorDtype.FLOAT16 else torch.float32
+    cpu_tensor = tensor.to(torch_dtype).cpu().contiguous()
+    return Tensor(
+        data=cpu_tensor.numpy().tobytes(), shape=list(cpu_tensor.shape), dtype=dtype
+    )
+
+
+def encode_rows(tensor: torch.Tensor, message):
+    cpu_results = tensor.reshape(-1).tolist()
+    step_size = tensor.shape[-1]
+    return [
+        message(values=cpu_results[i * step_size : (i + 1) * step_size])
+        for i in range(len(tensor))
+    ]
+
+
+@tracer.start_as_current_span("encode_sparse")
+def encode_sparse(
+    embeddings: torch.Tensor, options: embed_pb2.SparseOptions
+) -> List[SparseEmbedding]:
+    """Indices and values of the selected entries of every row, selected on device"""
+    batch_size, dim = embeddings.shape
+    if options.top_k:
+        values, indices = embeddings.topk(min(options.top_k, dim), dim=-1)
+        keep = values > options.threshold
+        rows = torch.arange(batch_size, device=embeddings.device)
+        rows = rows.unsqueeze(-1).expand_as(indices)[keep]
+        indices, values = indices[keep], values[keep]
+    else:
+        rows, indices = (embeddings > options.threshold).nonzero(as_tuple=True)
+        values = embeddings[rows, indices]
+
+    counts = torch.bincount(rows, minlength=batch_size).tolist()
+    indices = indices.cpu().split(counts)
+    values = values.float().cpu().split(counts)
+    return [
+        SparseEmbedding(indices=row_indices.tolist(), values=row_values.tolist())
+        for row_indices, row_values in zip(indices, values)
+    ]
+
+
+@tracer.start_as_current_span("to_embed_response")
+def to_embed_response(
+    embeddings: torch.Tensor, pb: embed_pb2.EmbedRequest
+) -> embed_pb2.EmbedResponse:
+    # Static shape batches can carry padding rows
+    embeddings = embeddings[: len(pb.cu_seq_lengths) - 1]
+    if pb.HasField("sparse"):
+        return embed_pb2.EmbedResponse(
+            sparse_embeddings=encode_sparse(embeddings, pb.sparse)
+        )
+    if pb.HasField("output_dtype"):
+        return embed_pb2.EmbedResponse(
+            tensor=encode_tensor(embeddings, pb.output_dtype)
+        )
+    return embed_pb2.EmbedResponse(embeddings=encode_rows(embeddings, Embedding))
+
+
+@tracer.start_as_current_span("to_predict_response")
+def to_predict_response(
+    scores: torch.Tensor, pb: embed_pb2.EmbedRequest
+) -> embed_pb2.PredictResponse:
+    scores = scores[: len(pb.cu_seq_lengths) - 1]
+    if pb.HasField("output_dtype"):
+        return embed_pb2.PredictResponse(tensor=encode_tensor(scores, pb.output_dtype))
+    return embed_pb2.PredictResponse(scores=encode_rows(scores, Score))
+
+
 class Batch(ABC):
     @classmethod
     @abstractmethod
@@ -40,13 +200,21 @@ class PaddedBatch(Batch):
     @classmethod
     @tracer.start_as_current_span("from_pb")
     def from_pb(
-        cls, pb: embed_pb2.EmbedRequest, device: torch.device, max_input_length: int
+        cls,
+        pb: embed_pb2.EmbedRequest,
+        device: torch.device,
+        max_input_length: int,
+        pin_memory: bool = False,
+        shape: Optional[Tuple[int, int]] = None,
     ) -> "PaddedBatch":
+        """Padded to the `(batch_size, seq_len)` bucket `shape` when given"""
         if pb.max_length > max_input_length:
-            raise RuntimeError(f"input length exceeds model config's max_input_length")
+            raise RuntimeError("input length exceeds model config's max_input_length")
 
         batch_size = len(pb.cu_seq_lengths) - 1
-        if device.type == "hpu":
+        if shape is not None:
+            new_bs, max_length = shape
+        elif device.type == "hpu":
             # To better utilize HPU, we need to do batch/seq_len bucketing
             max_length = round_up_seq(
                 pb.max_length, PAD_SEQUENCE_TO_MULTIPLE_OF, SEQ_LEN_EXPONENT_BASE
@@ -56,26 +224,24 @@ class PaddedBatch(Batch):
         else:
             new_bs = batch_size
             max_length = pb.max_length
-        # Allocate padded tensors all at once
-        all_tensors = torch.zeros([4, new_bs, max_length], dtype=torch.int32)
+        cu_seq_lengths = torch.tensor(pb.cu_seq_lengths, dtype=torch.int64)
+        input_lengths = cu_seq_lengths[1:] - cu_seq_lengths[:-1]
 
-        for i, start_index in enumerate(pb.cu_seq_lengths[:-1]):
-            end_index = pb.cu_seq_lengths[i + 1]
-            input_length = end_index - start_index
+        # Flat position of every token in the padded [new_bs, max_length] layout:
+        # row * max_length + (token index - row start)
+        row_starts = torch.arange(batch_size) * max_length - cu_seq_lengths[:-1]
+        padded_index = torch.arange(
+            int(cu_seq_lengths[-1])
+        ) + row_starts.repeat_interleave(input_lengths)
 
-            all_tensors[0, i, :input_length] = torch.tensor(
-                pb.input_ids[start_index:end_index], dtype=torch.int32
-            )
-            all_tensors[1, i, :input_length] = torch.tensor(
-                pb.token_type_ids[start_index:end_index], dtype=torch.int32
-            )
-            all_tensors[2, i, :input_length] = torch.tensor(
-                pb.position_ids[start_index:end_index], dtype=torch.int32
-            )
-            all_tensors[3, i, :input_length] = 1
+        # Allocate padded tensors all at once
+        all_tensors = torch.zeros([4, new_bs * max_length], dtype=torch.int32)
+        all_tensors[:3, padded_index] = decode_request(pb)
+        all_tensors[3, padded_index] = 1
+        all_tensors = all_tensors.view(4, new_bs, max_length)
 
         # Move padded tensors all at once
-        all_tensors = all_tensors.to(device)
+        all_tensors = to_device(all_tensors, device, pin_memory)
 
         return PaddedBatch(
             input_ids=all_tensors[0],
@@ -101,17 +267,19 @@ class FlashBatch(Batch):
     @classmethod
     @tracer.start_as_current_span("from_pb")
     def from_pb(
-        cls, pb: embed_pb2.EmbedRequest, device: torch.device, max_input_length: int
+        cls,
+        pb: embed_pb2.EmbedRequest,
+        device: torch.device,
+        max_input_length: int,
+        pin_memory: bool = False,
     ) -> "FlashBatch":
-        batch_input_ids = torch.tensor(pb.input_ids, dtype=torch.int32, device=device)
-        batch_token_type_ids = torch.tensor(
-            pb.token_type_ids, dtype=torch.int32, device=device
-        )
-        batch_position_ids = torch.tensor(
-            pb.position_ids, dtype=torch.int32, device=device
+        batch_input_ids, batch_token_type_ids, batch_position_ids = to_device(
+            decode_request(pb), device, pin_memory
         )
 
-        cu_seqlens = torch.tensor(pb.cu_seq_lengths, dtype=torch.int32, device=device)
+        cu_seqlens = to_device(
+            torch.tensor(pb.cu_seq_lengths, dtype=torch.int32), device, pin_memory
+        )
 
         return FlashBatch(
             input_ids=batch_input_ids,
@@ -124,3 +292,126 @@ class FlashBatch(Batch):
 
     def __len__(self):
         return self.size
+
+
+def pack_rows(lengths: List[int], row_length: int) -> List[List[int]]:
+    """Sequences of every row when packing them first-fit decreasing"""
+    rows = []
+    free = []
+    for seq in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row, space in enumerate(free):
+            if space >= lengths[seq]:
+                rows[row].append(seq)
+                free[row] -= lengths[seq]
+                break
+        else:
+            rows.append([seq])
+            free.append(row_length - lengths[seq])
+    return rows
+
+
+def packed_capacity(num_seqs: int, num_rows: int) -> int:
+    """
+    Sequences a static shape packed batch of `num_rows` rows is sized for: a power
+    of two number of sequences per row, so that every bucket only compiles for a
+    few packings
+    """
+    per_row = max(1, math.ceil(num_seqs / num_rows))
+    return num_rows * 2 ** math.ceil(math.log2(per_row))
+
+
+@dataclass
+class PackedBatch(Batch):
+    """
+    Several sequences back to back in every fixed-length row, for static shapes.
+    Position ids restart at every sequence and attention is restricted to the
+    sequence with a block-diagonal mask built from `segment_ids`
+    """
+
+    input_ids: torch.Tensor
+    token_type_ids: torch.Tensor
+    position_ids: torch.Tensor
+    # Rank of the sequence of every token in its row, from 1. 0 for the padding
+    segment_ids: torch.Tensor
+
+    # Segments tiling the flattened `[rows * row_length]` layout: every sequence and
+    # the padding at the end of every row, then empty segments up to the capacity
+    # of the bucket. Pooling them never selects tokens with a data-dependent shape
+    cu_seqlens: torch.Tensor
+    # Segment of every sequence of the request, then of the padding sequences
+    order: torch.Tensor
+    size: int
+
+    @classmethod
+    @tracer.start_as_current_span("from_pb")
+    def from_pb(
+        cls,
+        pb: embed_pb2.EmbedRequest,
+        device: torch.device,
+        max_input_length: int,
+        pin_memory: bool = False,
+        shape: Optional[Tuple[int, int]] = None,
+    ) -> "PackedBatch":
+        """Packed in rows of the `(batch_size, seq_len)` bucket `shape` when given"""
+        if pb.max_length > max_input_length:
+            raise RuntimeError("input length exceeds model config's max_input_length")
+
+        cu = pb.cu_seq_lengths
+        lengths = [end - start for start, end in zip(cu, cu[1:])]
+        row_length = shape[1] if shape is not None else pb.max_length
+        rows = pack_rows(lengths, row_length)
+        num_rows = max(len(rows), shape[0]) if shape is not None else len(rows)
+
+        sequences = [seq for row in rows for seq in row]
+        starts = []
+        ranks = []
+        segments = [0]
+        order = [0] * len(sequences)
+        for row_index in range(num_rows):
+            row = rows[row_index] if row_index < len(rows) else []
+            offset = row_index * row_length
+            for rank, seq in enumerate(row, start=1):
+                starts.append(offset)
+                ranks.append(rank)
+                offset += lengths[seq]
+                order[seq] = len(segments) - 1
+                segments.append(offset)
+            if offset < (row_index + 1) * row_length:
+                segments.append((row_index + 1) * row_length)
+
+        if shape is not None:
+            # Sized by the bucket and the packing density, not the request
+            capacity = packed_capacity(len(sequences), num_rows)
+            order.extend([len(segments) - 1] * (capacity - len(sequences)))
+            segments.extend([segments[-1]] * (capacity + num_rows + 1 - len(segments)))
+
+        packed = select_rows(pb, sequences)
+        packed_cu_seqlens = torch.tensor(packed.cu_seq_lengths, dtype=torch.int64)
+        packed_lengths = packed_cu_seqlens.diff()
+        # Flat position of every token in the [num_rows, row_length] layout
+        packed_index = torch.arange(int(packed_cu_seqlens[-1])) + (
+            torch.tensor(starts) - packed_cu_seqlens[:-1]
+        ).repeat_interleave(packed_lengths)
+
+        all_tensors = torch.zeros([4, num_rows * row_length], dtype=torch.int32)
+        all_tensors[:3, packed_index] = decode_request(packed)
+        all_tensors[3, packed_index] = torch.tensor(
+            ranks, dtype=torch.int32
+        ).repeat_interleave(packed_lengths)
+        all_tensors = all_tensors.view(4, num_rows, row_length)
+
+        all_tensors = to_device(all_tensors, device, pin_memory)
+        return PackedBatch(
+            input_ids=all_tensors[0],
+            token_type_ids=all_tensors[1],
+            position_ids=all_tensors[2],
+            segment_ids=all_tensors[3],
+            cu_seqlens=to_device(
+                torch.tensor(segments, dtype=torch.int32), device, pin_memory
+            ),
+            order=to_device(torch.tensor(order, dtype=torch.int64), device, pin_memory),
+            size=len(sequences),
+        )
+
+    def __len__(self):
+        return self.size
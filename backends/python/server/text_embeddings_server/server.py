@@ -9,15 +9,35 @@ from typing import Optional
 
 from text_embeddings_server.models import Model, get_model
 from text_embeddings_server.pb import embed_pb2_grpc, embed_pb2
+from text_embeddings_server.utils.cache import (
+    EMBEDDING_CACHE_PREWARM,
+    EMBEDDING_CACHE_SIZE,
+    EmbeddingCache,
+    prewarm,
+)
+from text_embeddings_server.utils.buckets import (
+    STATIC_SHAPE_HISTOGRAM,
+    BucketSet,
+    save_histogram,
+)
+from text_embeddings_server.utils.disk_cache import EMBEDDING_DISK_CACHE_DIR, DiskCache
+from text_embeddings_server.utils.fingerprint import model_fingerprint
+from text_embeddings_server.utils.executor import InferenceExecutor
 from text_embeddings_server.utils.tracing import UDSOpenTelemetryAioServerInterceptor
 from text_embeddings_server.utils.interceptor import ExceptionInterceptor
+from text_embeddings_server.utils.startup import startup_profile
 
 
 class EmbeddingService(embed_pb2_grpc.EmbeddingServiceServicer):
-    def __init__(self, model: Model):
+    def __init__(
+        self,
+        model: Model,
+        cache: Optional[EmbeddingCache] = None,
+        buckets: Optional[BucketSet] = None,
+    ):
         self.model = model
-        # Force inference mode for the lifetime of EmbeddingService
-        self._inference_mode_raii_guard = torch._C._InferenceMode(True)
+        # The model runs on the executor thread, which holds its own inference mode guard
+        self.executor = InferenceExecutor(model, cache=cache, buckets=buckets)
 
     async def Health(self, request, context):
         if self.model.device.type == "cuda":
@@ -25,24 +45,10 @@ class EmbeddingService(embed_pb2_grpc.EmbeddingServiceServicer):
         return embed_pb2.HealthResponse()
 
     async def Embed(self, request, context):
-        max_input_length = self.model.max_input_length
-        batch = self.model.batch_type.from_pb(
-            request, self.model.device, max_input_length
-        )
-
-        embeddings = self.model.embed(batch)
-
-        return embed_pb2.EmbedResponse(embeddings=embeddings)
+        return await self.executor.embed(request)
 
     async def Predict(self, request, context):
-        max_input_length = self.model.max_input_length
-        batch = self.model.batch_type.from_pb(
-            request, self.model.device, max_input_length
-        )
-
-        scores = self.model.predict(batch)
-
-        return embed_pb2.PredictResponse(scores=scores)
+        return await self.executor.predict(request)
 
 
 def serve(
@@ -50,6 +56,10 @@ def serve(
     dtype: Optional[str],
     uds_path: Path,
     pool: str,
+    profile_startup: bool = False,
+    compile: bool = False,
+    exported: bool = False,
+    quantize: Optional[str] = None,
 ):
     async def serve_inner(
         model_path: Path,
@@ -58,7 +68,12 @@ def serve(
         unix_socket = f"unix://{uds_path}"
 
         try:
-            model = get_model(model_path, dtype, pool)
+            if exported:
+                from text_embeddings_server.models.exported_model import ExportedModel
+
+                model = ExportedModel(model_path, dtype, pool)
+            else:
+                model = get_model(model_path, dtype, pool, quantize)
         except Exception:
             logger.exception("Error when initializing model")
             raise
@@ -69,9 +84,51 @@ def serve(
                 UDSOpenTelemetryAioServerInterceptor(),
             ]
         )
-        embed_pb2_grpc.add_EmbeddingServiceServicer_to_server(
-            EmbeddingService(model), server
-        )
+        cache = None
+        if EMBEDDING_CACHE_SIZE > 0 or EMBEDDING_DISK_CACHE_DIR:
+            precision = str(model.dtype)
+            if model.quantize is not None:
+                precision += f":{model.quantize}"
+            fingerprint = model_fingerprint(model_path, precision)
+            cache = EmbeddingCache(f"{fingerprint}:{pool}")
+            if EMBEDDING_DISK_CACHE_DIR:
+                # Pooling changes the vectors: keep it in the shared file name
+                cache.disk = DiskCache(
+                    EMBEDDING_DISK_CACHE_DIR, f"{fingerprint}-{pool}", cache.dtype
+                )
+            logger.info(
+                f"Embedding cache enabled ({EMBEDDING_CACHE_SIZE} bytes in memory, "
+                f"disk: {EMBEDDING_DISK_CACHE_DIR})"
+            )
+
+        buckets = None
+        if exported:
+            # Batches are padded to the exported shapes
+            buckets = model.buckets
+        elif compile:
+            from text_embeddings_server.utils.compile import compile_model
+
+            # Compiled before the server starts: Health only answers once every
+            # bucket is warm
+            with startup_profile.phase("compile"):
+                buckets = compile_model(
+                    model,
+                    BucketSet.default(
+                        model.device, model.max_input_length, static=True
+                    ),
+                )
+
+        service = EmbeddingService(model, cache, buckets)
+        if cache is not None and EMBEDDING_CACHE_PREWARM:
+            with startup_profile.phase("warmup"):
+                num_rows = prewarm(
+                    service.executor,
+                    EMBEDDING_CACHE_PREWARM,
+                    max(service.executor.max_batch_tokens, 1),
+                )
+            logger.info(f"Pre-warmed the embedding cache with {num_rows} inputs")
+        service.executor.start()
+        embed_pb2_grpc.add_EmbeddingServiceServicer_to_server(service, server)
         SERVICE_NAMES = (
             embed_pb2.DESCRIPTOR.services_by_name["EmbeddingService"].full_name,
             reflection.SERVICE_NAME,
@@ -82,11 +139,18 @@ def serve(
         await server.start()
 
         logger.info(f"Server started at {unix_socket}")
+        if profile_startup:
+            startup_profile.report()
 
         try:
             await server.wait_for_termination()
         except KeyboardInterrupt:
             logger.info("Signal received. Shutting down")
             await server.stop(0)
+        finally:
+            if STATIC_SHAPE_HISTOGRAM:
+                save_histogram(
+                    service.executor.length_histogram, STATIC_SHAPE_HISTOGRAM
+                )
 
     asyncio.run(serve_inner(model_path, dtype))
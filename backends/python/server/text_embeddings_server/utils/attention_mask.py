@@ -0,0 +1,65 @@
+import os
+import torch
+
+from collections import OrderedDict
+from typing import Tuple
+
+# Padded batch shapes whose mask buffer is kept for reuse
+MAX_CACHED_MASKS = 64
+# Below this many packed tokens, the sequences of a batch attend in one call with a
+# [total_tokens, total_tokens] block-diagonal mask instead of one call per sequence
+BLOCK_DIAGONAL_MAX_TOKENS = int(os.getenv("BLOCK_DIAGONAL_MAX_TOKENS", 512))
+
+
+def padded_cu_seqlens(attention_mask: torch.Tensor) -> torch.Tensor:
+    """cu_seqlens of the rows of a right padded batch"""
+    input_lens = attention_mask.sum(-1, dtype=torch.int32)
+    return torch.nn.functional.pad(input_lens.cumsum(-1, dtype=torch.int32), (1, 0))
+
+
+def packed_attention_mask(
+    segment_ids: torch.Tensor, dtype: torch.dtype, is_causal: bool = False
+) -> torch.Tensor:
+    """
+    Additive `[rows, 1, seq, seq]` block-diagonal (block-causal with `is_causal`)
+    mask of the sequences packed in every row. Padding tokens only see each other
+    """
+    allowed = segment_ids[:, None, :, None] == segment_ids[:, None, None, :]
+    if is_causal:
+        allowed = allowed.tril()
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segment_ids.device)
+    return mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+
+
+class KeyPaddingMasks:
+    """
+    Additive `[batch, 1, 1, seq]` masks hiding the padded keys of a batch, broadcast
+    by the attention kernel over heads and queries instead of materializing a
+    `[batch, 1, seq, seq]` mask.
+
+    The buffers are kept per `(batch, seq, dtype)` and refilled in place, so the
+    bucketed shapes of the router reuse the same memory (and the same addresses for
+    graph replays).
+    """
+
+    def __init__(self, max_entries: int = MAX_CACHED_MASKS):
+        self.max_entries = max_entries
+        self._buffers: "OrderedDict[Tuple, torch.Tensor]" = OrderedDict()
+
+    def __call__(
+        self, attention_mask: torch.Tensor, dtype: torch.dtype
+    ) -> torch.Tensor:
+        bsz, tgt_len = attention_mask.shape
+        key = (bsz, tgt_len, dtype, attention_mask.device)
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            buffer = torch.empty(
+                (bsz, 1, 1, tgt_len), dtype=dtype, device=attention_mask.device
+            )
+        self._buffers[key] = buffer
+        while len(self._buffers) > self.max_entries:
+            self._buffers.popitem(last=False)
+
+        return buffer.fill_(0.0).masked_fill_(
+            attention_mask[:, None, None, :] == 0, torch.finfo(dtype).min
+        )
@@ -0,0 +1,239 @@
+import json
+import math
+import os
+import torch
+
+from collections import Counter
+from loguru import logger
+from typing import Dict, List, Optional, Tuple
+
+from text_embeddings_server.models.types import (
+    PAD_SEQUENCE_TO_MULTIPLE_OF,
+    SEQ_LEN_EXPONENT_BASE,
+    pack_rows,
+    round_up_seq,
+)
+
+# JSON file with either the shapes to compile, `{"seq_lens": [...], "batch_sizes":
+# [...]}`, or a histogram of served lengths, `{"histogram": {"<length>": <count>}}`,
+# to learn them from. Unset uses the geometric buckets on HPU and none elsewhere
+STATIC_SHAPE_BUCKETS = os.getenv("STATIC_SHAPE_BUCKETS")
+# Number of sequence length buckets learned from a histogram
+STATIC_SHAPE_NUM_BUCKETS = int(os.getenv("STATIC_SHAPE_NUM_BUCKETS", 6))
+# Learned sequence length buckets are multiples of this many tokens
+STATIC_SHAPE_GRANULARITY = int(os.getenv("STATIC_SHAPE_GRANULARITY", 16))
+# File the histogram of served lengths is written to on shutdown, to learn the
+# buckets of the next start from
+STATIC_SHAPE_HISTOGRAM = os.getenv("STATIC_SHAPE_HISTOGRAM")
+# Largest power-of-two batch size warmed up when the buckets have no batch sizes
+WARMUP_MAX_BATCH_SIZE = int(os.getenv("WARMUP_MAX_BATCH_SIZE", 32))
+
+
+def learn_seq_buckets(
+    histogram: Dict[int, int],
+    num_buckets: int,
+    max_length: int,
+    granularity: int = STATIC_SHAPE_GRANULARITY,
+) -> List[int]:
+    """
+    `num_buckets` sequence lengths minimizing the padding of the lengths of
+    `histogram`. The last bucket is `max_length` so that every input has a shape
+    """
+    counts = Counter()
+    sums = Counter()
+    for length, count in histogram.items():
+        length = min(int(length), max_length)
+        candidate = min(math.ceil(length / granularity) * granularity, max_length)
+        counts[candidate] += count
+        sums[candidate] += count * length
+    counts[max_length] += 0
+    candidates = sorted(counts)
+    if len(candidates) <= num_buckets:
+        return candidates
+
+    # Prefix sums over the candidates: rows of candidates (j, i] padded to
+    # candidates[i - 1] cost width * (num[i] - num[j]) - (tokens[i] - tokens[j])
+    num = torch.tensor([0] + [counts[c] for c in candidates], dtype=torch.float64)
+    tokens = torch.tensor([0] + [sums[c] for c in candidates], dtype=torch.float64)
+    num, tokens = num.cumsum(0), tokens.cumsum(0)
+    widths = torch.tensor([0] + candidates, dtype=torch.float64)
+
+    size = len(candidates) + 1
+    cost = torch.full((size,), math.inf, dtype=torch.float64)
+    cost[0] = 0
+    previous = []
+    for _ in range(num_buckets):
+        next_cost = torch.full((size,), math.inf, dtype=torch.float64)
+        argmin = torch.zeros(size, dtype=torch.int64)
+        for i in range(1, size):
+            padding = widths[i] * (num[i] - num[:i]) - (tokens[i] - tokens[:i])
+            next_cost[i], argmin[i] = (cost[:i] + padding).min(0)
+        cost = next_cost
+        previous.append(argmin)
+
+    buckets = []
+    i = size - 1
+    for argmin in reversed(previous):
+        buckets.append(candidates[i - 1])
+        i = int(argmin[i])
+    return sorted(buckets)
+
+
+def geometric_seq_buckets(
+    max_length: int,
+    multiple: int = PAD_SEQUENCE_TO_MULTIPLE_OF,
+    base: int = SEQ_LEN_EXPONENT_BASE,
+) -> List[int]:
+    """Sequence lengths `multiple * base**i` up to `max_length`"""
+    buckets = []
+    length = min(multiple, max_length)
+    while length < max_length:
+        buckets.append(length)
+        length = round_up_seq(length + 1, multiple, base)
+    buckets.append(max_length)
+    return buckets
+
+
+class BucketSet:
+    """
+    Padded shapes of a static-shape backend (HPU graphs, compiled or exported
+    graphs). Batches are padded to the smallest bucket fitting them, or split
+    between two adjacent sequence buckets when that pads less.
+
+    Without `batch_sizes`, batch sizes are rounded up to a power of two.
+    """
+
+    def __init__(self, seq_lens: List[int], batch_sizes: Optional[List[int]] = None):
+        self.seq_lens = sorted(set(seq_lens))
+        self.batch_sizes = sorted(set(batch_sizes)) if batch_sizes else None
+
+    @classmethod
+    def from_file(cls, path: str, max_length: int) -> "BucketSet":
+        with open(path, "r") as f:
+            config = json.load(f)
+        if "seq_lens" in config:
+            seq_lens = [min(length, max_length) for length in config["seq_lens"]]
+            if max(seq_lens) < max_length:
+                seq_lens.append(max_length)
+        else:
+            histogram = {int(k): v for k, v in config["histogram"].items()}
+            seq_lens = learn_seq_buckets(
+                histogram, STATIC_SHAPE_NUM_BUCKETS, max_length
+            )
+            logger.info(f"Learned sequence buckets {seq_lens} from {path}")
+        return cls(seq_lens, config.get("batch_sizes"))
+
+    @classmethod
+    def default(
+        cls, device: torch.device, max_length: int, static: bool = False
+    ) -> Optional["BucketSet"]:
+        """
+        Buckets of `STATIC_SHAPE_BUCKETS`, else the geometric buckets on HPU or for
+        `static` shapes, else None
+        """
+        if STATIC_SHAPE_BUCKETS:
+            return cls.from_file(STATIC_SHAPE_BUCKETS, max_length)
+        if device.type == "hpu" or static:
+            return cls(geometric_seq_buckets(max_length))
+        return None
+
+    @property
+    def max_batch_size(self) -> Optional[int]:
+        return self.batch_sizes[-1] if self.batch_sizes else None
+
+    def seq_len(self, length: int) -> int:
+        for bucket in self.seq_lens:
+            if bucket >= length:
+                return bucket
+        raise RuntimeError(f"input length {length} exceeds the largest bucket")
+
+    def batch_size(self, size: int) -> int:
+        if self.batch_sizes is None:
+            return 2 ** math.ceil(math.log2(size))
+        for bucket in self.batch_sizes:
+            if bucket >= size:
+                return bucket
+        raise RuntimeError(f"batch size {size} exceeds the largest bucket")
+
+    def shapes(self) -> List[Tuple[int, int]]:
+        """
+        Every `(batch_size, seq_len)` shape, for warmups. Batch sizes are powers of
+        two up to `WARMUP_MAX_BATCH_SIZE` without `batch_sizes`
+        """
+        batch_sizes = self.batch_sizes or [
+            2**i for i in range(int(math.log2(WARMUP_MAX_BATCH_SIZE)) + 1)
+        ]
+        return [(bs, seq_len) for bs in batch_sizes for seq_len in self.seq_lens]
+
+    def split(self, lengths: List[int]) -> List[Tuple[List[int], Tuple[int, int]]]:
+        """Rows of every sub-batch and its `(batch_size, seq_len)` shape"""
+        rows = sorted(range(len(lengths)), key=lengths.__getitem__)
+        chunk = self.max_batch_size or len(rows)
+
+        plan = []
+        for start in range(0, len(rows), chunk):
+            plan.extend(self._split_chunk(rows[start : start + chunk], lengths))
+        return plan
+
+    def _split_chunk(
+        self, rows: List[int], lengths: List[int]
+    ) -> List[Tuple[List[int], Tuple[int, int]]]:
+        upper = self.seq_len(lengths[rows[-1]])
+        single = [(rows, (self.batch_size(len(rows)), upper))]
+        index = self.seq_lens.index(upper)
+        if index == 0:
+            return single
+
+        # Rows fitting the bucket below run in their own batch
+        lower = self.seq_lens[index - 1]
+        num_short = sum(1 for row in rows if lengths[row] <= lower)
+        if num_short == 0:
+            return single
+        short, long = rows[:num_short], rows[num_short:]
+        split_cost = (
+            self.batch_size(len(short)) * lower + self.batch_size(len(long)) * upper
+        )
+        if split_cost >= self.batch_size(len(rows)) * upper:
+            return single
+        return [
+            (short, (self.batch_size(len(short)), lower)),
+            (long, (self.batch_size(len(long)), upper)),
+        ]
+
+    def packed_shape(self, lengths: List[int]) -> Optional[Tuple[int, int]]:
+        """Smallest shape packing sequences of the given lengths, None if none fits"""
+        best = None
+        for seq_len in self.seq_lens:
+            if seq_len < max(lengths):
+                continue
+            num_rows = len(pack_rows(lengths, seq_len))
+            if self.max_batch_size is not None and num_rows > self.max_batch_size:
+                continue
+            shape = (self.batch_size(num_rows), seq_len)
+            if best is None or shape[0] * shape[1] < best[0] * best[1]:
+                best = shape
+        return best
+
+    def split_packed(
+        self, lengths: List[int], rows: Optional[List[int]] = None
+    ) -> List[Tuple[List[int], Tuple[int, int]]]:
+        """Rows of every packed sub-batch and its `(batch_size, seq_len)` shape"""
+        if rows is None:
+            rows = list(range(len(lengths)))
+            # No split fits a row longer than every bucket
+            self.seq_len(max(lengths))
+        shape = self.packed_shape([lengths[row] for row in rows])
+        if shape is not None:
+            return [(rows, shape)]
+        # Too many rows for the largest batch bucket
+        half = len(rows) // 2
+        return self.split_packed(lengths, rows[:half]) + self.split_packed(
+            lengths, rows[half:]
+        )
+
+
+def save_histogram(histogram: Counter, path: str):
+    """Write `histogram` in the format of `STATIC_SHAPE_BUCKETS`"""
+    with open(path, "w") as f:
+        json.dump({"histogram": dict(histogram)}, f)
+    logger.info(f"Saved the histogram of {sum(histogram.values())} lengths to {path}")
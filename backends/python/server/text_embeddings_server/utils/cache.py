@@ -0,0 +1,320 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import torch
+
+from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from loguru import logger
+from opentelemetry import metrics
+from typing import Callable, Dict, List, Optional
+
+from text_embeddings_server.models.types import decode_request, encode_request
+from text_embeddings_server.pb import embed_pb2
+from text_embeddings_server.utils.disk_cache import DiskCache
+
+meter = metrics.get_meter(__name__)
+
+# Byte budget of the in-process embedding cache. 0 disables the cache
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 0))
+# Store cached vectors in float16 to fit twice as many entries in the budget
+EMBEDDING_CACHE_FP16 = os.getenv("EMBEDDING_CACHE_FP16", "false").lower() in [
+    "true",
+    "1",
+]
+# JSON lines file of popular inputs (`input_ids`, optional `token_type_ids`,
+# `position_ids` and `method`) computed before the server starts
+EMBEDDING_CACHE_PREWARM = os.getenv("EMBEDDING_CACHE_PREWARM")
+# Seconds a batch waits for the rows another batch is computing before computing
+# them itself
+EMBEDDING_CACHE_WAIT_TIMEOUT = float(os.getenv("EMBEDDING_CACHE_WAIT_TIMEOUT", 30))
+
+
+def sequence_keys(pb: embed_pb2.EmbedRequest, identity: bytes) -> List[bytes]:
+    """128 bits hash of the token ids, token type ids and position ids of every row"""
+    tokens = decode_request(pb)
+    input_ids = memoryview(tokens[0].numpy()).cast("B")
+    token_type_ids = memoryview(tokens[1].numpy()).cast("B")
+    position_ids = memoryview(tokens[2].numpy()).cast("B")
+
+    base = hashlib.blake2b(identity, digest_size=16)
+    cu_seq_lengths = pb.cu_seq_lengths
+    keys = []
+    for i in range(len(cu_seq_lengths) - 1):
+        start, end = cu_seq_lengths[i] * 4, cu_seq_lengths[i + 1] * 4
+        hasher = base.copy()
+        hasher.update(input_ids[start:end])
+        hasher.update(token_type_ids[start:end])
+        hasher.update(position_ids[start:end])
+        keys.append(hasher.digest())
+    return keys
+
+
+@dataclass
+class CacheLookup:
+    keys: List[bytes]
+    # Rows served from the cache
+    hits: Dict[int, torch.Tensor] = field(default_factory=dict)
+    # Rows computed by another in-flight batch, or duplicates of a miss in this one
+    pending: Dict[int, Future] = field(default_factory=dict)
+    # Rows this batch runs through the model
+    miss_rows: List[int] = field(default_factory=list)
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.keys)
+
+
+class EmbeddingCache:
+    """
+    LRU cache of model outputs keyed on the hash of each sequence's tokens.
+
+    Lookups happen before padding so cached rows cost no compute. Identical
+    sequences that are already being computed, by this batch or by another
+    in-flight batch, are awaited instead of being computed again (single-flight).
+    Misses fall back to the optional `disk` cache shared with other processes.
+    """
+
+    def __init__(
+        self,
+        identity: str,
+        max_bytes: int = EMBEDDING_CACHE_SIZE,
+        fp16: bool = EMBEDDING_CACHE_FP16,
+        disk: Optional[DiskCache] = None,
+    ):
+        self.identity = identity
+        self.max_bytes = max_bytes
+        self.dtype = torch.float16 if fp16 else torch.float32
+        self.disk = disk
+        self.size_bytes = 0
+
+        self._entries: "OrderedDict[bytes, torch.Tensor]" = OrderedDict()
+        self._in_flight: Dict[bytes, Future] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hits_counter = meter.create_counter(
+            "tei_python_embedding_cache_hits", description="Rows served from the cache"
+        )
+        self._coalesced_counter = meter.create_counter(
+            "tei_python_embedding_cache_coalesced",
+            description="Rows awaited from the batch already computing them",
+        )
+        self._disk_hits_counter = meter.create_counter(
+            "tei_python_embedding_cache_disk_hits",
+            description="Rows served from the shared disk cache",
+        )
+        self._misses_counter = meter.create_counter(
+            "tei_python_embedding_cache_misses",
+            description="Rows computed by the model",
+        )
+        self._evictions_counter = meter.create_counter(
+            "tei_python_embedding_cache_evictions",
+            description="Entries evicted to stay within the byte budget",
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+        }
+
+    def lookup(self, pb: embed_pb2.EmbedRequest, method: str) -> CacheLookup:
+        keys = sequence_keys(pb, f"{self.identity}:{method}".encode())
+        lookup = CacheLookup(keys=keys)
+        disk_hits = 0
+
+        with self._lock:
+            for row, key in enumerate(keys):
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    lookup.hits[row] = value
+                    continue
+                if key in self._in_flight:
+                    lookup.pending[row] = self._in_flight[key]
+                    continue
+
+                value = self.disk.get(method, key) if self.disk is not None else None
+                if value is not None:
+                    value = value.to(self.dtype)
+                    self._insert(key, value)
+                    lookup.hits[row] = value
+                    disk_hits += 1
+                else:
+                    self._in_flight[key] = Future()
+                    lookup.miss_rows.append(row)
+
+        self.hits += len(lookup.hits)
+        self.disk_hits += disk_hits
+        self.coalesced += len(lookup.pending)
+        self.misses += len(lookup.miss_rows)
+        self._hits_counter.add(len(lookup.hits))
+        self._disk_hits_counter.add(disk_hits)
+        self._coalesced_counter.add(len(lookup.pending))
+        self._misses_counter.add(len(lookup.miss_rows))
+        return lookup
+
+    def complete(
+        self,
+        lookup: CacheLookup,
+        method: str,
+        results: Optional[torch.Tensor],
+        recompute: Optional[Callable[[List[int]], Optional[torch.Tensor]]] = None,
+    ) -> Optional[torch.Tensor]:
+        """
+        Store the rows computed for `lookup` and assemble the results of every row
+        in the original order. None when the model does not implement `method`.
+
+        Rows still pending after `EMBEDDING_CACHE_WAIT_TIMEOUT` are computed again
+        by `recompute`, so that a stalled batch does not block this one
+        """
+        computed = {}
+        if results is not None:
+            results = results[: len(lookup.miss_rows)].to(self.dtype).cpu()
+            with self._lock:
+                for row, value in zip(lookup.miss_rows, results):
+                    key = lookup.keys[row]
+                    value = value.clone()
+                    computed[row] = value
+                    self._insert(key, value)
+                    self._in_flight.pop(key).set_result(value)
+            if self.disk is not None:
+                self.disk.put_many(
+                    method, [lookup.keys[row] for row in lookup.miss_rows], results
+                )
+
+        values = {**lookup.hits, **computed}
+        futures.wait(set(lookup.pending.values()), timeout=EMBEDDING_CACHE_WAIT_TIMEOUT)
+        stalled = []
+        for row, future in lookup.pending.items():
+            if not future.done():
+                stalled.append(row)
+                continue
+            values[row] = future.result()
+            if values[row] is None:
+                # Released by a batch whose model does not implement `method`
+                return None
+
+        if stalled:
+            if recompute is None:
+                raise TimeoutError(
+                    f"{len(stalled)} rows still computed by another batch after "
+                    f"{EMBEDDING_CACHE_WAIT_TIMEOUT}s"
+                )
+            logger.warning(
+                f"{len(stalled)} rows still computed by another batch after "
+                f"{EMBEDDING_CACHE_WAIT_TIMEOUT}s: computing them again"
+            )
+            recomputed = recompute(stalled)
+            if recomputed is None:
+                return None
+            for row, value in zip(stalled, recomputed.to(self.dtype).cpu()):
+                values[row] = value
+
+        output = torch.empty(
+            (lookup.num_rows, next(iter(values.values())).shape[-1]),
+            dtype=torch.float32,
+        )
+        for row, value in values.items():
+            output[row] = value
+        return output
+
+    def abort(self, lookup: CacheLookup, err: Exception):
+        """Release the rows owned by `lookup` when its batch failed"""
+        with self._lock:
+            for row in lookup.miss_rows:
+                future = self._in_flight.pop(lookup.keys[row], None)
+                if future is not None:
+                    future.set_exception(err)
+
+    def release(self, lookup: CacheLookup):
+        """
+        Release the rows owned by `lookup` without a value, when the model does not
+        implement the method
+        """
+        with self._lock:
+            for row in lookup.miss_rows:
+                future = self._in_flight.pop(lookup.keys[row], None)
+                if future is not None:
+                    future.set_result(None)
+
+    def _insert(self, key: bytes, value: torch.Tensor):
+        entry_bytes = value.nbytes + len(key)
+        if entry_bytes > self.max_bytes:
+            return
+
+        self._entries[key] = value
+        self.size_bytes += entry_bytes
+        while self.size_bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= evicted.nbytes + len(evicted_key)
+            self.evictions += 1
+            self._evictions_counter.add(1)
+
+
+def prewarm(executor, path: str, max_batch_tokens: int):
+    """Run the inputs of a JSON lines file through `executor` to fill its cache"""
+    from text_embeddings_server.utils.executor import _Request
+
+    batches = {"embed": [], "predict": []}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            input_ids = item["input_ids"]
+            token_type_ids = item.get("token_type_ids", [0] * len(input_ids))
+            # Positions start where the router starts them for this model
+            offset = executor.model.position_offset
+            position_ids = item.get(
+                "position_ids", list(range(offset, offset + len(input_ids)))
+            )
+            batches[item.get("method", "embed")].append(
+                (input_ids, token_type_ids, position_ids)
+            )
+
+    num_rows = 0
+    for method, rows in batches.items():
+        start = 0
+        while start < len(rows):
+            end, num_tokens = start, 0
+            while end < len(rows) and (
+                end == start or num_tokens + len(rows[end][0]) <= max_batch_tokens
+            ):
+                num_tokens += len(rows[end][0])
+                end += 1
+
+            chunk = rows[start:end]
+            cu_seq_lengths = [0]
+            for input_ids, _, _ in chunk:
+                cu_seq_lengths.append(cu_seq_lengths[-1] + len(input_ids))
+            tokens = torch.tensor(
+                [
+                    list(itertools.chain.from_iterable(row[i] for row in chunk))
+                    for i in range(3)
+                ],
+                dtype=torch.int32,
+            )
+            pb = encode_request(
+                tokens, cu_seq_lengths, max(len(row[0]) for row in chunk)
+            )
+            with torch.inference_mode():
+                executor.run([_Request(method, pb, num_tokens, len(chunk), None, None)])
+
+            num_rows += len(chunk)
+            start = end
+    return num_rows
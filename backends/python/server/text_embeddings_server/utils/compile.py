@@ -0,0 +1,183 @@
+import os
+import time
+import torch
+
+from loguru import logger
+from opentelemetry import metrics
+from typing import Callable, List, Optional, Set, Tuple
+
+from text_embeddings_server.models import Model
+from text_embeddings_server.models.types import (
+    PackedBatch,
+    PaddedBatch,
+    encode_request,
+)
+from text_embeddings_server.utils.buckets import BucketSet
+
+meter = metrics.get_meter(__name__)
+
+METHODS = ["embed", "predict"]
+
+# Largest power-of-two number of sequences per row warmed up for packed batches.
+# Denser packings run eagerly
+WARMUP_MAX_SEQS_PER_ROW = int(os.getenv("WARMUP_MAX_SEQS_PER_ROW", 8))
+# Batches between two logs of the share of batches running compiled code
+COMPILE_HIT_RATE_LOG_INTERVAL = int(os.getenv("COMPILE_HIT_RATE_LOG_INTERVAL", 1000))
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timed(fn: Callable, batch, device: torch.device):
+    start = time.perf_counter()
+    result = fn(batch)
+    synchronize(device)
+    return result, time.perf_counter() - start
+
+
+def warmup_batch(model: Model, batch_size: int, seq_len: int, seqs_per_row: int = 1):
+    """
+    Batch of the `(batch_size, seq_len)` bucket, every row filled with
+    `seqs_per_row` sequences of the same length
+    """
+    length = seq_len // seqs_per_row
+    num_seqs = batch_size * seqs_per_row
+    tokens = torch.zeros((3, num_seqs, length), dtype=torch.int32)
+    tokens[2] = torch.arange(length, dtype=torch.int32) + model.position_offset
+    pb = encode_request(
+        tokens.view(3, -1),
+        list(range(0, num_seqs * length + 1, length)),
+        length,
+    )
+    return model.batch_type.from_pb(
+        pb, model.device, model.max_input_length, shape=(batch_size, seq_len)
+    )
+
+
+def warmup_packings(model: Model, seq_len: int) -> List[int]:
+    """
+    Sequences per row warmed up for every bucket: packed batches compile once per
+    power of two (see `packed_capacity`), padded batches hold one sequence per row
+    """
+    if model.batch_type is not PackedBatch:
+        return [1]
+    packings = []
+    seqs_per_row = 1
+    while seqs_per_row <= min(seq_len, WARMUP_MAX_SEQS_PER_ROW):
+        packings.append(seqs_per_row)
+        seqs_per_row *= 2
+    return packings
+
+
+def batch_key(batch) -> Tuple[int, ...]:
+    """Shapes the compiled code of a batch is specialized on"""
+    if isinstance(batch, PackedBatch):
+        return (*batch.input_ids.shape, batch.order.numel())
+    return tuple(batch.input_ids.shape)
+
+
+class CompiledMethod:
+    """
+    Code compiled for the warmed up batch shapes, frozen: other shapes run eagerly.
+    The share of batches running compiled code is counted and logged every
+    `COMPILE_HIT_RATE_LOG_INTERVAL` batches, to tune the buckets
+    """
+
+    def __init__(self, method: str, compiled: Callable, keys: Set[Tuple[int, ...]]):
+        self.method = method
+        self.forward = torch._dynamo.run(compiled)
+        self.keys = keys
+        self.batches = 0
+        self.hits = 0
+        self._batches_counter = meter.create_counter(
+            "tei_python_compiled_batches",
+            description="Batches by whether their shape was compiled",
+        )
+
+    def __call__(self, batch):
+        hit = batch_key(batch) in self.keys
+        self.batches += 1
+        self.hits += hit
+        self._batches_counter.add(1, {"method": self.method, "compiled": hit})
+        if self.batches % COMPILE_HIT_RATE_LOG_INTERVAL == 0:
+            logger.info(
+                f"Compiled {self.method} ran {self.hits / self.batches:.1%} of "
+                f"{self.batches} batches, the others ran eagerly"
+            )
+        return self.forward(batch)
+
+
+def compile_model(model: Model, buckets: BucketSet) -> Optional[BucketSet]:
+    """
+    Compile `embed` and `predict` of `model` with `torch.compile` for every shape of
+    `buckets`, then freeze the compiled code: shapes outside of the buckets run
+    eagerly instead of compiling on the request path.
+
+    Returns the buckets the executor must pad to, None when the model cannot run
+    static shapes.
+    """
+    if model.device.type == "hpu":
+        logger.info("HPU graphs already capture static shapes: not compiling")
+        return buckets
+
+    # Flash models switch from varlen to packed batches
+    model.static_shapes = True
+    if model.batch_type not in [PaddedBatch, PackedBatch]:
+        logger.warning(
+            f"{type(model).__name__} does not run static shapes: not compiling"
+        )
+        model.static_shapes = False
+        return None
+
+    shapes = buckets.shapes()
+    warmups = [
+        (batch_size, seq_len, seqs_per_row)
+        for batch_size, seq_len in shapes
+        for seqs_per_row in warmup_packings(model, seq_len)
+    ]
+    # Every bucket and packing keeps its own compiled code
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, 2 * len(warmups)
+    )
+    torch._dynamo.config.accumulated_cache_size_limit = max(
+        torch._dynamo.config.accumulated_cache_size_limit, 4 * len(warmups)
+    )
+
+    start = time.perf_counter()
+    # The executor thread runs in inference mode: compile under the same guards
+    with torch.inference_mode():
+        for method in METHODS:
+            eager = getattr(model, method, None)
+            if eager is None:
+                # Flash models do not implement `predict`
+                continue
+            compiled = torch.compile(eager, dynamic=False)
+            keys = set()
+            for batch_size, seq_len, seqs_per_row in warmups:
+                batch = warmup_batch(model, batch_size, seq_len, seqs_per_row)
+                timed(eager, batch, model.device)
+                result, eager_seconds = timed(eager, batch, model.device)
+                if result is None:
+                    # Method not implemented by this model
+                    break
+                _, compile_seconds = timed(compiled, batch, model.device)
+                _, compiled_seconds = timed(compiled, batch, model.device)
+                keys.add(batch_key(batch))
+                logger.info(
+                    f"Compiled {method} for shape ({batch_size}, {seq_len}) with "
+                    f"{seqs_per_row} sequences per row in {compile_seconds:.1f}s: "
+                    f"eager {eager_seconds * 1000:.1f}ms, "
+                    f"compiled {compiled_seconds * 1000:.1f}ms "
+                    f"({eager_seconds / max(compiled_seconds, 1e-9):.2f}x)"
+                )
+            else:
+                # Only run the code compiled for the buckets from now on
+                setattr(model, method, CompiledMethod(method, compiled, keys))
+
+    logger.info(
+        f"Compiled {len(shapes)} shapes, {len(warmups)} packings, in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+    return buckets
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from loguru import logger
 import importlib.metadata
 import importlib.util
@@ -14,6 +15,7 @@ ALLOW_REDUCED_PRECISION = os.getenv(
 ]
 
 
+@lru_cache(maxsize=None)
 def _is_ipex_available():
     def get_major_and_minor_from_version(full_version):
         return (
@@ -41,6 +43,8 @@ def _is_ipex_available():
     return True
 
 
+# Probes shell out or import heavy modules: run them once per process
+@lru_cache(maxsize=None)
 def is_hpu() -> bool:
     is_hpu_available = True
     try:
@@ -50,11 +54,13 @@ def is_hpu() -> bool:
     return is_hpu_available
 
 
+@lru_cache(maxsize=None)
 def use_ipex() -> bool:
     value = os.environ.get("USE_IPEX", "True").lower()
     return value in ["true", "1"] and _is_ipex_available()
 
 
+@lru_cache(maxsize=None)
 def get_device():
     device = torch.device("cpu")
     if torch.cuda.is_available():
@@ -0,0 +1,217 @@
+import fcntl
+import mmap
+import numpy as np
+import os
+import struct
+import torch
+
+from loguru import logger
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Directory of the memory-mapped cache files shared by every server on the host.
+# Unset disables the disk cache
+EMBEDDING_DISK_CACHE_DIR = os.getenv("EMBEDDING_DISK_CACHE_DIR")
+# Number of vectors each cache file can hold
+EMBEDDING_DISK_CACHE_SLOTS = int(os.getenv("EMBEDDING_DISK_CACHE_SLOTS", 262144))
+
+MAGIC = b"TEICACHE"
+VERSION = 1
+# magic, version, dim, element size, number of slots
+HEADER_FORMAT = "<8sIIIQ"
+HEADER_SIZE = mmap.PAGESIZE
+# seqlock counter (uint32), padding, key (16 bytes), padding
+SLOT_SIZE = 32
+KEY_OFFSET = 8
+KEY_SIZE = 16
+# Slots probed after the home slot of a key
+PROBES = 4
+
+DTYPES = {torch.float16: np.float16, torch.float32: np.float32}
+
+
+class MmapTable:
+    """
+    Fixed-slot hash table of vectors in a memory-mapped file.
+
+    Every slot is protected by a seqlock: readers never block and treat a slot
+    written concurrently as a miss. Writers take an `fcntl` lock on the byte range
+    of the slots probed for their key only, so processes contend only when writing
+    neighbouring keys.
+    """
+
+    def __init__(self, path: Path, num_slots: int, dim: int, dtype: torch.dtype):
+        self.path = path
+        self.num_slots = num_slots
+        self.dim = dim
+        self.np_dtype = DTYPES[dtype]
+        itemsize = np.dtype(self.np_dtype).itemsize
+        self.arena_offset = HEADER_SIZE + num_slots * SLOT_SIZE
+        size = self.arena_offset + num_slots * dim * itemsize
+
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, dim, itemsize, num_slots)
+        self.fd = self._open(path, header, size)
+
+        self.mmap = mmap.mmap(self.fd, size)
+        slots = np.frombuffer(
+            self.mmap, dtype=np.uint8, count=num_slots * SLOT_SIZE, offset=HEADER_SIZE
+        ).reshape(num_slots, SLOT_SIZE)
+        self.seqs = slots.view(np.uint32)[:, 0]
+        self.keys = slots[:, KEY_OFFSET : KEY_OFFSET + KEY_SIZE]
+        self.vectors = np.frombuffer(
+            self.mmap,
+            dtype=self.np_dtype,
+            count=num_slots * dim,
+            offset=self.arena_offset,
+        ).reshape(num_slots, dim)
+
+    @staticmethod
+    def _open(path: Path, header: bytes, size: int) -> int:
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            # Only one process initializes the file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                current_inode = os.stat(path).st_ino
+            except FileNotFoundError:
+                current_inode = None
+            if current_inode == os.fstat(fd).st_ino:
+                break
+            # Another process rebuilt the file while this one waited for the lock
+            # of the old one: closing releases it
+            os.close(fd)
+
+        try:
+            current = os.pread(fd, len(header), 0)
+            if not current:
+                # Sparse file: untouched slots do not use disk space
+                os.ftruncate(fd, size)
+                os.pwrite(fd, header, 0)
+                return fd
+            if current == header:
+                return fd
+
+            # Other processes may still map the old file: replace it instead of
+            # truncating it under them
+            logger.warning(f"Rebuilding incompatible embedding cache {path}")
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(tmp_fd, size)
+            os.pwrite(tmp_fd, header, 0)
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        return tmp_fd
+
+    def _probe(self, key: bytes) -> range:
+        home = int.from_bytes(key[:8], "little") % self.num_slots
+        return range(home, home + PROBES)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        for slot in self._probe(key):
+            slot %= self.num_slots
+            seq = int(self.seqs[slot])
+            if seq == 0:
+                return None
+            if seq % 2 == 1 or self.keys[slot].tobytes() != key:
+                continue
+            value = self.vectors[slot].copy()
+            # The slot was overwritten while reading
+            if int(self.seqs[slot]) != seq:
+                return None
+            return value
+        return None
+
+    def _probe_ranges(self, key: bytes) -> List[Tuple[int, int]]:
+        """`(offset, length)` byte ranges of the slots probed for `key`"""
+        home = self._probe(key).start
+        first = min(PROBES, self.num_slots - home)
+        ranges = [(HEADER_SIZE + home * SLOT_SIZE, first * SLOT_SIZE)]
+        if first < PROBES:
+            # The probe wraps around the end of the table
+            ranges.append((HEADER_SIZE, (PROBES - first) * SLOT_SIZE))
+        return ranges
+
+    def put(self, key: bytes, value: np.ndarray):
+        ranges = self._probe_ranges(key)
+        for offset, length in ranges:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+        try:
+            # Probed under the lock: another process may have just claimed the
+            # empty slot this key would take
+            slots = [slot % self.num_slots for slot in self._probe(key)]
+            target = slots[0]
+            for slot in slots:
+                if self.seqs[slot] == 0 or self.keys[slot].tobytes() == key:
+                    target = slot
+                    break
+
+            self.seqs[target] += 1
+            self.keys[target] = np.frombuffer(key, dtype=np.uint8)
+            self.vectors[target] = value
+            self.seqs[target] += 1
+        finally:
+            for offset, length in reversed(ranges):
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+
+class DiskCache:
+    """
+    Embedding cache shared by every server process on the host and persisted across
+    restarts. One file per model fingerprint, RPC method and storage dtype so entries
+    computed by other weights are never served.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fingerprint: str,
+        dtype: torch.dtype,
+        num_slots: int = EMBEDDING_DISK_CACHE_SLOTS,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+        self.dtype = dtype
+        self.num_slots = num_slots
+        self._tables: Dict[str, MmapTable] = {}
+
+    def _path(self, method: str) -> Path:
+        dtype = str(self.dtype).split(".")[-1]
+        return (
+            self.directory
+            / f"{self.fingerprint}-{method}-{dtype}-{self.num_slots}.cache"
+        )
+
+    def _table(self, method: str, dim: Optional[int] = None) -> Optional[MmapTable]:
+        table = self._tables.get(method)
+        if table is not None:
+            return table
+
+        path = self._path(method)
+        if dim is None:
+            # The vector size is only known once a server wrote to the file
+            if not path.exists() or path.stat().st_size <= HEADER_SIZE:
+                return None
+            with open(path, "rb") as f:
+                _, _, dim, _, _ = struct.unpack(
+                    HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT))
+                )
+
+        table = MmapTable(path, self.num_slots, dim, self.dtype)
+        self._tables[method] = table
+        return table
+
+    def get(self, method: str, key: bytes) -> Optional[torch.Tensor]:
+        table = self._table(method)
+        if table is None:
+            return None
+        value = table.get(key)
+        return torch.from_numpy(value) if value is not None else None
+
+    def put_many(self, method: str, keys: List[bytes], values: torch.Tensor):
+        table = self._table(method, dim=values.shape[-1])
+        values = values.to(self.dtype).numpy()
+        for key, value in zip(keys, values):
+            table.put(key, value)
@@ -0,0 +1,506 @@
+import asyncio
+import contextvars
+import os
+import threading
+import torch
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from loguru import logger
+from opentelemetry import metrics, trace
+from typing import List, Optional, Tuple, Union
+
+from text_embeddings_server.models import Model
+from text_embeddings_server.models.types import (
+    Batch,
+    PackedBatch,
+    PaddedBatch,
+    concat_requests,
+    select_rows,
+    to_embed_response,
+    to_predict_response,
+)
+from text_embeddings_server.pb import embed_pb2
+from text_embeddings_server.utils.cache import (
+    CacheLookup,
+    EmbeddingCache,
+    sequence_keys,
+)
+from text_embeddings_server.utils.buckets import STATIC_SHAPE_HISTOGRAM, BucketSet
+from text_embeddings_server.utils.planner import plan_micro_batches
+
+tracer = trace.get_tracer(__name__)
+meter = metrics.get_meter(__name__)
+
+# Token budget of a merged forward pass, the router's `--max-batch-tokens` by
+# default. 0 disables merging of concurrent RPCs
+BATCH_MERGE_MAX_TOKENS = int(
+    os.getenv("BATCH_MERGE_MAX_TOKENS", os.getenv("MAX_BATCH_TOKENS", 16384))
+)
+# Rows of a merged forward pass, the router's `--max-batch-requests` by default so
+# that merged batches keep the shapes the router warmed up. 0 for no limit
+BATCH_MERGE_MAX_ROWS = int(
+    os.getenv("BATCH_MERGE_MAX_ROWS", os.getenv("MAX_BATCH_REQUESTS", 0))
+)
+# Overlap batch preparation, model forward and response serialization
+INFERENCE_PIPELINE = os.getenv("INFERENCE_PIPELINE", "false").lower() in ["true", "1"]
+# Run identical rows of a batch once. Defaults to off on HPU where the warmup relies
+# on batches of identical rows to capture graphs of every batch size
+BATCH_DEDUP = os.getenv("BATCH_DEDUP")
+# Split padded batches into micro-batches of similar lengths. Defaults to on for
+# models running padded batches, except on HPU where graphs are captured per shape
+MICRO_BATCH_PLANNER = os.getenv("MICRO_BATCH_PLANNER")
+
+_thread_state = threading.local()
+
+
+def enter_inference_mode():
+    # `torch._C._InferenceMode` is thread local: keep a guard alive for the whole
+    # lifetime of the inference thread
+    _thread_state.inference_mode_guard = torch._C._InferenceMode(True)
+
+
+def set_results(requests: List["_Request"], responses: List):
+    for request, response in zip(requests, responses):
+        if not request.future.done():
+            request.future.set_result(response)
+
+
+def set_exception(requests: List["_Request"], err: Exception):
+    for request in requests:
+        if not request.future.done():
+            request.future.set_exception(err)
+
+
+@dataclass
+class _Request:
+    method: str
+    pb: embed_pb2.EmbedRequest
+    num_tokens: int
+    num_rows: int
+    future: asyncio.Future
+    context: contextvars.Context
+
+
+@dataclass
+class PreparedBatch:
+    # Forward passes to run, one per micro-batch. Empty when every row was served
+    # from the cache
+    batches: List[Batch]
+    lookup: Optional[CacheLookup] = None
+    # Row of the computed results for every row of the merged request
+    inverse: Optional[torch.Tensor] = None
+    # Rows of every batch before padding to a bucket
+    num_rows: List[int] = field(default_factory=list)
+    # Row of the concatenated micro-batch results for every computed row
+    order: Optional[torch.Tensor] = None
+    # Merged request of `lookup`, to recompute the rows another batch stalls on
+    pb: Optional[embed_pb2.EmbedRequest] = None
+
+
+def dedup_rows(pb: embed_pb2.EmbedRequest) -> Tuple[List[int], List[int]]:
+    """Rows of `pb` with unique tokens and, for every row, its unique row index"""
+    unique = {}
+    unique_rows = []
+    inverse = []
+    for row, key in enumerate(sequence_keys(pb, b"")):
+        index = unique.get(key)
+        if index is None:
+            index = unique[key] = len(unique_rows)
+            unique_rows.append(row)
+        inverse.append(index)
+    return unique_rows, inverse
+
+
+class InferenceExecutor:
+    """
+    Runs the model on a dedicated thread so the event loop stays responsive.
+
+    RPCs arriving while a forward pass is running are queued and merged into the
+    next forward pass, up to `max_batch_tokens`, then the results are split back
+    per RPC. With a `cache`, rows already computed are removed before padding.
+    Padded batches are split into micro-batches of similar lengths, or padded to
+    the static shapes of `buckets`.
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        max_batch_tokens: int = BATCH_MERGE_MAX_TOKENS,
+        max_batch_rows: int = BATCH_MERGE_MAX_ROWS,
+        pipeline: bool = INFERENCE_PIPELINE,
+        cache: Optional[EmbeddingCache] = None,
+        dedup: Optional[bool] = None,
+        plan: Optional[bool] = None,
+        buckets: Optional[BucketSet] = None,
+    ):
+        self.model = model
+        self.cache = cache
+        if dedup is None:
+            dedup = (
+                BATCH_DEDUP.lower() in ["true", "1"]
+                if BATCH_DEDUP is not None
+                else model.device.type != "hpu"
+            )
+        # The cache already runs identical rows once
+        self.dedup = dedup and cache is None
+        self._dedup_rows_saved = meter.create_counter(
+            "tei_python_batch_dedup_rows_saved",
+            description="Duplicate rows of a batch not run through the model",
+        )
+        if plan is None:
+            plan = (
+                MICRO_BATCH_PLANNER.lower() in ["true", "1"]
+                if MICRO_BATCH_PLANNER is not None
+                else model.device.type != "hpu"
+            )
+        self.plan = plan and model.batch_type is PaddedBatch
+        if buckets is None and model.batch_type in [PaddedBatch, PackedBatch]:
+            buckets = BucketSet.default(model.device, model.max_input_length)
+        self.buckets = buckets
+        # Lengths served, saved on shutdown to learn buckets from
+        self.length_histogram = Counter() if STATIC_SHAPE_HISTOGRAM else None
+        self._real_tokens = meter.create_counter(
+            "tei_python_batch_real_tokens",
+            description="Tokens of the rows run through the model",
+        )
+        self._padded_tokens = meter.create_counter(
+            "tei_python_batch_padded_tokens",
+            description="Tokens of padded batches, without and with micro-batches",
+        )
+        self.max_batch_tokens = max_batch_tokens
+        # Merged batches never exceed the largest static batch either
+        if self.buckets is not None and self.buckets.max_batch_size is not None:
+            max_batch_rows = min(
+                max_batch_rows or self.buckets.max_batch_size,
+                self.buckets.max_batch_size,
+            )
+        self.max_batch_rows = max_batch_rows
+        self.pipeline = None
+        if pipeline:
+            from text_embeddings_server.utils.pipeline import InferencePipeline
+
+            self.pipeline = InferencePipeline(self)
+        self._queue: Optional[asyncio.Queue] = None
+        # Request that did not fit in the previous merged batch
+        self._pending: Optional[_Request] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="inference",
+            initializer=enter_inference_mode,
+        )
+
+    def start(self):
+        """Start the batching loop. Must be called from the running event loop"""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._batching_loop())
+
+    async def embed(self, pb: embed_pb2.EmbedRequest) -> embed_pb2.EmbedResponse:
+        return await self._submit("embed", pb)
+
+    async def predict(self, pb: embed_pb2.EmbedRequest) -> embed_pb2.PredictResponse:
+        return await self._submit("predict", pb)
+
+    async def _submit(self, method: str, pb: embed_pb2.EmbedRequest):
+        # Rejected before merging, so that it does not fail the RPCs merged with it
+        if pb.max_length > self.model.max_input_length:
+            raise RuntimeError("input length exceeds model config's max_input_length")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(
+            _Request(
+                method=method,
+                pb=pb,
+                num_tokens=pb.cu_seq_lengths[-1],
+                num_rows=len(pb.cu_seq_lengths) - 1,
+                future=future,
+                context=contextvars.copy_context(),
+            )
+        )
+        return await future
+
+    async def _next_batch(self) -> List[_Request]:
+        first = self._pending or await self._queue.get()
+        self._pending = None
+
+        requests = [first]
+        num_tokens = first.num_tokens
+        num_rows = first.num_rows
+        while not self._queue.empty():
+            request = self._queue.get_nowait()
+            if (
+                request.method != first.method
+                or num_tokens + request.num_tokens > self.max_batch_tokens
+                or self.max_batch_rows
+                and num_rows + request.num_rows > self.max_batch_rows
+            ):
+                self._pending = request
+                break
+            requests.append(request)
+            num_tokens += request.num_tokens
+            num_rows += request.num_rows
+
+        return requests
+
+    async def _batching_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = []
+            try:
+                requests = await self._next_batch()
+                requests = [r for r in requests if not r.future.cancelled()]
+                if not requests:
+                    continue
+
+                if self.pipeline is not None:
+                    # Returns as soon as the prepare stage has room for the batch
+                    await loop.run_in_executor(
+                        None, self.pipeline.submit, requests, loop
+                    )
+                    continue
+
+                await self._run_merged(requests, loop)
+            except Exception as err:
+                # Keep serving: only the RPCs of this batch fail
+                logger.exception("Batching loop failed")
+                set_exception(requests, err)
+
+    async def _run_merged(self, requests: List[_Request], loop):
+        try:
+            # Trace the merged forward pass under the first RPC's span
+            responses = await loop.run_in_executor(
+                self._thread, requests[0].context.run, self.run, requests
+            )
+        except Exception as err:
+            if len(requests) == 1:
+                set_exception(requests, err)
+                return
+            # Run the merged RPCs one by one so that only the failing ones fail
+            logger.warning(f"Merged forward pass failed, retrying per RPC: {err}")
+            for request in requests:
+                try:
+                    responses = await loop.run_in_executor(
+                        self._thread, request.context.run, self.run, [request]
+                    )
+                except Exception as request_err:
+                    set_exception([request], request_err)
+                    continue
+                set_results([request], responses)
+            return
+        set_results(requests, responses)
+
+    @tracer.start_as_current_span("run")
+    def run(
+        self, requests: List[_Request]
+    ) -> List[Union[embed_pb2.EmbedResponse, embed_pb2.PredictResponse]]:
+        prepared = self.prepare(requests)
+        results = self.compute(requests[0].method, prepared)
+        return self.serialize(requests, results)
+
+    @tracer.start_as_current_span("prepare")
+    def prepare(
+        self, requests: List[_Request], pin_memory: bool = False
+    ) -> PreparedBatch:
+        span = trace.get_current_span()
+        span.set_attribute("merged_requests", len(requests))
+
+        pb = concat_requests([request.pb for request in requests])
+        if len(requests) > 1:
+            logger.debug(f"Merged {len(requests)} requests into one forward pass")
+
+        lookup = None
+        inverse = None
+        if self.dedup:
+            unique_rows, inverse = dedup_rows(pb)
+            rows_saved = len(inverse) - len(unique_rows)
+            span.set_attribute("dedup_rows_saved", rows_saved)
+            if rows_saved:
+                self._dedup_rows_saved.add(rows_saved)
+                pb = select_rows(pb, unique_rows)
+                inverse = torch.tensor(inverse, dtype=torch.int64)
+            else:
+                inverse = None
+        elif self.cache is not None:
+            lookup = self.cache.lookup(pb, requests[0].method)
+            span.set_attribute("cache_misses", len(lookup.miss_rows))
+            if not lookup.miss_rows:
+                return PreparedBatch(batches=[], lookup=lookup, pb=pb)
+
+        # From here on, a failure must release the rows owned by the lookup
+        try:
+            miss_pb = pb
+            if lookup is not None and len(lookup.miss_rows) < lookup.num_rows:
+                miss_pb = select_rows(pb, lookup.miss_rows)
+            if self.length_histogram is not None:
+                cu = miss_pb.cu_seq_lengths
+                self.length_histogram.update(
+                    end - start for start, end in zip(cu, cu[1:])
+                )
+            prepared = self.batch_rows(miss_pb, pin_memory)
+        except Exception as err:
+            if lookup is not None:
+                self.cache.abort(lookup, err)
+            raise
+
+        prepared.lookup = lookup
+        prepared.inverse = inverse
+        if lookup is not None:
+            prepared.pb = pb
+        return prepared
+
+    def batch_rows(
+        self, pb: embed_pb2.EmbedRequest, pin_memory: bool = False
+    ) -> PreparedBatch:
+        """Batches of the rows of `pb`: padded to buckets or split in micro-batches"""
+        cu = pb.cu_seq_lengths
+        lengths = [end - start for start, end in zip(cu, cu[1:])]
+        if self.buckets is not None:
+            parts = self.bucket_batches(lengths)
+        elif self.plan:
+            parts = self.plan_batches(lengths)
+        else:
+            parts = [(None, None)]
+        batches = []
+        for rows, shape in parts:
+            kwargs = {"shape": shape} if shape is not None else {}
+            batches.append(
+                self.model.batch_type.from_pb(
+                    select_rows(pb, rows) if len(parts) > 1 else pb,
+                    self.model.device,
+                    self.model.max_input_length,
+                    pin_memory=pin_memory,
+                    **kwargs,
+                )
+            )
+
+        order = None
+        if len(parts) > 1:
+            # Results come back grouped by batch
+            order = torch.empty(len(lengths), dtype=torch.int64)
+            order[[row for rows, _ in parts for row in rows]] = torch.arange(
+                len(lengths)
+            )
+        return PreparedBatch(
+            batches=batches,
+            num_rows=[len(rows) if rows else len(lengths) for rows, _ in parts],
+            order=order,
+        )
+
+    def bucket_batches(
+        self, lengths: List[int]
+    ) -> List[Tuple[List[int], Tuple[int, int]]]:
+        """Rows and static shape of the batches of rows of the given lengths"""
+        if self.model.batch_type is PackedBatch:
+            parts = self.buckets.split_packed(lengths)
+        else:
+            parts = self.buckets.split(lengths)
+        span = trace.get_current_span()
+        span.set_attribute("bucket_shapes", [str(shape) for _, shape in parts])
+        return parts
+
+    def plan_batches(
+        self, lengths: List[int]
+    ) -> List[Tuple[Optional[List[int]], None]]:
+        """Rows of the micro-batches of rows of the given lengths, None for all rows"""
+        plan = plan_micro_batches(lengths)
+
+        span = trace.get_current_span()
+        span.set_attribute("micro_batches", len(plan.groups))
+        span.set_attribute("real_tokens", plan.real_tokens)
+        span.set_attribute("padded_tokens_before", plan.padded_tokens_before)
+        span.set_attribute("padded_tokens_after", plan.padded_tokens_after)
+        self._real_tokens.add(plan.real_tokens)
+        self._padded_tokens.add(plan.padded_tokens_before, {"planned": False})
+        self._padded_tokens.add(plan.padded_tokens_after, {"planned": True})
+
+        if len(plan.groups) == 1:
+            return [(None, None)]
+        logger.debug(
+            f"Split {len(lengths)} rows into {len(plan.groups)} micro-batches: "
+            f"{plan.padded_tokens_before} -> {plan.padded_tokens_after} padded tokens "
+            f"for {plan.real_tokens} tokens"
+        )
+        return [(group, None) for group in plan.groups]
+
+    def compute(self, method: str, prepared: PreparedBatch) -> Optional[torch.Tensor]:
+        """Results of every row, None when the model does not implement `method`"""
+        try:
+            results = None
+            if prepared.batches:
+                results = self.run_batches(method, prepared)
+                if results is None:
+                    if prepared.lookup is not None:
+                        self.cache.release(prepared.lookup)
+                    return None
+            if prepared.lookup is not None:
+                results = self.cache.complete(
+                    prepared.lookup,
+                    method,
+                    results,
+                    recompute=lambda rows: self.run_batches(
+                        method, self.batch_rows(select_rows(prepared.pb, rows))
+                    ),
+                )
+                if results is None:
+                    return None
+            if prepared.inverse is not None:
+                results = results.index_select(
+                    0, prepared.inverse.to(results.device, non_blocking=True)
+                )
+        except Exception as err:
+            # Do not leave other batches waiting on rows this batch owned
+            if prepared.lookup is not None:
+                self.cache.abort(prepared.lookup, err)
+            raise
+        return results
+
+    def run_batches(
+        self, method: str, prepared: PreparedBatch
+    ) -> Optional[torch.Tensor]:
+        """
+        Outputs of the batches of `prepared` in the order of its rows, None when the
+        model does not implement `method`
+        """
+        forward = self.model.embed if method == "embed" else self.model.predict
+        outputs = [forward(batch) for batch in prepared.batches]
+        if any(output is None for output in outputs):
+            return None
+        results = [
+            # Drop the rows padding a batch to its bucket
+            output[:num_rows]
+            for output, num_rows in zip(outputs, prepared.num_rows)
+        ]
+        results = results[0] if len(results) == 1 else torch.cat(results)
+        if prepared.order is not None:
+            results = results.index_select(
+                0, prepared.order.to(results.device, non_blocking=True)
+            )
+        return results
+
+    @tracer.start_as_current_span("serialize")
+    def serialize(
+        self, requests: List[_Request], results: Optional[torch.Tensor]
+    ) -> List[Union[embed_pb2.EmbedResponse, embed_pb2.PredictResponse]]:
+        if results is None:
+            # Empty responses, as for models returning nothing
+            empty = (
+                embed_pb2.EmbedResponse
+                if requests[0].method == "embed"
+                else embed_pb2.PredictResponse
+            )
+            return [empty() for _ in requests]
+
+        to_response = (
+            to_embed_response if requests[0].method == "embed" else to_predict_response
+        )
+        responses = []
+        offset = 0
+        for request in requests:
+            num_rows = len(request.pb.cu_seq_lengths) - 1
+            responses.append(
+                to_response(results[offset : offset + num_rows], request.pb)
+            )
+            offset += num_rows
+        return responses
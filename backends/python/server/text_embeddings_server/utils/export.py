@@ -0,0 +1,188 @@
+import json
+import os
+import time
+import torch
+
+from loguru import logger
+from pathlib import Path
+from safetensors.torch import load_file, save_file
+from typing import Dict, List, Tuple
+
+from text_embeddings_server.models import Model, get_model
+from text_embeddings_server.models.types import PaddedBatch, encode_request
+from text_embeddings_server.utils.buckets import BucketSet
+from text_embeddings_server.utils.compile import METHODS
+from text_embeddings_server.utils.fingerprint import model_fingerprint
+
+# Bumped when the package layout changes: older packages are not loaded
+EXPORT_FORMAT_VERSION = 1
+# Minimum cosine similarity between the packaged and eager outputs of the probe
+EXPORT_PARITY_MIN_COSINE = float(os.getenv("EXPORT_PARITY_MIN_COSINE", 0.999))
+
+MANIFEST = "manifest.json"
+PROBE = "probe.safetensors"
+INPUTS = ["input_ids", "token_type_ids", "position_ids", "attention_mask"]
+
+
+def package_dir(model_path: Path, dtype: str, pool: str, device: torch.device) -> Path:
+    """Directory of the packages exported from the weights of `model_path`"""
+    fingerprint = model_fingerprint(model_path, dtype)
+    name = f"v{EXPORT_FORMAT_VERSION}-{device.type}-{dtype}-{pool}-{fingerprint[:16]}"
+    return model_path / "aoti" / name
+
+
+def package_file(method: str, shape: Tuple[int, int]) -> str:
+    return f"{method}-{shape[0]}x{shape[1]}.pt2"
+
+
+class BatchForward(torch.nn.Module):
+    """`embed` or `predict` of a padded batch model, on the tensors of the batch"""
+
+    def __init__(self, model: Model, method: str):
+        super().__init__()
+        self.forward_batch = getattr(model, method)
+
+    def forward(self, input_ids, token_type_ids, position_ids, attention_mask):
+        return self.forward_batch(
+            PaddedBatch(input_ids, token_type_ids, position_ids, attention_mask)
+        )
+
+
+def probe_batch(model: Model, batch_size: int, seq_len: int) -> PaddedBatch:
+    """Padded batch of random tokens and lengths, the same on every run"""
+    generator = torch.Generator().manual_seed(0)
+    lengths = torch.randint(1, seq_len + 1, (batch_size,), generator=generator)
+    # Low ids exist in every vocabulary
+    tokens = torch.zeros((3, int(lengths.sum())), dtype=torch.int32)
+    tokens[0] = torch.randint(1000, (tokens.size(1),), generator=generator)
+    tokens[2] = torch.cat([torch.arange(length) for length in lengths.tolist()])
+    cu_seq_lengths = [0] + lengths.cumsum(0).tolist()
+    pb = encode_request(tokens, cu_seq_lengths, int(lengths.max()))
+    return PaddedBatch.from_pb(
+        pb, model.device, model.max_input_length, shape=(batch_size, seq_len)
+    )
+
+
+def check_parity(expected: torch.Tensor, output: torch.Tensor, name: str):
+    """Raise when `output` drifts from the eager `expected` output"""
+    cosine = torch.nn.functional.cosine_similarity(
+        output.float().flatten(1), expected.float().flatten(1).to(output.device)
+    ).min()
+    if cosine < EXPORT_PARITY_MIN_COSINE:
+        raise RuntimeError(
+            f"{name} drifts from eager: cosine similarity {cosine:.6f} < "
+            f"{EXPORT_PARITY_MIN_COSINE}"
+        )
+    logger.info(f"{name} matches eager: cosine similarity {cosine:.6f}")
+
+
+def export_model(model_path: Path, dtype: str, pool: str) -> Path:
+    """
+    Export `embed` and `predict` of the model of `model_path` with `torch.export`
+    and compile them ahead of time with AOTInductor, one package per static shape
+    bucket.
+
+    The packages are written next to the weights with a manifest of the buckets
+    and a probe batch whose eager outputs are checked against the packages on load.
+    """
+    model = get_model(model_path, dtype, pool)
+    if model.device.type == "hpu":
+        raise RuntimeError("AOTInductor packages are not supported on HPU")
+    if model.quantize is not None:
+        raise RuntimeError(f"{model.quantize} models cannot be exported")
+    if model.batch_type is not PaddedBatch:
+        raise RuntimeError(
+            f"{type(model).__name__} does not run padded batches: cannot export"
+        )
+
+    buckets = BucketSet.default(model.device, model.max_input_length, static=True)
+    shapes = buckets.shapes()
+    seq_lens = sorted({seq_len for _, seq_len in shapes})
+    batch_sizes = sorted({batch_size for batch_size, _ in shapes})
+
+    output_dir = package_dir(model_path, dtype, pool, model.device)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    probe = probe_batch(model, batch_sizes[-1], seq_lens[0])
+    tensors = {name: getattr(probe, name).cpu() for name in INPUTS}
+    methods: Dict[str, List[dict]] = {}
+
+    start = time.perf_counter()
+    for method in METHODS:
+        expected = getattr(model, method)(probe)
+        if expected is None:
+            # Method not implemented by this model
+            continue
+        tensors[method] = expected.cpu()
+        module = BatchForward(model, method)
+
+        methods[method] = []
+        for batch_size, seq_len in shapes:
+            batch = probe_batch(model, batch_size, seq_len)
+            args = tuple(getattr(batch, name) for name in INPUTS)
+            file_name = package_file(method, (batch_size, seq_len))
+
+            export_start = time.perf_counter()
+            exported = torch.export.export(module, args, strict=False)
+            torch._inductor.aoti_compile_and_package(
+                exported, args, {}, package_path=str(output_dir / file_name)
+            )
+            logger.info(
+                f"Exported {method} for shape ({batch_size}, {seq_len}) in "
+                f"{time.perf_counter() - export_start:.1f}s"
+            )
+            methods[method].append({"shape": [batch_size, seq_len], "file": file_name})
+
+    save_file(tensors, str(output_dir / PROBE))
+    manifest = {
+        "version": EXPORT_FORMAT_VERSION,
+        "torch": torch.__version__,
+        "model": type(model).__name__,
+        "device": model.device.type,
+        "dtype": dtype,
+        "pool": pool,
+        "max_input_length": model.max_input_length,
+        "seq_lens": seq_lens,
+        "batch_sizes": batch_sizes,
+        "methods": methods,
+        "probe": PROBE,
+    }
+    with open(output_dir / MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info(
+        f"Exported {len(shapes)} shapes to {output_dir} in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+    return output_dir
+
+
+def load_manifest(output_dir: Path, device: torch.device) -> dict:
+    """Manifest of the packages of `output_dir`, if they run on this install"""
+    manifest_path = output_dir / MANIFEST
+    if not manifest_path.exists():
+        raise FileNotFoundError(
+            f"No exported model in {output_dir}: run `text-embeddings-server export`"
+        )
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    # AOTInductor packages are native code built against one torch release
+    if manifest["torch"] != torch.__version__:
+        raise RuntimeError(
+            f"{output_dir} was exported with torch {manifest['torch']}, "
+            f"running torch {torch.__version__}: export the model again"
+        )
+    if manifest["device"] != device.type:
+        raise RuntimeError(
+            f"{output_dir} was exported for {manifest['device']}, running on "
+            f"{device.type}"
+        )
+    return manifest
+
+
+def load_probe(output_dir: Path, manifest: dict, device: torch.device):
+    """Probe batch of the export and the eager outputs of every method"""
+    tensors = load_file(str(output_dir / manifest["probe"]))
+    batch = PaddedBatch(*(tensors[name].to(device) for name in INPUTS))
+    return batch, {method: tensors[method] for method in manifest["methods"]}
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import struct
+
+from pathlib import Path
+
+# Weight data sampled per file on top of the safetensors header
+SAMPLED_BLOCKS = 16
+SAMPLED_BLOCK_SIZE = 64 * 1024
+
+WEIGHT_PATTERNS = ["*.safetensors", "*.bin"]
+
+
+def _hash_weight_file(hasher, path: Path):
+    stat = path.stat()
+    size = stat.st_size
+    hasher.update(path.name.encode())
+    # Sampling misses changes outside of the sampled blocks: any rewrite of the file
+    # changes the fingerprint through its modification time
+    hasher.update(struct.pack("<QQ", size, stat.st_mtime_ns))
+
+    with open(path, "rb") as f:
+        data_start = 0
+        if path.suffix == ".safetensors":
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            # Tensor names, dtypes, shapes and offsets
+            hasher.update(f.read(header_size))
+            data_start = 8 + header_size
+
+        # Headers are identical for fine-tunes of the same architecture: also sample
+        # the weights themselves, without reading multi GB files entirely
+        data_size = size - data_start
+        step = max(data_size // SAMPLED_BLOCKS, 1)
+        for offset in range(data_start, size, step):
+            f.seek(offset)
+            hasher.update(f.read(SAMPLED_BLOCK_SIZE))
+
+
+def model_fingerprint(model_path: Path, dtype: str) -> str:
+    """Hex digest identifying the weights in `model_path` and the dtype they run in"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(dtype.encode())
+
+    config_path = model_path / "config.json"
+    if config_path.exists():
+        with open(config_path, "r") as f:
+            hasher.update(json.dumps(json.load(f), sort_keys=True).encode())
+
+    weight_files = sorted(
+        {path for pattern in WEIGHT_PATTERNS for path in model_path.glob(pattern)}
+    )
+    for path in weight_files:
+        _hash_weight_file(hasher, path)
+    return hasher.hexdigest()
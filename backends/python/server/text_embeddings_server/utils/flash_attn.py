@@ -1,60 +1,73 @@
 import os
 import torch
+import torch.nn.functional as F
 from text_embeddings_server.utils.device import use_ipex, is_hpu
 
 from loguru import logger
+from text_embeddings_server.models.pooling import segment_ids
+from text_embeddings_server.utils.attention_mask import BLOCK_DIAGONAL_MAX_TOKENS
 
 if os.getenv("USE_FLASH_ATTENTION", "").lower() == "false":
     raise ImportError("`USE_FLASH_ATTENTION` is false.")
 
 HAS_FLASH_ATTN = False
 HAS_FLASH_ATTN_V2 = False
+# Pure PyTorch backend used when no accelerator kernel is available
+HAS_SDPA_VARLEN = False
 
 is_hpu = is_hpu()
 use_ipex = use_ipex()
 
 if use_ipex or is_hpu:
     HAS_FLASH_ATTN_V2 = True
+elif not torch.cuda.is_available():
+    HAS_SDPA_VARLEN = True
 else:
-    if not torch.cuda.is_available():
-        raise ImportError("CUDA is not available")
-
-    major, minor = torch.cuda.get_device_capability()
-    is_sm75 = major == 7 and minor == 5
-    is_sm8x = major == 8 and minor >= 0
-    is_sm90 = major == 9 and minor == 0
-
     try:
+        major, minor = torch.cuda.get_device_capability()
+        is_sm75 = major == 7 and minor == 5
+        is_sm8x = major == 8 and minor >= 0
+        is_sm90 = major == 9 and minor == 0
+
         try:
-            import flash_attn_2_cuda
-        except ImportError:
-            raise ImportError(
-                "Flash Attention V2 is not installed.\n"
-                "Use the official Docker image (ghcr.io/huggingface/text-generation-inference:latest) "
-                "or install flash attention v2 with `cd server && make install install-flash-attention-v2`"
-            )
-        if not (is_sm8x or is_sm90):
-            raise ImportError(
-                f"GPU with CUDA capability {major} {minor} is not supported for "
-                "Flash Attention V2"
-            )
-        HAS_FLASH_ATTN_V2 = True
+            try:
+                import flash_attn_2_cuda
+            except ImportError:
+                raise ImportError(
+                    "Flash Attention V2 is not installed.\n"
+                    "Use the official Docker image (ghcr.io/huggingface/text-generation-inference:latest) "
+                    "or install flash attention v2 with `cd server && make install install-flash-attention-v2`"
+                )
+            if not (is_sm8x or is_sm90):
+                raise ImportError(
+                    f"GPU with CUDA capability {major} {minor} is not supported for "
+                    "Flash Attention V2"
+                )
+            HAS_FLASH_ATTN_V2 = True
+        except ImportError as e:
+            try:
+                import flash_attn_cuda
+            except ImportError:
+                raise ImportError(
+                    "Flash Attention is not installed.\n"
+                    "Use the official Docker image (ghcr.io/huggingface/text-generation-inference:latest) "
+                    "or install flash attention with `cd server && make install install-flash-attention`"
+                ) from e
+
+            if not (is_sm75 or is_sm8x or is_sm90):
+                raise ImportError(
+                    f"GPU with CUDA capability {major} {minor} is not supported"
+                ) from e
+            logger.warning(f"Unable to use Flash Attention V2: {e}")
+            HAS_FLASH_ATTN = True
     except ImportError as e:
-        try:
-            import flash_attn_cuda
-        except ImportError:
-            raise ImportError(
-                "Flash Attention is not installed.\n"
-                "Use the official Docker image (ghcr.io/huggingface/text-generation-inference:latest) "
-                "or install flash attention with `cd server && make install install-flash-attention`"
-            ) from e
-
-        if not (is_sm75 or is_sm8x or is_sm90):
-            raise ImportError(
-                f"GPU with CUDA capability {major} {minor} is not supported"
-            ) from e
-        logger.warning(f"Unable to use Flash Attention V2: {e}")
-        HAS_FLASH_ATTN = True
+        logger.warning(f"Using PyTorch SDPA varlen attention: {e}")
+        HAS_SDPA_VARLEN = True
+
+
+def supports_packed_batches() -> bool:
+    """Whether `attention` applies the block-diagonal masks of packed batches"""
+    return is_hpu or HAS_SDPA_VARLEN
 
 
 def hpu_attn(
@@ -86,6 +99,68 @@ def hpu_attn(
     return out
 
 
+def block_diagonal_mask(
+    cu_seqlens: torch.Tensor, total: int, is_causal: bool = False
+) -> torch.Tensor:
+    """Boolean [total, total] mask letting tokens attend within their segment"""
+    ids = segment_ids(cu_seqlens, total)
+    mask = ids[:, None] == ids[None, :]
+    if is_causal:
+        mask = mask.tril()
+    return mask
+
+
+def sdpa_varlen_attn(
+    q, k, v, out, cu_seqlens, max_s, softmax_scale, is_causal=False, attn_mask=None
+):
+    if q.dim() == 4:
+        # Padded [batch, seq, heads, head_size] layout with an additive mask
+        out_ = F.scaled_dot_product_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            attn_mask=None if is_causal else attn_mask,
+            is_causal=is_causal,
+            scale=softmax_scale,
+            enable_gqa=k.size(2) != q.size(2),
+        )
+        out.copy_(out_.transpose(1, 2))
+        return out
+
+    # Packed [total_tokens, heads, head_size] layout: [heads, total_tokens, head_size]
+    q, k, v = q.transpose(0, 1), k.transpose(0, 1), v.transpose(0, 1)
+    enable_gqa = k.size(0) != q.size(0)
+    total = q.size(1)
+    if cu_seqlens.numel() == 2 or total <= BLOCK_DIAGONAL_MAX_TOKENS:
+        out_ = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=(
+                block_diagonal_mask(cu_seqlens, total, is_causal)
+                if cu_seqlens.numel() > 2
+                else None
+            ),
+            is_causal=is_causal and cu_seqlens.numel() == 2,
+            scale=softmax_scale,
+            enable_gqa=enable_gqa,
+        )
+        out.copy_(out_.transpose(0, 1))
+        return out
+
+    bounds = cu_seqlens.tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        out[start:end] = F.scaled_dot_product_attention(
+            q[:, start:end],
+            k[:, start:end],
+            v[:, start:end],
+            is_causal=is_causal,
+            scale=softmax_scale,
+            enable_gqa=enable_gqa,
+        ).transpose(0, 1)
+    return out
+
+
 def attention(
     q, k, v, out, cu_seqlens, max_s, softmax_scale, is_causal=False, attn_mask=None
 ):
@@ -183,4 +258,17 @@ def attention(
             None,
         )
 
+    if HAS_SDPA_VARLEN:
+        return sdpa_varlen_attn(
+            q,
+            k,
+            v,
+            out,
+            cu_seqlens,
+            max_s,
+            softmax_scale,
+            is_causal=is_causal,
+            attn_mask=attn_mask,
+        )
+
     raise NotImplementedError("flash attention is not installed")
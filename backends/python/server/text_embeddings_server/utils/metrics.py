@@ -0,0 +1,19 @@
+from opentelemetry import metrics
+
+
+def setup_metrics(otlp_endpoint: str, otlp_service_name: str):
+    """Export the server metrics (`metrics.get_meter(__name__)` instruments) over OTLP"""
+    from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import (
+        OTLPMetricExporter,
+    )
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+    from opentelemetry.sdk.resources import Resource
+
+    resource = Resource.create(attributes={"service.name": otlp_service_name})
+    metric_reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(endpoint=otlp_endpoint, insecure=True)
+    )
+    metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=[metric_reader])
+    )
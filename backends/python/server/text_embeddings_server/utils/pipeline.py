@@ -0,0 +1,185 @@
+import os
+import queue
+import threading
+import time
+import torch
+
+from dataclasses import dataclass, field, fields
+from loguru import logger
+from opentelemetry import metrics
+from typing import Dict, List, Optional
+
+from text_embeddings_server.utils.executor import (
+    enter_inference_mode,
+    set_exception,
+    set_results,
+)
+
+meter = metrics.get_meter(__name__)
+
+# Maximum number of batches waiting in front of each stage
+INFERENCE_PIPELINE_DEPTH = int(os.getenv("INFERENCE_PIPELINE_DEPTH", 1))
+
+STAGES = ["prepare", "compute", "serialize"]
+
+
+@dataclass
+class _Job:
+    requests: List
+    loop: object
+    batch: Optional[object] = None
+    results: Optional[torch.Tensor] = None
+    responses: Optional[List] = None
+    # Set by the prepare stage when the host to device copy runs on a side stream
+    copy_done: Optional[object] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class InferencePipeline:
+    """
+    Three stage pipeline overlapping the CPU work of neighbouring batches with the
+    model forward:
+
+        prepare:   merge + decode the requests, build the batch and stage it on the
+                   device (pinned memory + side stream on CUDA)
+        compute:   model forward and pooling
+        serialize: build the response protobufs
+
+    While batch N is in the model, batch N+1 is prepared and batch N-1 serialized.
+    Every stage runs on its own thread and stages are connected by bounded queues
+    (`INFERENCE_PIPELINE_DEPTH`) for back pressure.
+    """
+
+    def __init__(self, executor, depth: int = INFERENCE_PIPELINE_DEPTH):
+        self.executor = executor
+        self.device = executor.model.device
+        self.queues = {stage: queue.Queue(maxsize=depth) for stage in STAGES}
+        self.copy_stream = (
+            torch.cuda.Stream(device=self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+
+        self.stage_count = {stage: 0 for stage in STAGES}
+        self.stage_seconds = {stage: 0.0 for stage in STAGES}
+        self._stage_duration = meter.create_histogram(
+            "tei_python_pipeline_stage_duration",
+            unit="s",
+            description="Time spent by a batch in each pipeline stage",
+        )
+        meter.create_observable_gauge(
+            "tei_python_pipeline_queue_depth",
+            callbacks=[self._observe_queue_depths],
+            description="Batches waiting in front of each pipeline stage",
+        )
+
+        self._stage_fns = {
+            "prepare": self._prepare,
+            "compute": self._compute,
+            "serialize": self._serialize,
+        }
+        for i, stage in enumerate(STAGES):
+            next_stage = STAGES[i + 1] if i + 1 < len(STAGES) else None
+            threading.Thread(
+                target=self._stage_loop,
+                args=(stage, next_stage),
+                name=f"pipeline-{stage}",
+                daemon=True,
+            ).start()
+
+    def submit(self, requests: List, loop):
+        """Queue a merged batch. Blocks while the prepare stage is full"""
+        self.queues["prepare"].put(_Job(requests=requests, loop=loop))
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {stage: q.qsize() for stage, q in self.queues.items()}
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per stage queue depth, processed batches and mean latency in seconds"""
+        depths = self.queue_depths()
+        return {
+            stage: {
+                "queue_depth": depths[stage],
+                "batches": self.stage_count[stage],
+                "mean_seconds": self.stage_seconds[stage]
+                / max(1, self.stage_count[stage]),
+            }
+            for stage in STAGES
+        }
+
+    def _observe_queue_depths(self, options):
+        return [
+            metrics.Observation(depth, {"stage": stage})
+            for stage, depth in self.queue_depths().items()
+        ]
+
+    def _stage_loop(self, stage: str, next_stage: Optional[str]):
+        enter_inference_mode()
+        stage_fn = self._stage_fns[stage]
+        while True:
+            job = self.queues[stage].get()
+            start = time.perf_counter()
+            try:
+                # Trace every stage under the first RPC's span
+                job.requests[0].context.run(stage_fn, job)
+            except Exception as err:
+                if len(job.requests) == 1:
+                    logger.exception(f"Pipeline stage {stage} failed")
+                    job.loop.call_soon_threadsafe(set_exception, job.requests, err)
+                    continue
+                # Run the merged RPCs one by one so that only the failing ones fail
+                logger.warning(
+                    f"Merged batch failed in pipeline stage {stage}, retrying per "
+                    f"RPC: {err}"
+                )
+                job.loop.call_soon_threadsafe(self._retry_per_request, job)
+                continue
+
+            elapsed = time.perf_counter() - start
+            job.timings[stage] = elapsed
+            self.stage_count[stage] += 1
+            self.stage_seconds[stage] += elapsed
+            self._stage_duration.record(elapsed, {"stage": stage})
+
+            if next_stage is not None:
+                self.queues[next_stage].put(job)
+            else:
+                job.loop.call_soon_threadsafe(set_results, job.requests, job.responses)
+                logger.debug(f"Pipeline batch timings: {job.timings}")
+
+    def _retry_per_request(self, job: _Job):
+        # Submitting blocks while the prepare stage is full: not on a stage thread
+        job.loop.run_in_executor(None, self._submit_each, job.requests, job.loop)
+
+    def _submit_each(self, requests: List, loop):
+        for request in requests:
+            self.submit([request], loop)
+
+    def _prepare(self, job: _Job):
+        if self.copy_stream is None:
+            job.batch = self.executor.prepare(job.requests)
+            return
+
+        with torch.cuda.stream(self.copy_stream):
+            job.batch = self.executor.prepare(job.requests, pin_memory=True)
+            job.copy_done = torch.cuda.Event()
+            job.copy_done.record(self.copy_stream)
+
+    def _compute(self, job: _Job):
+        if job.copy_done is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(job.copy_done)
+            # The batch was allocated on the copy stream but is used on this one
+            for batch in job.batch.batches:
+                for batch_field in fields(batch):
+                    value = getattr(batch, batch_field.name)
+                    if isinstance(value, torch.Tensor):
+                        value.record_stream(compute_stream)
+
+        job.results = self.executor.compute(job.requests[0].method, job.batch)
+        # Release device inputs as soon as possible
+        job.batch = None
+
+    def _serialize(self, job: _Job):
+        job.responses = self.executor.serialize(job.requests, job.results)
+        job.results = None
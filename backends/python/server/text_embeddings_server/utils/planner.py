@@ -0,0 +1,63 @@
+import os
+
+from dataclasses import dataclass
+from typing import List
+
+# Padded tokens a split must save to be worth one more forward pass
+MICRO_BATCH_OVERHEAD_TOKENS = int(os.getenv("MICRO_BATCH_OVERHEAD_TOKENS", 1024))
+
+
+@dataclass
+class BatchPlan:
+    # Rows of every micro-batch, shortest rows first
+    groups: List[List[int]]
+    real_tokens: int
+    # Tokens of the forward passes once padded, as one batch and as planned
+    padded_tokens_before: int
+    padded_tokens_after: int
+
+
+def plan_micro_batches(
+    lengths: List[int], overhead_tokens: int = MICRO_BATCH_OVERHEAD_TOKENS
+) -> BatchPlan:
+    """
+    Split rows of the given lengths into micro-batches of similar lengths, each
+    padded to its own longest row.
+
+    The rows are sorted by length and cut into contiguous groups minimizing the
+    padded tokens of all groups plus `overhead_tokens` per group.
+    """
+    num_rows = len(lengths)
+    order = sorted(range(num_rows), key=lengths.__getitem__)
+    sorted_lengths = [lengths[row] for row in order]
+
+    # Only cut between rows of different lengths
+    cuts = [i for i in range(1, num_rows) if sorted_lengths[i] != sorted_lengths[i - 1]]
+    cuts.append(num_rows)
+
+    # cost[i]: cheapest plan of the `i` shortest rows, a group of rows [j, i)
+    # costs its padded tokens (i - j) * sorted_lengths[i - 1]
+    cost = {0: 0}
+    previous = {}
+    starts = [0]
+    for end in cuts:
+        width = sorted_lengths[end - 1]
+        best_start = min(starts, key=lambda start: cost[start] + (end - start) * width)
+        cost[end] = cost[best_start] + (end - best_start) * width + overhead_tokens
+        previous[end] = best_start
+        starts.append(end)
+
+    groups = []
+    end = num_rows
+    while end > 0:
+        start = previous[end]
+        groups.append(order[start:end])
+        end = start
+    groups.reverse()
+
+    return BatchPlan(
+        groups=groups,
+        real_tokens=sum(lengths),
+        padded_tokens_before=num_rows * max(lengths, default=0),
+        padded_tokens_after=sum(len(group) * lengths[group[-1]] for group in groups),
+    )
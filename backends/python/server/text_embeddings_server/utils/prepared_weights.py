@@ -0,0 +1,253 @@
+import hashlib
+import importlib.metadata
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+import torch
+
+from contextlib import contextmanager
+from loguru import logger
+from pathlib import Path
+from safetensors.torch import save_file
+from typing import Callable, Dict, Iterator, Optional, Union
+
+from text_embeddings_server.utils.fingerprint import model_fingerprint
+from text_embeddings_server.utils.weights import Weights
+
+# Directory of the prepared weights. Unset disables the cache
+PREPARED_WEIGHTS_CACHE = os.getenv("PREPARED_WEIGHTS_CACHE")
+
+WEIGHTS_FILE = "model.safetensors"
+MANIFEST_FILE = "manifest.json"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def server_version() -> str:
+    try:
+        return importlib.metadata.version("text-embeddings-server")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def load_mmap(path: Path) -> Dict[str, torch.Tensor]:
+    """Tensors of a safetensors file, backed by a private memory map of the file"""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        # Copy on write: pages stay shared with the page cache until written to
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if start == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - start) // dtype.itemsize,
+            offset=data_start + start,
+        ).view(info["shape"])
+    return tensors
+
+
+class PreparedWeights:
+    """
+    Weights of a model after every conversion done at load time (dtype casts,
+    fused projections...), saved next to a manifest on the first load and memory
+    mapped on the following ones.
+
+    The cache entry is keyed on the model fingerprint, dtype, device type, model
+    class and server version, so any change of those prepares the weights again.
+    """
+
+    def __init__(
+        self,
+        model_path: Path,
+        device: torch.device,
+        dtype: torch.dtype,
+        model_name: str,
+        cache_dir: str = PREPARED_WEIGHTS_CACHE,
+        prefetch: bool = True,
+    ):
+        self.model_path = model_path
+        self.device = device
+        self.dtype = dtype
+        self.prefetch = prefetch
+
+        self.manifest = {
+            "fingerprint": model_fingerprint(model_path, str(dtype)),
+            "dtype": str(dtype),
+            "device": device.type,
+            "model": model_name,
+            "version": server_version(),
+        }
+        key = hashlib.blake2b(
+            json.dumps(self.manifest, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
+        self.directory = Path(cache_dir) / key
+
+        self._source: Optional[Weights] = None
+        self._recorded: Dict[str, torch.Tensor] = {}
+        # Number of nested `prepare` calls: their inputs are not recorded
+        self._preparing = 0
+        self._tensors = self._load()
+
+    @property
+    def hit(self) -> bool:
+        return self._tensors is not None
+
+    def _load(self) -> Optional[Dict[str, torch.Tensor]]:
+        manifest_path = self.directory / MANIFEST_FILE
+        if not manifest_path.exists():
+            return None
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if any(manifest.get(k) != v for k, v in self.manifest.items()):
+            logger.info(f"Ignoring stale prepared weights in {self.directory}")
+            return None
+
+        start = time.perf_counter()
+        tensors = load_mmap(self.directory / WEIGHTS_FILE)
+        for alias, name in manifest.get("aliases", {}).items():
+            tensors[alias] = tensors[name]
+        if self.device.type != "cpu":
+            tensors = {name: t.to(self.device) for name, t in tensors.items()}
+        logger.info(
+            f"Loaded prepared weights from {self.directory} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+        return tensors
+
+    @property
+    def source(self) -> Weights:
+        if self._source is None:
+            self._source = Weights(self.model_path, self.device, self.dtype)
+            if self.prefetch:
+                self._source.prefetch()
+        return self._source
+
+    def __contains__(self, name: str) -> bool:
+        if self._tensors is not None:
+            return name in self._tensors
+        return name in self.source
+
+    def get_tensor(
+        self, name: str, dtype: Optional[torch.dtype] = None
+    ) -> torch.Tensor:
+        if self._tensors is not None:
+            tensor = self._tensors[name]
+            return tensor.to(dtype) if dtype is not None else tensor
+
+        tensor = self.source.get_tensor(name, dtype)
+        if not self._preparing:
+            self._recorded[name] = tensor
+        return tensor
+
+    def prepare(self, name: str, fn: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """Tensor `name` computed by `fn` from the checkpoint on the first load"""
+        if self._tensors is not None:
+            return self._tensors[name]
+
+        self._preparing += 1
+        try:
+            tensor = fn()
+        finally:
+            self._preparing -= 1
+        self._recorded[name] = tensor
+        return tensor
+
+    def state_dict(self) -> Optional[Dict[str, torch.Tensor]]:
+        return self._tensors
+
+    def record(self, tensors: Dict[str, torch.Tensor]):
+        self._recorded.update(tensors)
+
+    def save(self):
+        if self.hit or not self._recorded:
+            return
+
+        start = time.perf_counter()
+        tensors = {}
+        aliases = {}
+        # safetensors refuses tensors sharing memory (tied weights)
+        names_by_view = {}
+        for name, tensor in self._recorded.items():
+            view = (
+                tensor.device,
+                tensor.untyped_storage().data_ptr(),
+                tensor.storage_offset(),
+                tuple(tensor.shape),
+                tensor.stride(),
+            )
+            if view in names_by_view:
+                aliases[name] = names_by_view[view]
+                continue
+            names_by_view[view] = name
+            tensors[name] = tensor.detach().contiguous().cpu()
+
+        tmp_directory = self.directory.with_name(
+            f"{self.directory.name}.{os.getpid()}.tmp"
+        )
+        tmp_directory.mkdir(parents=True, exist_ok=True)
+        save_file(tensors, str(tmp_directory / WEIGHTS_FILE))
+        with open(tmp_directory / MANIFEST_FILE, "w") as f:
+            json.dump({**self.manifest, "aliases": aliases}, f, indent=2)
+
+        try:
+            os.rename(tmp_directory, self.directory)
+        except OSError:
+            # Another server prepared the same weights first
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            return
+        logger.info(
+            f"Saved prepared weights to {self.directory} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+
+@contextmanager
+def load_weights(
+    model_path: Path,
+    device: torch.device,
+    dtype: torch.dtype,
+    model_name: str,
+    prefetch: bool = True,
+) -> Iterator[Union[Weights, PreparedWeights]]:
+    """
+    Weights of `model_path` for the duration of the model construction, prepared
+    weights from `PREPARED_WEIGHTS_CACHE` when enabled.
+
+    Without `prefetch`, tensors are read one at a time when the model asks for
+    them, so that the whole checkpoint is never held in memory at once
+    """
+    if not PREPARED_WEIGHTS_CACHE:
+        weights = Weights(model_path, device, dtype)
+        if prefetch:
+            weights.prefetch()
+        yield weights
+        return
+
+    weights = PreparedWeights(model_path, device, dtype, model_name, prefetch=prefetch)
+    yield weights
+    weights.save()
@@ -0,0 +1,312 @@
+import os
+import torch
+import torch.nn.functional as F
+
+from loguru import logger
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from text_embeddings_server.models.model import Model
+from text_embeddings_server.models.types import PaddedBatch, encode_request
+
+# Minimum cosine similarity between the int8 and float outputs of the calibration
+# set: below it the server refuses to start
+INT8_MIN_COSINE = float(os.getenv("INT8_MIN_COSINE", 0.99))
+# Text file with one calibration input per line. Unset uses `CALIBRATION_TEXTS`
+INT8_CALIBRATION_FILE = os.getenv("INT8_CALIBRATION_FILE")
+
+# Bits of the weight-only `--quantize` modes
+QUANTIZE_BITS = {"int8": 8, "int4": 4}
+# Input features sharing a scale in weight-only quantization. 0 keeps one scale per
+# output channel. Unset uses per-channel int8 and groups of 128 for int4
+QUANTIZE_GROUP_SIZE = os.getenv("QUANTIZE_GROUP_SIZE")
+DEFAULT_GROUP_SIZES = {8: 0, 4: 128}
+
+CALIBRATION_TEXTS = [
+    "What is the capital of France?",
+    "The capital of France is Paris.",
+    "How do I reset my password?",
+    "def add(a, b):\n    return a + b",
+    "Der schnelle braune Fuchs springt über den faulen Hund.",
+    "Quarterly revenue grew 12% year over year, driven by cloud services.",
+    "Take two tablets daily with food and drink plenty of water.",
+    "A short one.",
+]
+
+
+def calibration_texts() -> List[str]:
+    if INT8_CALIBRATION_FILE is None:
+        return CALIBRATION_TEXTS
+    with open(INT8_CALIBRATION_FILE, "r") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def calibration_batch(model: Model, model_path: Path) -> PaddedBatch:
+    """Padded batch of the calibration texts, tokenized like the router would"""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    encodings = tokenizer(
+        calibration_texts(), truncation=True, max_length=model.max_input_length
+    )
+    rows = encodings["input_ids"]
+    token_type_ids = encodings.get("token_type_ids") or [[0] * len(r) for r in rows]
+
+    lengths = [len(row) for row in rows]
+    # RoBERTa-like models start their position ids after the padding index
+    offset = model.position_offset
+    tokens = torch.tensor(
+        [
+            [token for row in rows for token in row],
+            [token for row in token_type_ids for token in row],
+            [
+                position
+                for length in lengths
+                for position in range(offset, offset + length)
+            ],
+        ],
+        dtype=torch.int32,
+    )
+    cu_seq_lengths = [0]
+    for length in lengths:
+        cu_seq_lengths.append(cu_seq_lengths[-1] + length)
+    pb = encode_request(tokens, cu_seq_lengths, max(lengths))
+    return PaddedBatch.from_pb(pb, model.device, model.max_input_length)
+
+
+def model_outputs(model: Model, batch: PaddedBatch) -> Dict[str, torch.Tensor]:
+    """Outputs of the methods the model implements"""
+    outputs = {}
+    for method in ["embed", "predict"]:
+        output = getattr(model, method)(batch)
+        if output is not None:
+            outputs[method] = output.float()
+    return outputs
+
+
+def quantize_int8(model: Model, model_path: Path) -> Model:
+    """
+    Replace the `nn.Linear` layers of a transformers model by dynamically quantized
+    int8 layers: weights are quantized once, activations per batch.
+
+    The outputs of the calibration set must stay within `INT8_MIN_COSINE` of the
+    float model, or the model is refused.
+    """
+    if model.device.type != "cpu":
+        raise RuntimeError(f"int8 only runs on CPU, not {model.device.type}")
+
+    batch = calibration_batch(model, model_path)
+    expected = model_outputs(model, batch)
+
+    torch.ao.quantization.quantize_dynamic(
+        model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    model.quantize = "int8"
+
+    for method, output in model_outputs(model, batch).items():
+        cosine = torch.nn.functional.cosine_similarity(output, expected[method]).min()
+        if cosine < INT8_MIN_COSINE:
+            raise RuntimeError(
+                f"int8 {method} drifts from float: cosine similarity {cosine:.4f} < "
+                f"{INT8_MIN_COSINE} on the calibration set"
+            )
+        logger.info(f"int8 {method} cosine similarity to float: {cosine:.4f}")
+    return model
+
+
+def quantize_group_size(quantize: str) -> int:
+    """Input features sharing a scale in the `quantize` mode, 0 for per-channel"""
+    bits = QUANTIZE_BITS[quantize]
+    if QUANTIZE_GROUP_SIZE is not None:
+        return max(0, int(QUANTIZE_GROUP_SIZE))
+    return DEFAULT_GROUP_SIZES[bits]
+
+
+def prepared_model_name(name: str, quantize: Optional[str]) -> str:
+    """
+    Key of the prepared weights of model `name`: quantized weights are keyed apart,
+    by mode and group size
+    """
+    if quantize is None:
+        return name
+    return f"{name}:{quantize}:g{quantize_group_size(quantize)}"
+
+
+def quantize_weight(
+    weight: torch.Tensor, bits: int, group_size: int, name: str = "weight"
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric quantization of a `[out, in]` weight with one scale per `group_size`
+    input features. int8 weights are stored as int8, int4 weights as pairs of
+    nibbles offset by 8 in uint8, `[out, in // 2]`
+    """
+    out_features, in_features = weight.shape
+    if group_size <= 0 or in_features % group_size != 0:
+        raise ValueError(
+            f"Cannot quantize {name}: {in_features} input features are not a "
+            f"multiple of the group size {group_size}"
+        )
+    if bits == 4 and in_features % 2 != 0:
+        raise ValueError(
+            f"Cannot quantize {name} to int4: {in_features} input features do not "
+            f"pack in pairs"
+        )
+    groups = weight.float().view(out_features, -1, group_size)
+    max_value = 2 ** (bits - 1) - 1
+    scales = groups.abs().amax(-1, keepdim=True).clamp_(min=1e-8) / max_value
+    qweight = (groups / scales).round_().clamp_(-max_value - 1, max_value)
+    qweight = qweight.view(out_features, in_features).to(torch.int8)
+    if bits == 4:
+        qweight = (qweight + 8).to(torch.uint8)
+        qweight = qweight[:, ::2] | (qweight[:, 1::2] << 4)
+    return qweight, scales.squeeze(-1).to(weight.dtype)
+
+
+class QuantizedLinear:
+    """
+    Weight-only quantized linear layer. Per-channel int8 runs the int8 matmul
+    kernel of PyTorch on CPU, the other layouts are dequantized on the fly
+    """
+
+    def __init__(self, qweight: torch.Tensor, scales: torch.Tensor, bits: int):
+        self.qweight = qweight
+        self.scales = scales
+        self.bits = bits
+        self.out_features = qweight.size(0)
+        self.in_features = qweight.size(1) * (8 // bits)
+        self.group_size = self.in_features // scales.size(1)
+        self.use_int8_kernel = (
+            bits == 8
+            and scales.size(1) == 1
+            and qweight.device.type == "cpu"
+            and hasattr(torch, "_weight_int8pack_mm")
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.qweight.nbytes + self.scales.nbytes
+
+    def dequantize(self) -> torch.Tensor:
+        qweight = self.qweight
+        if self.bits == 4:
+            qweight = torch.stack([qweight & 0xF, qweight >> 4], dim=-1)
+            qweight = qweight.view(self.out_features, -1).to(torch.int8) - 8
+        weight = qweight.view(self.out_features, -1, self.group_size).to(
+            self.scales.dtype
+        )
+        return (weight * self.scales[..., None]).view(self.out_features, -1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.use_int8_kernel:
+            output = torch._weight_int8pack_mm(
+                x.reshape(-1, self.in_features), self.qweight, self.scales[:, 0]
+            )
+            return output.view(*x.shape[:-1], self.out_features)
+        return F.linear(x, self.dequantize())
+
+
+def linear(
+    x: torch.Tensor, weight: Union[torch.Tensor, QuantizedLinear]
+) -> torch.Tensor:
+    if isinstance(weight, QuantizedLinear):
+        return weight.forward(x)
+    return F.linear(x, weight)
+
+
+def load_linear(
+    weights,
+    name: str,
+    quantize: Optional[str] = None,
+    parts: Optional[List[str]] = None,
+) -> Union[torch.Tensor, QuantizedLinear]:
+    """
+    Weight `name` of a linear layer, or the rows of the `parts` weights of the
+    checkpoint fused into it when given. With `quantize`, the layer is quantized at
+    load time or read from the `.qweight` and `.scales` tensors of a pre-quantized
+    checkpoint, fused or one per part
+    """
+
+    def dense_weight() -> torch.Tensor:
+        if parts is None:
+            return weights.get_tensor(name)
+        return torch.cat([weights.get_tensor(part) for part in parts])
+
+    if quantize is None:
+        return (
+            weights.prepare(name, dense_weight) if parts else weights.get_tensor(name)
+        )
+
+    bits = QUANTIZE_BITS[quantize]
+    prefix = name.rsplit(".", 1)[0]
+    qweight_name, scales_name = f"{prefix}.qweight", f"{prefix}.scales"
+    qweight_dtype = torch.int8 if bits == 8 else torch.uint8
+    if qweight_name in weights:
+        return QuantizedLinear(
+            weights.get_tensor(qweight_name, qweight_dtype),
+            weights.get_tensor(scales_name),
+            bits,
+        )
+
+    part_prefixes = [part.rsplit(".", 1)[0] for part in parts or []]
+    if part_prefixes and f"{part_prefixes[0]}.qweight" in weights:
+        # Output channels are independent: the parts fuse row-wise like the weights
+        scales = [weights.get_tensor(f"{part}.scales") for part in part_prefixes]
+        if len({part_scales.size(1) for part_scales in scales}) > 1:
+            raise RuntimeError(
+                f"Cannot fuse {', '.join(part_prefixes)} into {prefix}: they are "
+                f"quantized with different group sizes"
+            )
+        return QuantizedLinear(
+            torch.cat(
+                [
+                    weights.get_tensor(f"{part}.qweight", qweight_dtype)
+                    for part in part_prefixes
+                ]
+            ),
+            torch.cat(scales),
+            bits,
+        )
+
+    quantized = []
+
+    def quantized_part(index: int) -> torch.Tensor:
+        if not quantized:
+            weight = dense_weight()
+            group_size = quantize_group_size(quantize)
+            if group_size <= 0 or weight.size(1) % group_size != 0:
+                group_size = weight.size(1)
+            quantized.extend(quantize_weight(weight, bits, group_size, prefix))
+        return quantized[index]
+
+    return QuantizedLinear(
+        weights.prepare(qweight_name, lambda: quantized_part(0)),
+        weights.prepare(scales_name, lambda: quantized_part(1)),
+        bits,
+    )
+
+
+def weight_nbytes(layers: List) -> Tuple[int, int]:
+    """Bytes of the linear weights of `layers`, and of the same weights unquantized"""
+    nbytes = dense_nbytes = 0
+    for layer in layers:
+        for module in [layer.attention, layer.mlp]:
+            for value in vars(module).values():
+                if isinstance(value, QuantizedLinear):
+                    nbytes += value.nbytes
+                    dense_nbytes += (
+                        value.out_features
+                        * value.in_features
+                        * value.scales.element_size()
+                    )
+                elif isinstance(value, torch.Tensor) and value.dim() == 2:
+                    nbytes += value.nbytes
+                    dense_nbytes += value.nbytes
+    return nbytes, dense_nbytes
+
+
+def log_quantized_size(layers: List, quantize: str):
+    nbytes, dense_nbytes = weight_nbytes(layers)
+    logger.info(
+        f"Quantized projections to {quantize}: {nbytes / 2**30:.2f} GiB instead of "
+        f"{dense_nbytes / 2**30:.2f} GiB"
+    )
@@ -0,0 +1,77 @@
+import torch
+
+from transformers import PretrainedConfig
+from typing import Tuple
+
+
+def compute_default_rope_parameters(
+    config: PretrainedConfig,
+    device: torch.device,
+) -> tuple["torch.Tensor", float]:
+    base = config.rope_theta
+    partial_rotary_factor = (
+        config.partial_rotary_factor
+        if hasattr(config, "partial_rotary_factor")
+        else 1.0
+    )
+    head_dim = (
+        getattr(config, "head_dim", None)
+        or config.hidden_size // config.num_attention_heads
+    )
+    dim = int(head_dim * partial_rotary_factor)
+    attention_factor = 1.0
+
+    inv_freq = 1.0 / (
+        base
+        ** (
+            torch.arange(0, dim, 2, dtype=torch.int64).to(
+                device=device, dtype=torch.float
+            )
+            / dim
+        )
+    )
+    return inv_freq, attention_factor
+
+
+class RotaryCache:
+    """
+    cos and sin of every position up to `max_position_embeddings`, computed once in
+    float32 at load time and stored in the model dtype. One instance is shared by
+    all the layers of a model.
+
+    Only the first half of the frequencies is kept: the second half of the
+    rotary dimensions uses the same values.
+    """
+
+    def __init__(
+        self, config: PretrainedConfig, device: torch.device, dtype: torch.dtype
+    ):
+        inv_freq, attention_scaling = compute_default_rope_parameters(config, device)
+        positions = torch.arange(
+            config.max_position_embeddings, device=device, dtype=torch.float32
+        )
+        freqs = torch.outer(positions, inv_freq)
+        self.cos = (freqs.cos() * attention_scaling).to(dtype)
+        self.sin = (freqs.sin() * attention_scaling).to(dtype)
+        self.rotary_dim = 2 * inv_freq.numel()
+
+    def __call__(self, position_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """[..., rotary_dim // 2] cos and sin of `position_ids`, any shape"""
+        return self.cos[position_ids], self.sin[position_ids]
+
+
+def apply_rotary_(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor):
+    """
+    Rotate `x` of shape [..., heads, head_dim] in place, with `cos` and `sin` from
+    `RotaryCache` for the leading dimensions of `x`
+    """
+    cos = cos.unsqueeze(-2)
+    sin = sin.unsqueeze(-2)
+    half = cos.size(-1)
+    x1 = x[..., :half]
+    x2 = x[..., half : 2 * half]
+    # (x1, x2) -> (x1 * cos - x2 * sin, x2 * cos + x1 * sin): only x1 is copied
+    x1_copy = x1.clone()
+    x1.mul_(cos).addcmul_(x2, sin, value=-1)
+    x2.mul_(cos).addcmul_(x1_copy, sin)
+    return x
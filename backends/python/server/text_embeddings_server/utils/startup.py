@@ -0,0 +1,34 @@
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from loguru import logger
+
+
+class StartupProfile:
+    """Wall time spent in each phase of the server startup"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def report(self):
+        total = time.perf_counter() - self.start
+        lines = [f"{'phase':<24}{'seconds':>10}{'share':>8}"]
+        for name, seconds in self.phases.items():
+            lines.append(f"{name:<24}{seconds:>10.3f}{seconds / total:>8.1%}")
+        other = total - sum(self.phases.values())
+        lines.append(f"{'other':<24}{other:>10.3f}{other / total:>8.1%}")
+        lines.append(f"{'total':<24}{total:>10.3f}")
+        logger.info("Startup profile:\n" + "\n".join(lines))
+
+
+startup_profile = StartupProfile()
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+import torch
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from pathlib import Path
+from safetensors import safe_open
+from typing import Callable, Dict, List, Optional
+
+# Threads reading and converting tensors while loading the weights
+WEIGHTS_LOADING_THREADS = int(
+    os.getenv("WEIGHTS_LOADING_THREADS", min(8, os.cpu_count() or 1))
+)
+
+SINGLE_FILE = "model.safetensors"
+INDEX_FILE = "model.safetensors.index.json"
+
+
+def weight_files(model_path: Path) -> List[Path]:
+    """Safetensors files of a single file or sharded checkpoint"""
+    index_path = model_path / INDEX_FILE
+    if index_path.exists():
+        with open(index_path, "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [model_path / name for name in sorted(set(weight_map.values()))]
+    return [model_path / SINGLE_FILE]
+
+
+class Weights:
+    """
+    Tensors of a safetensors checkpoint, `model.safetensors` or sharded with
+    `model.safetensors.index.json`.
+
+    Every shard is opened once. `prefetch` reads all tensors in parallel and moves
+    them to `device` and `dtype` in a single copy, `get_tensor` then hands them
+    over to the model.
+    """
+
+    def __init__(self, model_path: Path, device: torch.device, dtype: torch.dtype):
+        self.model_path = model_path
+        self.device = device
+        self.dtype = dtype
+
+        self._handles = {}
+        self._routing: Dict[str, str] = {}
+        for path in weight_files(model_path):
+            handle = safe_open(path, framework="pt")
+            self._handles[path.name] = handle
+            for name in handle.keys():
+                self._routing[name] = path.name
+        self._prefetched: Dict[str, torch.Tensor] = {}
+
+    def keys(self) -> List[str]:
+        return list(self._routing.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._routing
+
+    def _load(self, name: str, dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+        tensor = self._handles[self._routing[name]].get_tensor(name)
+        return tensor.to(device=self.device, dtype=dtype or self.dtype)
+
+    def prefetch(self, max_workers: int = WEIGHTS_LOADING_THREADS):
+        """Load every tensor of the checkpoint in parallel"""
+        names_per_shard = defaultdict(list)
+        for name, shard in self._routing.items():
+            names_per_shard[shard].append(name)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="weights"
+        ) as pool:
+            for shard, names in names_per_shard.items():
+                shard_start = time.perf_counter()
+                tensors = pool.map(self._load, names)
+                num_bytes = 0
+                for name, tensor in zip(names, tensors):
+                    self._prefetched[name] = tensor
+                    num_bytes += tensor.nbytes
+                logger.info(
+                    f"Loaded {shard} ({len(names)} tensors, {num_bytes / 2**20:.1f} MiB) "
+                    f"in {time.perf_counter() - shard_start:.2f}s"
+                )
+        logger.info(f"Loaded weights in {time.perf_counter() - start:.2f}s")
+
+    def get_tensor(
+        self, name: str, dtype: Optional[torch.dtype] = None
+    ) -> torch.Tensor:
+        """`name` on the target device, in `dtype` or the model dtype"""
+        tensor = self._prefetched.pop(name, None)
+        if tensor is None:
+            return self._load(name, dtype)
+        return tensor.to(dtype) if dtype is not None else tensor
+
+    def prepare(self, name: str, fn: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """Tensor `name` derived from the checkpoint by `fn`"""
+        return fn()